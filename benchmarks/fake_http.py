@@ -0,0 +1,72 @@
+"""
+Base of the HTTP stand-ins for the services transmart-packer depends on.
+"""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Tuple
+
+# A handler gets the request and its body, and returns the status code, the body
+# (bytes, or an object to send as JSON) and optionally extra response headers.
+Handler = Callable[[BaseHTTPRequestHandler, bytes], tuple]
+
+
+class FakeService:
+    """
+    HTTP service on a local port, that handles every request in its own thread.
+    """
+    name = 'fake-service'
+
+    def __init__(self):
+        self.server = None
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def routes(self) -> Dict[Tuple[str, str], Handler]:
+        """ :return: the handlers by method and path. """
+        raise NotImplementedError
+
+    def start(self, port: int = 0):
+        """
+        :param port: port to listen on, a free port by default.
+        """
+        service = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def handle_request(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                handler = service.routes().get((self.command, self.path.split('?')[0]))
+                if handler is None:
+                    self.respond(404, {'error': 'not_found'})
+                else:
+                    self.respond(*handler(self, body))
+
+            do_GET = do_POST = handle_request
+
+            def respond(self, code: int, body, headers: dict = None):
+                headers = dict(headers or {})
+                if not isinstance(body, bytes):
+                    body = json.dumps(body).encode()
+                    headers.setdefault('Content-Type', 'application/json')
+                self.send_response(code)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), RequestHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name=self.name, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
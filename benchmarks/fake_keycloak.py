@@ -0,0 +1,71 @@
+"""
+Keycloak stand-in for benchmarks, that signs access tokens with a generated RSA key
+and serves its public key as the certificates (JWKS) of the realm.
+"""
+import json
+import time
+from urllib.parse import parse_qs
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jwt.algorithms import RSAAlgorithm
+
+from benchmarks.fake_http import FakeService
+
+KEY_ID = 'benchmark-key'
+SERVICE_USER = 'packer-service'
+
+
+class FakeKeycloak(FakeService):
+    """
+    Keycloak realm on a local HTTP port. The token endpoint accepts any offline token,
+    for the service user, and exchanges it for a token of any user.
+    """
+    name = 'fake-keycloak'
+
+    def __init__(self, realm: str = 'transmart', client_id: str = 'transmart-client', token_lifetime: int = 3600):
+        super().__init__()
+        self.realm = realm
+        self.client_id = client_id
+        self.token_lifetime = token_lifetime
+        self.private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.tokens_issued = 0
+
+    @property
+    def server_url(self) -> str:
+        """ URL to configure as ``KEYCLOAK_SERVER_URL``. """
+        return self.url
+
+    @property
+    def realm_url(self) -> str:
+        return f'{self.server_url}/realms/{self.realm}'
+
+    def jwks(self) -> dict:
+        key = json.loads(RSAAlgorithm.to_jwk(self.private_key.public_key()))
+        return {'keys': [dict(key, kid=KEY_ID, alg='RS256', use='sig')]}
+
+    def token(self, user: str, **claims) -> str:
+        """ :return: an access token of the user, signed by the realm. """
+        now = int(time.time())
+        claims = dict(sub=user, aud=self.client_id, iat=now, exp=now + self.token_lifetime,
+                      iss=self.realm_url, email=f'{user}@example.com', **claims)
+        return jwt.encode(claims, self.private_key, algorithm='RS256', headers={'kid': KEY_ID})
+
+    def get_certs(self, request, body: bytes):
+        return 200, self.jwks()
+
+    def post_token(self, request, body: bytes):
+        params = {name: values[0] for name, values in parse_qs(body.decode()).items()}
+        grant_type = params.get('grant_type')
+        if grant_type == 'refresh_token' and params.get('refresh_token'):
+            user = SERVICE_USER
+        elif grant_type == 'urn:ietf:params:oauth:grant-type:token-exchange' and params.get('subject_token'):
+            user = params.get('requested_subject', SERVICE_USER)
+        else:
+            return 400, {'error': 'invalid_grant'}
+        self.tokens_issued += 1
+        return 200, {'access_token': self.token(user), 'expires_in': self.token_lifetime, 'token_type': 'Bearer'}
+
+    def routes(self) -> dict:
+        path = f'/realms/{self.realm}/protocol/openid-connect'
+        return {('GET', f'{path}/certs'): self.get_certs, ('POST', f'{path}/token'): self.post_token}
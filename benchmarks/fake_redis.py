@@ -0,0 +1,782 @@
+"""
+Redis stand-in for benchmarks, that speaks the Redis protocol (RESP) and keeps its data in memory.
+
+It implements the commands that the API server uses: strings, sets, hashes, lists, streams,
+publish/subscribe and transactions. Lua scripts (``EVAL``) are not supported, so the admission
+limits must be disabled when the server runs against it.
+"""
+import argparse
+import asyncio
+import fnmatch
+import itertools
+import multiprocessing
+import time
+from collections import deque, defaultdict
+from typing import List, Optional, Tuple
+
+
+class CommandError(Exception):
+    """ Error reply to a command. """
+
+
+WRONGTYPE = 'WRONGTYPE Operation against a key holding the wrong kind of value'
+
+
+class Stream:
+
+    def __init__(self):
+        self.entries = []  # (ms, seq, fields)
+        self.last_id = (0, 0)
+
+    def add(self, fields: List[bytes], maxlen: Optional[int]) -> bytes:
+        ms = int(time.time() * 1000)
+        seq = self.last_id[1] + 1 if ms <= self.last_id[0] else 0
+        self.last_id = (max(ms, self.last_id[0]), seq)
+        self.entries.append((*self.last_id, fields))
+        if maxlen is not None and len(self.entries) > maxlen:
+            del self.entries[:len(self.entries) - maxlen]
+        return format_stream_id(self.last_id)
+
+    def range(self, start: bytes, stop: bytes, count: Optional[int]) -> list:
+        first = (0, 0) if start == b'-' else parse_stream_id(start, 0)
+        last = (float('inf'), 0) if stop == b'+' else parse_stream_id(stop, float('inf'))
+        result = []
+        for ms, seq, fields in self.entries:
+            if first <= (ms, seq) <= last:
+                result.append([format_stream_id((ms, seq)), fields])
+                if count is not None and len(result) >= count:
+                    break
+        return result
+
+
+def parse_stream_id(value: bytes, default_seq) -> Tuple[int, int]:
+    ms, _, seq = value.decode().partition('-')
+    try:
+        return int(ms), int(seq) if seq else default_seq
+    except ValueError:
+        raise CommandError('ERR Invalid stream ID specified as stream command argument')
+
+
+def format_stream_id(stream_id) -> bytes:
+    return f'{stream_id[0]}-{stream_id[1]}'.encode()
+
+
+def format_float(value: float) -> bytes:
+    text = repr(value)
+    return (text[:-2] if text.endswith('.0') else text).encode()
+
+
+def to_int(value: bytes) -> int:
+    try:
+        return int(value)
+    except ValueError:
+        raise CommandError('ERR value is not an integer or out of range')
+
+
+def to_float(value: bytes) -> float:
+    try:
+        return float(value)
+    except ValueError:
+        raise CommandError('ERR value is not a valid float')
+
+
+class Connection:
+
+    def __init__(self, server, writer: asyncio.StreamWriter):
+        self.server = server
+        self.writer = writer
+        self.channels = set()
+        self.patterns = set()
+        self.transaction = None  # commands queued after MULTI
+
+    @property
+    def subscriptions(self) -> int:
+        return len(self.channels) + len(self.patterns)
+
+    def send(self, reply):
+        self.writer.write(encode(reply))
+
+
+class Status(str):
+    """ Simple string reply. """
+
+
+class NoArray(list):
+    """ Null array reply. """
+
+
+OK = Status('OK')
+NO_ARRAY = NoArray()
+NO_REPLY = object()
+
+
+def encode(reply) -> bytes:
+    if reply is None:
+        return b'$-1\r\n'
+    if isinstance(reply, NoArray):
+        return b'*-1\r\n'
+    if isinstance(reply, Status):
+        return b'+' + reply.encode() + b'\r\n'
+    if isinstance(reply, CommandError):
+        return b'-' + str(reply).encode() + b'\r\n'
+    if isinstance(reply, bool):
+        reply = int(reply)
+    if isinstance(reply, int):
+        return b':%d\r\n' % reply
+    if isinstance(reply, str):
+        reply = reply.encode()
+    if isinstance(reply, bytes):
+        return b'$%d\r\n%s\r\n' % (len(reply), reply)
+    return b'*%d\r\n' % len(reply) + b''.join(encode(item) for item in reply)
+
+
+async def read_command(reader: asyncio.StreamReader) -> Optional[List[bytes]]:
+    line = await reader.readline()
+    if not line:
+        return None
+    if not line.startswith(b'*'):
+        return line.split()  # inline command, e.g., from telnet
+    args = []
+    for _ in range(int(line[1:])):
+        length = int((await reader.readline())[1:])
+        args.append((await reader.readexactly(length + 2))[:-2])
+    return args
+
+
+class FakeRedisServer:
+    """
+    In-memory Redis server on a TCP port, running on an asyncio loop.
+    """
+
+    BLOCKING = {b'BLPOP', b'BRPOP'}
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        """
+        :param port: port to listen on, a free port by default.
+        """
+        self.host = host
+        self.port = port
+        self.data = {}
+        self.expires = {}
+        self.connections = set()
+        self.waiters = defaultdict(deque)  # futures of blocked list pops by key
+        self.server = None
+
+    @property
+    def url(self) -> str:
+        return f'redis://{self.host}:{self.port}'
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        connection = Connection(self, writer)
+        self.connections.add(connection)
+        try:
+            while True:
+                args = await read_command(reader)
+                if args is None:
+                    break
+                if not args:
+                    continue
+                name = args[0].upper()
+                if name in self.BLOCKING and connection.transaction is None:
+                    reply = await self.blocking_pop(name, args[1:])
+                else:
+                    reply = self.execute(connection, name, args[1:])
+                if reply is not NO_REPLY:
+                    connection.send(reply)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.connections.discard(connection)
+            writer.close()
+
+    def execute(self, connection: Connection, name: bytes, args: List[bytes]):
+        try:
+            if connection.transaction is not None and name not in (b'EXEC', b'DISCARD', b'MULTI'):
+                connection.transaction.append((name, args))
+                return Status('QUEUED')
+            command = COMMANDS.get(name.decode().lower())
+            if command is None:
+                raise CommandError(f'ERR unknown command {name.decode()!r}')
+            if connection.subscriptions and name not in PUBSUB_COMMANDS:
+                raise CommandError('ERR only (P)SUBSCRIBE / (P)UNSUBSCRIBE / PING / QUIT allowed in this context')
+            return command(self, connection, *args)
+        except CommandError as e:
+            return e
+        except TypeError:
+            return CommandError(f'ERR wrong number of arguments for {name.decode().lower()!r} command')
+
+    # Keys
+
+    def get(self, key: bytes, kind=None, create=False):
+        expires_at = self.expires.get(key)
+        if expires_at is not None and expires_at <= time.time():
+            self.delete(key)
+        value = self.data.get(key)
+        if value is None and create:
+            value = self.data[key] = kind()
+        if value is not None and kind is not None and not isinstance(value, kind):
+            raise CommandError(WRONGTYPE)
+        return value
+
+    def delete(self, key: bytes) -> bool:
+        self.expires.pop(key, None)
+        return self.data.pop(key, None) is not None
+
+    def cleanup(self, key: bytes):
+        """ Remove a key whose collection has become empty. """
+        if key in self.data and not self.data[key]:
+            self.delete(key)
+
+    def expire_at(self, key: bytes, timestamp: float) -> bool:
+        if self.get(key) is None:
+            return False
+        self.expires[key] = timestamp
+        return True
+
+    def publish(self, channel: bytes, message: bytes) -> int:
+        receivers = 0
+        text = channel.decode('latin-1')
+        for connection in list(self.connections):
+            if channel in connection.channels:
+                connection.send([b'message', channel, message])
+                receivers += 1
+            for pattern in connection.patterns:
+                if fnmatch.fnmatchcase(text, pattern.decode('latin-1')):
+                    connection.send([b'pmessage', pattern, channel, message])
+                    receivers += 1
+        return receivers
+
+    def push(self, key: bytes, values: List[bytes], left: bool) -> int:
+        items = self.get(key, deque, create=True)
+        for value in values:
+            items.appendleft(value) if left else items.append(value)
+        length = len(items)
+        waiters = self.waiters.get(key)
+        while waiters and items:
+            future, pop_left = waiters.popleft()
+            if not future.done():
+                future.set_result([key, items.popleft() if pop_left else items.pop()])
+        self.cleanup(key)
+        return length
+
+    async def blocking_pop(self, name: bytes, args: List[bytes]):
+        *keys, timeout = args
+        left = name == b'BLPOP'
+        for key in keys:
+            items = self.get(key, deque)
+            if items:
+                value = items.popleft() if left else items.pop()
+                self.cleanup(key)
+                return [key, value]
+        future = asyncio.get_event_loop().create_future()
+        for key in keys:
+            self.waiters[key].append((future, left))
+        try:
+            return await asyncio.wait_for(future, float(timeout) or None)
+        except asyncio.TimeoutError:
+            return NO_ARRAY
+        finally:
+            for key in keys:
+                waiters = self.waiters.get(key)
+                if waiters is not None:
+                    self.waiters[key] = deque(waiter for waiter in waiters if waiter[0] is not future)
+                    if not self.waiters[key]:
+                        del self.waiters[key]
+
+
+COMMANDS = {}
+PUBSUB_COMMANDS = {b'SUBSCRIBE', b'UNSUBSCRIBE', b'PSUBSCRIBE', b'PUNSUBSCRIBE', b'PING', b'QUIT'}
+
+
+def command(function):
+    COMMANDS[function.__name__.rstrip('_')] = function
+    return function
+
+
+# Connection
+
+
+@command
+def ping(server, connection, message=None):
+    if connection.subscriptions:
+        return [b'pong', message or b'']
+    return Status('PONG') if message is None else message
+
+
+@command
+def echo(server, connection, message):
+    return message
+
+
+@command
+def select(server, connection, db):
+    return OK
+
+
+@command
+def client(server, connection, *args):
+    return OK
+
+
+@command
+def info(server, connection, *sections):
+    return b'# Server\r\nredis_version:6.2.0\r\nredis_mode:standalone\r\n'
+
+
+@command
+def quit_(server, connection):
+    return OK
+
+
+# Keys
+
+
+@command
+def flushall(server, connection, *args):
+    server.data.clear()
+    server.expires.clear()
+    return OK
+
+
+COMMANDS['flushdb'] = flushall
+
+
+@command
+def dbsize(server, connection):
+    return len(server.data)
+
+
+@command
+def keys(server, connection, pattern):
+    pattern = pattern.decode('latin-1')
+    return [key for key in list(server.data)
+            if server.get(key) is not None and fnmatch.fnmatchcase(key.decode('latin-1'), pattern)]
+
+
+@command
+def exists(server, connection, *keys):
+    return sum(server.get(key) is not None for key in keys)
+
+
+@command
+def delete(server, connection, *keys):
+    return sum(server.delete(key) for key in keys)
+
+
+COMMANDS['del'] = COMMANDS['unlink'] = delete
+
+
+@command
+def type_(server, connection, key):
+    names = {bytes: 'string', set: 'set', dict: 'hash', deque: 'list', Stream: 'stream'}
+    return Status(names.get(type(server.get(key)), 'none'))
+
+
+@command
+def expire(server, connection, key, seconds):
+    return server.expire_at(key, time.time() + to_int(seconds))
+
+
+@command
+def pexpire(server, connection, key, milliseconds):
+    return server.expire_at(key, time.time() + to_int(milliseconds) / 1000)
+
+
+@command
+def ttl(server, connection, key):
+    if server.get(key) is None:
+        return -2
+    expires_at = server.expires.get(key)
+    return -1 if expires_at is None else round(expires_at - time.time())
+
+
+@command
+def persist(server, connection, key):
+    return server.expires.pop(key, None) is not None
+
+
+# Strings
+
+
+@command
+def get(server, connection, key):
+    return server.get(key, bytes)
+
+
+@command
+def set_(server, connection, key, value, *options):
+    options = [option.upper() for option in options]
+    expires_at = None
+    condition = None
+    index = 0
+    while index < len(options):
+        option = options[index]
+        if option in (b'EX', b'PX') and index + 1 < len(options):
+            amount = to_int(options[index + 1])
+            expires_at = time.time() + (amount if option == b'EX' else amount / 1000)
+            index += 1
+        elif option in (b'NX', b'XX'):
+            condition = option
+        elif option != b'KEEPTTL':
+            raise CommandError('ERR syntax error')
+        index += 1
+    exists_ = server.get(key) is not None
+    if (condition == b'NX' and exists_) or (condition == b'XX' and not exists_):
+        return None
+    keep_ttl = b'KEEPTTL' in options and key in server.expires
+    server.data[key] = value
+    if expires_at is not None:
+        server.expires[key] = expires_at
+    elif not keep_ttl:
+        server.expires.pop(key, None)
+    return OK
+
+
+@command
+def setex(server, connection, key, seconds, value):
+    return set_(server, connection, key, value, b'EX', seconds)
+
+
+@command
+def setnx(server, connection, key, value):
+    return set_(server, connection, key, value, b'NX') is not None
+
+
+@command
+def mget(server, connection, *keys):
+    values = []
+    for key in keys:
+        value = server.get(key)
+        values.append(value if isinstance(value, bytes) else None)
+    return values
+
+
+@command
+def mset(server, connection, *pairs):
+    for key, value in zip(pairs[::2], pairs[1::2]):
+        set_(server, connection, key, value)
+    return OK
+
+
+@command
+def incrby(server, connection, key, amount):
+    value = to_int(server.get(key, bytes) or b'0') + to_int(amount)
+    server.data[key] = str(value).encode()
+    return value
+
+
+@command
+def incr(server, connection, key):
+    return incrby(server, connection, key, b'1')
+
+
+@command
+def decr(server, connection, key):
+    return incrby(server, connection, key, b'-1')
+
+
+@command
+def incrbyfloat(server, connection, key, amount):
+    value = format_float(to_float(server.get(key, bytes) or b'0') + to_float(amount))
+    server.data[key] = value
+    return value
+
+
+# Sets
+
+
+@command
+def sadd(server, connection, key, *members):
+    items = server.get(key, set, create=True)
+    size = len(items)
+    items.update(members)
+    return len(items) - size
+
+
+@command
+def srem(server, connection, key, *members):
+    items = server.get(key, set) or set()
+    size = len(items)
+    items.difference_update(members)
+    server.cleanup(key)
+    return size - len(items)
+
+
+@command
+def smembers(server, connection, key):
+    return list(server.get(key, set) or ())
+
+
+@command
+def sismember(server, connection, key, member):
+    return member in (server.get(key, set) or ())
+
+
+@command
+def scard(server, connection, key):
+    return len(server.get(key, set) or ())
+
+
+# Hashes
+
+
+@command
+def hset(server, connection, key, *pairs):
+    if not pairs or len(pairs) % 2:
+        raise TypeError
+    fields = server.get(key, dict, create=True)
+    added = 0
+    for field, value in zip(pairs[::2], pairs[1::2]):
+        added += field not in fields
+        fields[field] = value
+    return added
+
+
+@command
+def hmset(server, connection, key, *pairs):
+    hset(server, connection, key, *pairs)
+    return OK
+
+
+@command
+def hget(server, connection, key, field):
+    return (server.get(key, dict) or {}).get(field)
+
+
+@command
+def hmget(server, connection, key, *fields):
+    values = server.get(key, dict) or {}
+    return [values.get(field) for field in fields]
+
+
+@command
+def hgetall(server, connection, key):
+    return list(itertools.chain.from_iterable((server.get(key, dict) or {}).items()))
+
+
+@command
+def hdel(server, connection, key, *fields):
+    values = server.get(key, dict) or {}
+    removed = sum(values.pop(field, None) is not None for field in fields)
+    server.cleanup(key)
+    return removed
+
+
+@command
+def hlen(server, connection, key):
+    return len(server.get(key, dict) or {})
+
+
+@command
+def hexists(server, connection, key, field):
+    return field in (server.get(key, dict) or {})
+
+
+@command
+def hincrby(server, connection, key, field, amount):
+    fields = server.get(key, dict, create=True)
+    value = to_int(fields.get(field, b'0')) + to_int(amount)
+    fields[field] = str(value).encode()
+    return value
+
+
+@command
+def hincrbyfloat(server, connection, key, field, amount):
+    fields = server.get(key, dict, create=True)
+    value = format_float(to_float(fields.get(field, b'0')) + to_float(amount))
+    fields[field] = value
+    return value
+
+
+# Lists
+
+
+@command
+def lpush(server, connection, key, *values):
+    return server.push(key, values, left=True)
+
+
+@command
+def rpush(server, connection, key, *values):
+    return server.push(key, values, left=False)
+
+
+@command
+def lpop(server, connection, key):
+    items = server.get(key, deque)
+    value = items.popleft() if items else None
+    server.cleanup(key)
+    return value
+
+
+@command
+def rpop(server, connection, key):
+    items = server.get(key, deque)
+    value = items.pop() if items else None
+    server.cleanup(key)
+    return value
+
+
+@command
+def llen(server, connection, key):
+    return len(server.get(key, deque) or ())
+
+
+@command
+def lrange(server, connection, key, start, stop):
+    items = list(server.get(key, deque) or ())
+    start, stop = to_int(start), to_int(stop)
+    stop = len(items) if stop == -1 else stop + 1
+    return items[start:stop]
+
+
+# Streams
+
+
+@command
+def xadd(server, connection, key, *args):
+    args = list(args)
+    maxlen = None
+    if args and args[0].upper() == b'MAXLEN':
+        del args[0]
+        if args[0] in (b'~', b'='):
+            del args[0]
+        maxlen = to_int(args.pop(0))
+    entry_id, *fields = args
+    if entry_id != b'*':
+        raise CommandError('ERR only automatically generated stream ids are supported')
+    if not fields or len(fields) % 2:
+        raise TypeError
+    return server.get(key, Stream, create=True).add(fields, maxlen)
+
+
+@command
+def xlen(server, connection, key):
+    stream = server.get(key, Stream)
+    return 0 if stream is None else len(stream.entries)
+
+
+@command
+def xrange(server, connection, key, start, stop, *options):
+    count = None
+    if options:
+        if len(options) != 2 or options[0].upper() != b'COUNT':
+            raise CommandError('ERR syntax error')
+        count = to_int(options[1])
+    stream = server.get(key, Stream)
+    return [] if stream is None else stream.range(start, stop, count)
+
+
+# Publish/subscribe
+
+
+@command
+def publish(server, connection, channel, message):
+    return server.publish(channel, message)
+
+
+def subscribe_replies(connection, kind: bytes, names, subscriptions: set, add: bool):
+    if not names:
+        names = list(subscriptions)
+        if not names:
+            connection.send([kind, None, connection.subscriptions])
+    for name in names:
+        if add:
+            subscriptions.add(name)
+        else:
+            subscriptions.discard(name)
+        connection.send([kind, name, connection.subscriptions])
+    return NO_REPLY
+
+
+@command
+def subscribe(server, connection, *channels):
+    return subscribe_replies(connection, b'subscribe', channels, connection.channels, True)
+
+
+@command
+def unsubscribe(server, connection, *channels):
+    return subscribe_replies(connection, b'unsubscribe', channels, connection.channels, False)
+
+
+@command
+def psubscribe(server, connection, *patterns):
+    return subscribe_replies(connection, b'psubscribe', patterns, connection.patterns, True)
+
+
+@command
+def punsubscribe(server, connection, *patterns):
+    return subscribe_replies(connection, b'punsubscribe', patterns, connection.patterns, False)
+
+
+# Transactions
+
+
+@command
+def multi(server, connection):
+    if connection.transaction is not None:
+        raise CommandError('ERR MULTI calls can not be nested')
+    connection.transaction = []
+    return OK
+
+
+@command
+def exec_(server, connection):
+    if connection.transaction is None:
+        raise CommandError('ERR EXEC without MULTI')
+    commands, connection.transaction = connection.transaction, None
+    return [server.execute(connection, name, args) for name, args in commands]
+
+
+@command
+def discard(server, connection):
+    if connection.transaction is None:
+        raise CommandError('ERR DISCARD without MULTI')
+    connection.transaction = None
+    return OK
+
+
+def serve(port: int = 0, ready=None):
+    """
+    Run a server until the process is stopped.
+
+    :param ready: connection to send the port to when the server is listening.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = FakeRedisServer(port=port)
+    loop.run_until_complete(server.start())
+    if ready is not None:
+        ready.send(server.port)
+    loop.run_forever()
+
+
+def start_in_process(port: int = 0) -> Tuple[multiprocessing.Process, str]:
+    """
+    Run a server in a child process, so that it does not compete with the caller for the CPU.
+
+    :return: the process and the URL of the server.
+    """
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=serve, args=(port, sender), name='fake-redis', daemon=True)
+    process.start()
+    if not receiver.poll(10):
+        process.terminate()
+        raise RuntimeError('The fake Redis server did not start.')
+    return process, f'redis://127.0.0.1:{receiver.recv()}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run an in-memory Redis stand-in.')
+    parser.add_argument('--port', type=int, default=6379)
+    args = parser.parse_args()
+    serve(args.port)
+
+
+if __name__ == '__main__':
+    main()
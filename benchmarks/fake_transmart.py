@@ -0,0 +1,200 @@
+"""
+tranSMART stand-in for benchmarks, that serves a synthetic hypercube of configurable size.
+
+The hypercube is the CSR test data of the test suite, with the subjects copied as many times
+as configured, so that both the basic and the CSR export can transform it.
+
+Usage, to run the stand-ins of tranSMART and Keycloak for workers started separately::
+
+    python -m benchmarks.fake_transmart --scale 100 --latency 0.5
+"""
+import argparse
+import copy
+import gzip
+import json
+import os
+import threading
+import time
+from typing import List, Optional, Set
+
+from benchmarks.fake_http import FakeService
+from benchmarks.fake_keycloak import FakeKeycloak
+
+TEMPLATE_PATH = os.path.join(os.path.dirname(__file__), os.pardir, 'tests', 'csr_observations.json')
+
+
+def load_template() -> dict:
+    with open(TEMPLATE_PATH) as f:
+        return json.load(f)
+
+
+def copy_element(element, index: int, id_offset: int):
+    """ :return: the element of a subject dimension, with new ids for copy index. """
+    if index == 0:
+        return element
+    if isinstance(element, dict):  # patient
+        return dict(element, id=element['id'] + index * id_offset,
+                    subjectIds={name: f'{value}-{index}' for name, value in element['subjectIds'].items()})
+    return f'{element}-{index}'
+
+
+def scaled_hypercube(scale: int, template: dict = None) -> dict:
+    """
+    :param scale: number of copies of the subjects of the template.
+    :return: hypercube with the observations of the template for each copy of its subjects.
+    """
+    template = template or load_template()
+    elements = template['dimensionElements']
+    indexed = [declaration['name'] for declaration in template['dimensionDeclarations']
+               if not declaration.get('inline')]
+    copied = [declaration['name'] for declaration in template['dimensionDeclarations']
+              if declaration.get('dimensionType') == 'subject' and declaration['name'] in elements]
+    id_offset = max(patient['id'] for patient in elements['patient']) + 1
+
+    hypercube = dict(template, dimensionElements={name: list(values) if name not in copied else []
+                                                  for name, values in elements.items()}, cells=[])
+    for index in range(scale):
+        for name in copied:
+            hypercube['dimensionElements'][name].extend(
+                copy_element(element, index, id_offset) for element in elements[name])
+        for cell in template['cells']:
+            cell = copy.copy(cell)
+            cell['dimensionIndexes'] = [
+                position + index * len(elements[name]) if name in copied and position is not None else position
+                for name, position in zip(indexed, cell['dimensionIndexes'])]
+            hypercube['cells'].append(cell)
+    return hypercube
+
+
+def patient_set_ids(constraint) -> Optional[Set[int]]:
+    """ :return: the ids of the patient set in the constraint, e.g., of a fetch partition, if any. """
+    if isinstance(constraint, dict):
+        if constraint.get('type') == 'patient_set' and 'patientIds' in constraint:
+            return set(constraint['patientIds'])
+        for value in constraint.values():
+            ids = patient_set_ids(value)
+            if ids is not None:
+                return ids
+    elif isinstance(constraint, list):
+        for value in constraint:
+            ids = patient_set_ids(value)
+            if ids is not None:
+                return ids
+    return None
+
+
+class FakeTransmart(FakeService):
+    """
+    tranSMART API on a local HTTP port, that returns the same observations for every constraint,
+    except that a patient set in the constraint selects the observations of those patients.
+    """
+    name = 'fake-transmart'
+
+    def __init__(self, scale: int = 1, latency: float = 0.0):
+        """
+        :param scale: number of copies of the subjects of the test data.
+        :param latency: seconds to wait before responding, as for the database queries.
+        """
+        super().__init__()
+        self.latency = latency
+        self.hypercube = scaled_hypercube(scale)
+        indexed = [declaration['name'] for declaration in self.hypercube['dimensionDeclarations']
+                   if not declaration.get('inline')]
+        self.patient_position = indexed.index('patient')
+        self.concept_position = indexed.index('concept')
+        self.patients = self.hypercube['dimensionElements']['patient']
+        self.observations_body = json.dumps(self.hypercube).encode()
+        self.observations_gzip = gzip.compress(self.observations_body, compresslevel=1)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes_sent = 0
+
+    def record(self, size: int):
+        with self.lock:
+            self.requests += 1
+            self.bytes_sent += size
+
+    def handle(self, request, body: bytes, respond):
+        if not request.headers.get('Authorization', '').startswith('Bearer '):
+            return 401, {'error': 'unauthorized'}
+        if self.latency:
+            time.sleep(self.latency)
+        try:
+            query = json.loads(body or b'{}')
+        except ValueError:
+            return 400, {'error': 'invalid json'}
+        code, body, headers = respond(patient_set_ids(query.get('constraint')), request)
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.record(len(body))
+        return code, body, dict(headers, **{'Content-Type': 'application/json'})
+
+    def selected_cells(self, patient_ids: Optional[Set[int]]) -> List[dict]:
+        if patient_ids is None:
+            return self.hypercube['cells']
+        return [cell for cell in self.hypercube['cells']
+                if self.patients[cell['dimensionIndexes'][self.patient_position]]['id'] in patient_ids]
+
+    def observations(self, patient_ids, request):
+        gzip_accepted = 'gzip' in request.headers.get('Accept-Encoding', '')
+        if patient_ids is None:
+            body, compressed = self.observations_body, self.observations_gzip
+        else:
+            body = json.dumps(dict(self.hypercube, cells=self.selected_cells(patient_ids))).encode()
+            compressed = gzip.compress(body, compresslevel=1) if gzip_accepted else None
+        if gzip_accepted:
+            return 200, compressed, {'Content-Encoding': 'gzip'}
+        return 200, body, {}
+
+    def patients_response(self, patient_ids, request):
+        patients = [patient for patient in self.patients if patient_ids is None or patient['id'] in patient_ids]
+        return 200, {'patients': patients}, {}
+
+    def counts(self, patient_ids, request):
+        cells = self.selected_cells(patient_ids)
+        patients = {cell['dimensionIndexes'][self.patient_position] for cell in cells}
+        return 200, {'observationCount': len(cells), 'patientCount': len(patients)}, {}
+
+    def counts_per_concept(self, patient_ids, request):
+        concepts = self.hypercube['dimensionElements']['concept']
+        counts = {}
+        for cell in self.selected_cells(patient_ids):
+            code = concepts[cell['dimensionIndexes'][self.concept_position]]['conceptCode']
+            counts.setdefault(code, {'observationCount': 0, 'patientCount': None})['observationCount'] += 1
+        return 200, {'countsPerConcept': counts}, {}
+
+    def routes(self) -> dict:
+        def post(respond):
+            return lambda request, body: self.handle(request, body, respond)
+        return {
+            ('POST', '/v2/observations'): post(self.observations),
+            ('POST', '/v2/patients'): post(self.patients_response),
+            ('POST', '/v2/observations/counts'): post(self.counts),
+            ('POST', '/v2/observations/counts_per_concept'): post(self.counts_per_concept),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the tranSMART and Keycloak stand-ins.')
+    parser.add_argument('--scale', type=int, default=1, help='number of copies of the test subjects (default: 1)')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds before each response (default: 0)')
+    parser.add_argument('--port', type=int, default=0, help='port of tranSMART (default: a free port)')
+    parser.add_argument('--keycloak-port', type=int, default=0, help='port of Keycloak (default: a free port)')
+    args = parser.parse_args()
+    transmart = FakeTransmart(args.scale, args.latency).start(args.port)
+    keycloak = FakeKeycloak().start(args.keycloak_port)
+    print(f'{len(transmart.hypercube["cells"])} observations of {len(transmart.patients)} patients, '
+          f'{len(transmart.observations_body)} bytes.')
+    print(f'TRANSMART_URL={transmart.url}')
+    print(f'KEYCLOAK_SERVER_URL={keycloak.server_url}')
+    print(f'KEYCLOAK_REALM={keycloak.realm}')
+    print('KEYCLOAK_OFFLINE_TOKEN=benchmark')
+    print(f'Example user token: {keycloak.token("benchmark-user")}', flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
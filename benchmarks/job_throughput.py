@@ -0,0 +1,207 @@
+"""
+End-to-end throughput of export jobs, with the stand-ins of tranSMART and Keycloak.
+
+Starts the stand-ins, an API server and Celery workers, creates export jobs through the API,
+waits for them to finish and downloads their data, and reports the number of jobs per hour
+and the bytes per second fetched from tranSMART and downloaded from the API.
+
+The workers need a Redis server as broker, use a dedicated one (``--redis-url``): other workers
+connected to it would take the jobs, and the jobs and their statuses are left in it.
+
+Usage::
+
+    python -m benchmarks.job_throughput --job-type csr_export --jobs 20 --scale 50 --concurrency 4
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Optional
+
+from benchmarks.load_test import start_server, stop_server, summarize
+
+JOB_TYPES = ('basic_export', 'csr_export')
+FINAL_STATES = ('SUCCESS', 'FAILED', 'CANCELLED')
+STATUS_WAIT = 30  # seconds a status request waits for a change
+
+
+def start_workers(args, hostname: str) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, '-m', 'celery', '-A', 'packer.tasks', 'worker', '-Q', 'light,heavy',
+         '-c', str(args.concurrency), '-n', hostname, '--loglevel', args.log_level],
+        env=os.environ.copy())
+
+
+def wait_for_workers(hostname: str, process: subprocess.Popen, timeout: float = 60):
+    from packer.celery_app import app
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'The workers stopped with exit code {process.returncode}.')
+        if app.control.ping(destination=[hostname], timeout=1):
+            return
+    raise RuntimeError('The workers did not start.')
+
+
+class ThroughputRun:
+
+    def __init__(self, args, base_url: str, token: str):
+        self.args = args
+        self.base_url = base_url
+        self.headers = {'Authorization': f'Bearer {token}'}
+        self.jobs = []  # (final status, seconds from creation to final status, bytes downloaded)
+        self.errors = []
+
+    async def create(self, index: int) -> dict:
+        from tornado.httpclient import AsyncHTTPClient
+        # A different constraint per job, so that identical jobs are not coalesced.
+        body = {'job_type': self.args.job_type,
+                'job_parameters': {'constraint': {'type': 'study_name', 'studyId': f'BENCHMARK-{index}'}}}
+        response = await AsyncHTTPClient().fetch(f'{self.base_url}/jobs/create', method='POST',
+                                                 body=json.dumps(body), headers=self.headers)
+        return json.loads(response.body)
+
+    async def wait_until_finished(self, status: dict) -> dict:
+        from tornado.httpclient import AsyncHTTPClient
+        while status['status'] not in FINAL_STATES:
+            response = await AsyncHTTPClient().fetch(
+                f'{self.base_url}/jobs/status/{status["task_id"]}?wait={STATUS_WAIT}',
+                headers=dict(self.headers, **{'If-None-Match': f'"{status.get("version")}"'}),
+                request_timeout=STATUS_WAIT + 10, raise_error=False)
+            if response.code == 200:
+                status = json.loads(response.body)
+            elif response.code != 304:
+                raise RuntimeError(f'Status request failed with code {response.code}.')
+        return status
+
+    async def download(self, task_id: str) -> int:
+        from tornado.httpclient import AsyncHTTPClient
+        size = 0
+
+        def count(chunk):
+            nonlocal size
+            size += len(chunk)
+
+        await AsyncHTTPClient().fetch(f'{self.base_url}/jobs/data/{task_id}', headers=self.headers,
+                                      streaming_callback=count, request_timeout=self.args.timeout)
+        return size
+
+    async def job(self, index: int, slots: asyncio.Semaphore):
+        async with slots:
+            start = time.monotonic()
+            try:
+                status = await self.wait_until_finished(await self.create(index))
+                size = await self.download(status['task_id']) if status['status'] == 'SUCCESS' else 0
+            except Exception as e:
+                self.errors.append(str(e))
+                return
+            if status['status'] != 'SUCCESS':
+                self.errors.append(f'Job {status["task_id"]} {status["status"]}: {status.get("message")}')
+            self.jobs.append((status['status'], time.monotonic() - start, size))
+
+    async def run(self):
+        slots = asyncio.Semaphore(self.args.in_flight or self.args.jobs)
+        await asyncio.gather(*[self.job(index, slots) for index in range(self.args.jobs)])
+
+
+def report(run: ThroughputRun, seconds: float, transmart_bytes: int, tokens_issued: int) -> dict:
+    succeeded = [job for job in run.jobs if job[0] == 'SUCCESS']
+    downloaded = sum(job[2] for job in succeeded)
+    return dict(
+        jobs=len(run.jobs),
+        succeeded=len(succeeded),
+        errors=len(run.errors),
+        seconds=round(seconds, 2),
+        jobs_per_hour=round(len(succeeded) / seconds * 3600, 1),
+        transmart_bytes_per_second=round(transmart_bytes / seconds),
+        download_bytes_per_second=round(downloaded / seconds),
+        tokens_issued=tokens_issued,
+        job_duration=summarize([job[1] for job in succeeded]),
+    )
+
+
+def print_report(result: dict, out=sys.stdout):
+    duration = result['job_duration']
+    print(f'{result["succeeded"]} of {result["jobs"]} jobs succeeded in {result["seconds"]} s, '
+          f'{result["errors"]} errors', file=out)
+    print(f'Throughput: {result["jobs_per_hour"]} jobs/hour', file=out)
+    print(f'Fetched from tranSMART (compressed): {result["transmart_bytes_per_second"] / 2 ** 20:.2f} MiB/s, '
+          f'downloaded: {result["download_bytes_per_second"] / 2 ** 20:.2f} MiB/s', file=out)
+    print(f'Job duration: p50 {duration["p50_ms"]} ms, p99 {duration["p99_ms"]} ms, '
+          f'max {duration["max_ms"]} ms', file=out)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='End-to-end throughput of transmart-packer export jobs.')
+    parser.add_argument('--job-type', choices=JOB_TYPES, default='basic_export', help='(default: basic_export)')
+    parser.add_argument('--jobs', type=int, default=10, help='number of jobs (default: 10)')
+    parser.add_argument('--in-flight', type=int, default=0,
+                        help='maximum number of unfinished jobs, 0 to create all at once (default: 0)')
+    parser.add_argument('--scale', type=int, default=10,
+                        help='copies of the subjects of the test data in the hypercube (default: 10)')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds tranSMART waits before each response (default: 0)')
+    parser.add_argument('--concurrency', type=int, default=2,
+                        help='number of worker processes, 0 to use workers that are already running (default: 2)')
+    parser.add_argument('--redis-url', default=os.environ.get('REDIS_URL', 'redis://localhost:6379'),
+                        help='Redis server of the API server and the workers (default: REDIS_URL or localhost)')
+    parser.add_argument('--timeout', type=float, default=600, help='seconds before a download fails (default: 600)')
+    parser.add_argument('--json', help='file to write the results to, as JSON')
+    parser.add_argument('--log-level', default='WARNING', help='log level of the server and workers (default: WARNING)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    logging.basicConfig(level=args.log_level)
+    from benchmarks.fake_keycloak import FakeKeycloak
+    from benchmarks.fake_transmart import FakeTransmart
+
+    transmart = FakeTransmart(args.scale, args.latency).start()
+    keycloak = FakeKeycloak().start()
+    data_dir = tempfile.TemporaryDirectory(prefix='packer-throughput-')
+    # The configuration is read from the environment when the packer modules are imported,
+    # by this process, the API server and the workers.
+    os.environ.update(REDIS_URL=args.redis_url, TRANSMART_URL=transmart.url,
+                      KEYCLOAK_SERVER_URL=keycloak.server_url, KEYCLOAK_REALM=keycloak.realm,
+                      KEYCLOAK_CLIENT_ID=keycloak.client_id, KEYCLOAK_OFFLINE_TOKEN='benchmark',
+                      DATA_DIR=data_dir.name + '/')
+    hostname = f'benchmark-{os.getpid()}@localhost'
+    workers: Optional[subprocess.Popen] = None
+    server_process = control = None
+    try:
+        if args.concurrency:
+            workers = start_workers(args, hostname)
+            wait_for_workers(hostname, workers)
+        server_process, control, base_url = start_server(fake_dispatch=False)
+        run = ThroughputRun(args, base_url, keycloak.token('benchmark-user'))
+        start = time.monotonic()
+        asyncio.get_event_loop().run_until_complete(run.run())
+        seconds = time.monotonic() - start
+    finally:
+        if server_process is not None:
+            stop_server(server_process, control)
+        if workers is not None:
+            workers.terminate()
+            workers.wait(60)
+        transmart.stop()
+        keycloak.stop()
+        data_dir.cleanup()
+
+    result = dict(report(run, seconds, transmart.bytes_sent, keycloak.tokens_issued), config=vars(args))
+    print_report(result)
+    for error in run.errors[:10]:
+        print(f'ERROR: {error}', file=sys.stderr)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+    return 1 if run.errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
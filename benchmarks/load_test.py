@@ -0,0 +1,430 @@
+"""
+Load test of the API server, without tranSMART, Keycloak, Redis or Celery workers.
+
+The server runs in a child process against a Redis stand-in (or a real Redis server), with
+tokens signed by a fake Keycloak realm. Jobs are not sent to Celery: the dispatch is replaced by
+a push to a Redis list, from which a fake worker publishes the status updates of the jobs.
+Concurrent clients request the endpoints and websocket clients receive the status updates,
+for a fixed duration, after which throughput, latency and IOLoop lag of the server are reported.
+
+Usage::
+
+    python -m benchmarks.load_test --clients 20 --websockets 50 --duration 10
+"""
+import argparse
+import asyncio
+import heapq
+import json
+import logging
+import math
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+SCENARIOS = ('list', 'status', 'create', 'data')
+DISPATCH_QUEUE = 'benchmark:dispatched'
+LAG_INTERVAL = 0.01  # seconds between IOLoop lag samples
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    """ :return: the nearest-rank percentile of the values, None if there are none. """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+def summarize(latencies: List[float]) -> dict:
+    """ :return: median, 99th percentile and maximum of latencies in seconds, in milliseconds. """
+    def ms(value):
+        return None if value is None else round(value * 1000, 3)
+    return {'p50_ms': ms(percentile(latencies, 0.5)), 'p99_ms': ms(percentile(latencies, 0.99)),
+            'max_ms': ms(max(latencies) if latencies else None)}
+
+
+def reader_user(index: int) -> str:
+    return f'benchmark-reader-{index}'
+
+
+def writer_user(index: int) -> str:
+    return f'benchmark-writer-{index}'
+
+
+def seed(args) -> Dict[str, dict]:
+    """
+    Store finished jobs for the reader users, with a data file for one job per user.
+
+    :return: the ids of a job and of a job with data, by user.
+    """
+    from packer.file_handling import FSHandler
+    from packer.redis_client import redis
+    from packer.task_status import Status, TaskStatus
+
+    data = os.urandom(args.data_size)
+    jobs = {}
+    for index in range(args.users):
+        user = reader_user(index)
+        task_ids = [str(uuid.uuid4()) for _ in range(args.jobs_per_user)]
+        for task_id in task_ids:
+            TaskStatus(task_id).create(job_type='add', job_parameters={'x': 1, 'y': 2}, status=Status.SUCCESS,
+                                       user=user, message='Seeded by the load test.')
+        redis.sadd(f'jobs:{user}', *task_ids)
+        with FSHandler(task_ids[0]).writer as f:
+            f.write(data)
+        jobs[user] = {'task_id': task_ids[-1], 'data_task_id': task_ids[0]}
+    return jobs
+
+
+def run_server(sockets, control, fake_dispatch=True):
+    """
+    Run the API server in the child process, until the parent asks for the IOLoop lag samples.
+
+    :param control: connection to the parent, that sends ``start`` to start sampling and ``stop``.
+    :param fake_dispatch: whether to push jobs to the list of the fake worker instead of sending them to Celery.
+    """
+    import tornado.ioloop
+    from packer import jobs
+    from packer.config import tornado_config
+    from packer.main import make_web_app
+
+    web_app, loop = make_web_app(None, dict(tornado_config, debug=False, autoreload=False), sockets)
+
+    def dispatch(job_spec, kwargs, task_id, **options):
+        """ Stands in for sending the task to the Celery queue of its resource class. """
+        message = json.dumps({'task_id': task_id, 'job_type': job_spec.name})
+        asyncio.ensure_future(web_app.redis.lpush(DISPATCH_QUEUE, message))
+
+    if fake_dispatch:
+        jobs.JobSpec.apply_async = dispatch
+
+    samples = []
+    sampling = False
+
+    async def sample_lag():
+        asyncio_loop = asyncio.get_event_loop()
+        while True:
+            start = asyncio_loop.time()
+            await asyncio.sleep(LAG_INTERVAL)
+            if sampling:
+                samples.append(max(asyncio_loop.time() - start - LAG_INTERVAL, 0.0))
+
+    def on_control(fd, events):
+        nonlocal sampling
+        command = control.recv()
+        if command == 'start':
+            samples.clear()
+            sampling = True
+        elif command == 'stop':
+            control.send(samples)
+            loop.stop()
+
+    loop.add_handler(control.fileno(), on_control, tornado.ioloop.IOLoop.READ)
+    loop.asyncio_loop.create_task(sample_lag())
+    control.send('ready')
+    loop.start()
+
+
+def start_server(fake_dispatch=True):
+    """
+    Start the API server in a child process, on a free port.
+
+    :return: the process, the connection to control it and the URL of the server.
+    """
+    from tornado.netutil import bind_sockets
+    sockets = bind_sockets(0, '127.0.0.1')
+    control, child_control = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=run_server, args=(sockets, child_control, fake_dispatch),
+                                      name='packer-server')
+    process.start()
+    port = sockets[0].getsockname()[1]
+    for sock in sockets:
+        sock.close()
+    if not control.poll(30) or control.recv() != 'ready':
+        process.terminate()
+        raise RuntimeError('The API server did not start.')
+    return process, control, f'http://127.0.0.1:{port}'
+
+
+def stop_server(process, control) -> List[float]:
+    """ :return: the IOLoop lag samples of the server since sampling started. """
+    samples = []
+    if process.is_alive():
+        control.send('stop')
+        samples = control.recv() if control.poll(30) else []
+    process.join(10)
+    if process.is_alive():
+        process.terminate()
+    return samples
+
+
+class FakeWorker(threading.Thread):
+    """
+    Takes the dispatched jobs from the Redis list and publishes their status updates, as a worker
+    would: running when the job is received, successful after the configured duration.
+    Events carry the time they were published as ``sent_at``, to measure the delivery latency.
+    """
+
+    def __init__(self, job_seconds: float):
+        super().__init__(name='fake-worker', daemon=True)
+        self.job_seconds = job_seconds
+        self.running = []  # heap of (finish time, task id, user)
+        self.stopped = threading.Event()
+
+    def publish(self, task_id: str, user: str, status: str, message: str):
+        from packer.task_status import TaskStatus
+        task_status = TaskStatus(task_id)
+        task_status.update(status=status, message=message)
+        task_status.publish(user, {'task_id': task_id, 'status': status, 'message': message,
+                                   'sent_at': time.time()})
+
+    def run(self):
+        from packer.redis_client import redis
+        from packer.task_status import Status, TaskStatus
+        while not self.stopped.is_set():
+            while self.running and self.running[0][0] <= time.time():
+                _, task_id, user = heapq.heappop(self.running)
+                self.publish(task_id, user, Status.SUCCESS, 'Done.')
+            timeout = min(self.running[0][0] - time.time(), 1) if self.running else 1
+            item = redis.brpop(DISPATCH_QUEUE, timeout=max(timeout, 0.01))
+            if item is None:
+                continue
+            task_id = json.loads(item[1])['task_id']
+            user = TaskStatus(task_id).get().get('user')
+            self.publish(task_id, user, Status.RUNNING, 'Running.')
+            heapq.heappush(self.running, (time.time() + self.job_seconds, task_id, user))
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class LoadTest:
+
+    def __init__(self, args, base_url: str, tokens: Dict[str, str], seeded: Dict[str, dict]):
+        self.args = args
+        self.base_url = base_url
+        self.ws_url = 'ws' + base_url[len('http'):]
+        self.tokens = tokens
+        self.seeded = seeded
+        self.measure_from = None
+        self.deadline = None
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.bytes = 0
+        self.ws_latencies = []
+        self.ws_messages = 0
+        self.ws_errors = 0
+        self.sequence = 0
+
+    def headers(self, user: str) -> dict:
+        return {'Authorization': f'Bearer {self.tokens[user]}'}
+
+    def request(self, scenario: str, index: int):
+        from tornado.httpclient import HTTPRequest
+        if scenario == 'create':
+            user = writer_user(index % self.args.users)
+            self.sequence += 1
+            body = json.dumps({'job_type': 'add', 'job_parameters': {'x': self.sequence, 'y': index}})
+            return HTTPRequest(f'{self.base_url}/jobs/create', method='POST', body=body, headers=self.headers(user))
+        user = reader_user(index % self.args.users)
+        if scenario == 'list':
+            return HTTPRequest(f'{self.base_url}/jobs', headers=self.headers(user))
+        if scenario == 'status':
+            return HTTPRequest(f'{self.base_url}/jobs/status/{self.seeded[user]["task_id"]}',
+                               headers=self.headers(user))
+
+        def count_bytes(chunk):
+            self.bytes += len(chunk) if self.measuring() else 0
+
+        return HTTPRequest(f'{self.base_url}/jobs/data/{self.seeded[user]["data_task_id"]}',
+                           headers=self.headers(user), streaming_callback=count_bytes,
+                           request_timeout=self.args.timeout)
+
+    def measuring(self) -> bool:
+        return time.monotonic() >= self.measure_from
+
+    async def client(self, scenario: str, index: int):
+        from tornado.httpclient import AsyncHTTPClient
+        http_client = AsyncHTTPClient()
+        while time.monotonic() < self.deadline:
+            start = time.monotonic()
+            try:
+                response = await http_client.fetch(self.request(scenario, index), raise_error=False)
+                failed = response.code >= 400
+            except Exception:
+                failed = True
+            if start >= self.measure_from:
+                self.latencies[scenario].append(time.monotonic() - start)
+                self.errors[scenario] += failed
+
+    async def websocket(self, index: int):
+        from tornado.httpclient import HTTPRequest
+        from tornado.websocket import websocket_connect
+        user = writer_user(index % self.args.users)
+        try:
+            connection = await websocket_connect(HTTPRequest(
+                f'{self.ws_url}/jobs/subscribe', headers=self.headers(user)))
+        except Exception:
+            self.ws_errors += 1
+            return
+        while time.monotonic() < self.deadline:
+            try:
+                message = await asyncio.wait_for(connection.read_message(), self.deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                break
+            if message is None:
+                self.ws_errors += 1
+                break
+            received_at = time.time()
+            try:
+                event = json.loads(message)
+            except ValueError:
+                continue  # the greeting
+            if isinstance(event, dict) and 'sent_at' in event and self.measuring():
+                self.ws_messages += 1
+                self.ws_latencies.append(received_at - event['sent_at'])
+        connection.close()
+
+    async def run(self, on_measure_start):
+        start = time.monotonic()
+        self.measure_from = start + self.args.warmup
+        self.deadline = self.measure_from + self.args.duration
+        asyncio.get_event_loop().call_later(self.args.warmup, on_measure_start)
+        tasks = [self.websocket(index) for index in range(self.args.websockets)]
+        tasks += [self.client(scenario, index) for scenario in self.args.scenarios
+                  for index in range(self.args.clients)]
+        await asyncio.gather(*tasks)
+
+    def report(self) -> dict:
+        duration = self.args.duration
+        http = {}
+        for scenario in self.args.scenarios:
+            latencies = self.latencies[scenario]
+            http[scenario] = dict(requests=len(latencies), errors=self.errors[scenario],
+                                  throughput=round(len(latencies) / duration, 1), **summarize(latencies))
+        if 'data' in http:
+            http['data']['megabytes_per_second'] = round(self.bytes / duration / 2 ** 20, 1)
+        return {
+            'http': http,
+            'websocket': dict(connections=self.args.websockets, errors=self.ws_errors, messages=self.ws_messages,
+                              throughput=round(self.ws_messages / duration, 1), **summarize(self.ws_latencies)),
+        }
+
+
+def print_report(result: dict, out=sys.stdout):
+    columns = ('requests', 'errors', 'throughput', 'p50_ms', 'p99_ms', 'max_ms')
+    print(f'{"":<10}' + ''.join(f'{column:>12}' for column in columns), file=out)
+    rows = dict(result['http'], websocket=dict(result['websocket'], requests=result['websocket']['messages']))
+    for name, row in rows.items():
+        print(f'{name:<10}' + ''.join(f'{"-" if row.get(column) is None else row[column]:>12}'
+                                      for column in columns), file=out)
+    lag = result['loop_lag']
+    print(f'IOLoop lag: p50 {lag["p50_ms"]} ms, p99 {lag["p99_ms"]} ms, max {lag["max_ms"]} ms', file=out)
+    if 'data' in result['http']:
+        print(f'Data: {result["http"]["data"]["megabytes_per_second"]} MiB/s', file=out)
+
+
+def check_limits(result: dict, args) -> List[str]:
+    """ :return: the limits the result exceeds. """
+    failures = []
+    for name, row in dict(result['http'], websocket=result['websocket']).items():
+        count = row.get('requests', row.get('messages')) or 0
+        if row['errors'] > args.max_error_rate * max(count, 1):
+            failures.append(f'{name}: {row["errors"]} errors')
+        if args.max_p99 is not None and name != 'websocket' and (row['p99_ms'] or 0) > args.max_p99:
+            failures.append(f'{name}: p99 latency {row["p99_ms"]} ms > {args.max_p99} ms')
+    if args.max_loop_lag is not None and (result['loop_lag']['p99_ms'] or 0) > args.max_loop_lag:
+        failures.append(f'IOLoop lag p99 {result["loop_lag"]["p99_ms"]} ms > {args.max_loop_lag} ms')
+    return failures
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Load test of the transmart-packer API server.')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f'comma separated endpoints to request: {", ".join(SCENARIOS)} (default: all)')
+    parser.add_argument('--clients', type=int, default=10, help='concurrent clients per scenario (default: 10)')
+    parser.add_argument('--websockets', type=int, default=10, help='websocket clients (default: 10)')
+    parser.add_argument('--users', type=int, default=10, help='users the clients are spread over (default: 10)')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to measure (default: 10)')
+    parser.add_argument('--warmup', type=float, default=2, help='seconds of load before measuring (default: 2)')
+    parser.add_argument('--jobs-per-user', type=int, default=20, help='jobs listed per user (default: 20)')
+    parser.add_argument('--data-size', type=int, default=2 ** 20,
+                        help='size in bytes of the downloaded job data (default: 1 MiB)')
+    parser.add_argument('--job-seconds', type=float, default=0.5,
+                        help='seconds the fake worker takes per job (default: 0.5)')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds before a request fails (default: 60)')
+    parser.add_argument('--redis-url', help='Redis server to use instead of the in-memory stand-in; '
+                                            'its database gets the keys of the benchmark users')
+    parser.add_argument('--json', help='file to write the results to, as JSON')
+    parser.add_argument('--max-p99', type=float, help='fail if the p99 latency of a scenario exceeds this (ms)')
+    parser.add_argument('--max-loop-lag', type=float, help='fail if the p99 IOLoop lag exceeds this (ms)')
+    parser.add_argument('--max-error-rate', type=float, default=0.0,
+                        help='fail if the fraction of failed requests exceeds this (default: 0)')
+    parser.add_argument('--log-level', default='WARNING', help='log level of the server (default: WARNING)')
+    args = parser.parse_args(argv)
+    args.scenarios = [scenario for scenario in args.scenarios.split(',') if scenario]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'unknown scenarios: {", ".join(sorted(unknown))}')
+    return args
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    logging.basicConfig(level=args.log_level)
+    from benchmarks import fake_redis
+    from benchmarks.fake_keycloak import FakeKeycloak
+
+    redis_process = None
+    redis_url = args.redis_url
+    if redis_url is None:
+        redis_process, redis_url = fake_redis.start_in_process()
+    keycloak = FakeKeycloak().start()
+    data_dir = tempfile.TemporaryDirectory(prefix='packer-load-test-')
+    # The configuration is read from the environment when the packer modules are imported.
+    os.environ.update(REDIS_URL=redis_url, KEYCLOAK_SERVER_URL=keycloak.server_url, KEYCLOAK_REALM=keycloak.realm,
+                      KEYCLOAK_CLIENT_ID=keycloak.client_id, DATA_DIR=data_dir.name + '/')
+    if args.redis_url is None:
+        # The stand-in does not run Lua scripts.
+        os.environ.update(MAX_RUNNING_JOBS='0', MAX_RUNNING_JOBS_PER_USER='0')
+
+    seeded = seed(args)
+    server_process, control, base_url = start_server()
+    worker = FakeWorker(args.job_seconds)
+    lag_samples = []
+    try:
+        worker.start()
+        from tornado.httpclient import AsyncHTTPClient
+        AsyncHTTPClient.configure(None, max_clients=args.clients * len(args.scenarios) + 1)
+        users = [reader_user(index) for index in range(args.users)] + \
+                [writer_user(index) for index in range(args.users)]
+        load_test = LoadTest(args, base_url, {user: keycloak.token(user) for user in users}, seeded)
+        asyncio.get_event_loop().run_until_complete(load_test.run(lambda: control.send('start')))
+    finally:
+        lag_samples = stop_server(server_process, control)
+        worker.stop()
+        keycloak.stop()
+        if redis_process is not None:
+            redis_process.terminate()
+        data_dir.cleanup()
+
+    result = dict(load_test.report(), loop_lag=summarize(lag_samples), config={
+        name: value for name, value in vars(args).items() if name not in ('json', 'log_level')})
+    print_report(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+    failures = check_limits(result, args)
+    for failure in failures:
+        print(f'FAILED: {failure}', file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,268 @@
+import logging
+import time
+from typing import List, Optional, Tuple
+
+from packer.config import admission_config
+from packer.jobs import registry
+from packer.routing import route_options
+from packer.task_status import TaskStatus, TaskStatusAsync, get_statuses
+
+logger = logging.getLogger(__name__)
+
+RUNNING_KEY = 'admission:running'
+RUNNING_PREFIX = 'admission:running:'
+PENDING_PREFIX = 'admission:pending:'
+USERS_KEY = 'admission:users'
+
+# Admit the task if the user has no pending tasks and there are free slots,
+# otherwise append it to the pending tasks of the user.
+# Returns 0 if the task is admitted, the approximate queue position otherwise.
+ADMIT_SCRIPT = """
+local expired = tonumber(ARGV[5]) - tonumber(ARGV[6])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', expired)
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', expired)
+local user_limit = tonumber(ARGV[3])
+local global_limit = tonumber(ARGV[4])
+if redis.call('LLEN', KEYS[3]) == 0
+        and (global_limit == 0 or redis.call('ZCARD', KEYS[1]) < global_limit)
+        and (user_limit == 0 or redis.call('ZCARD', KEYS[2]) < user_limit) then
+    redis.call('ZADD', KEYS[1], ARGV[5], ARGV[1])
+    redis.call('ZADD', KEYS[2], ARGV[5], ARGV[1])
+    return 0
+end
+local position = redis.call('RPUSH', KEYS[3], ARGV[1])
+if position == 1 then
+    redis.call('RPUSH', KEYS[4], ARGV[2])
+end
+local total = position
+for _, user in ipairs(redis.call('LRANGE', KEYS[4], 0, -1)) do
+    if user ~= ARGV[2] then
+        total = total + math.min(redis.call('LLEN', ARGV[7] .. user), position)
+    end
+end
+return total
+"""
+
+# Admit the first pending task of the next user in the round-robin that has a free slot.
+# Returns the task id and the user, or nil if no task can be admitted.
+NEXT_SCRIPT = """
+local now = tonumber(ARGV[3])
+local expired = now - tonumber(ARGV[4])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', expired)
+local user_limit = tonumber(ARGV[1])
+local global_limit = tonumber(ARGV[2])
+if global_limit > 0 and redis.call('ZCARD', KEYS[1]) >= global_limit then
+    return false
+end
+for _ = 1, redis.call('LLEN', KEYS[2]) do
+    local user = redis.call('LPOP', KEYS[2])
+    local running_key = ARGV[6] .. user
+    local pending_key = ARGV[5] .. user
+    redis.call('ZREMRANGEBYSCORE', running_key, '-inf', expired)
+    if user_limit == 0 or redis.call('ZCARD', running_key) < user_limit then
+        local task_id = redis.call('LPOP', pending_key)
+        if redis.call('LLEN', pending_key) > 0 then
+            redis.call('RPUSH', KEYS[2], user)
+        end
+        if task_id then
+            redis.call('ZADD', KEYS[1], now, task_id)
+            redis.call('ZADD', running_key, now, task_id)
+            return {task_id, user}
+        end
+    else
+        redis.call('RPUSH', KEYS[2], user)
+    end
+end
+return false
+"""
+
+# Remove a pending task. Returns the number of removed tasks.
+REMOVE_SCRIPT = """
+local removed = redis.call('LREM', KEYS[1], 0, ARGV[1])
+if redis.call('LLEN', KEYS[1]) == 0 then
+    redis.call('LREM', KEYS[2], 0, ARGV[2])
+end
+return removed
+"""
+
+
+def enabled() -> bool:
+    """ Admission control is enabled if a per-user or global limit is configured. """
+    return admission_config['user_limit'] > 0 or admission_config['global_limit'] > 0
+
+
+def admit_keys(user: str) -> list:
+    return [RUNNING_KEY, RUNNING_PREFIX + user, PENDING_PREFIX + user, USERS_KEY]
+
+
+def admit_args(task_id: str, user: str) -> list:
+    return [task_id, user, admission_config['user_limit'], admission_config['global_limit'],
+            time.time(), admission_config['slot_ttl'], PENDING_PREFIX]
+
+
+def next_args() -> list:
+    return [admission_config['user_limit'], admission_config['global_limit'],
+            time.time(), admission_config['slot_ttl'], PENDING_PREFIX, RUNNING_PREFIX]
+
+
+class AdmissionController:
+    """
+    Limits the number of running jobs per user and in total. Jobs over the limits are held
+    in a pending list per user, users with pending jobs take turns when a slot is released.
+    Slots of jobs that never release them expire after the slot ttl.
+    """
+
+    def __init__(self, redis):
+        self.redis = redis
+
+    def admit(self, task_id: str, user: str) -> int:
+        """
+        :return: 0 if the task can start, its position in the pending queue otherwise.
+        """
+        if not enabled():
+            return 0
+        return self.redis.eval(ADMIT_SCRIPT, 4, *admit_keys(user), *admit_args(task_id, user))
+
+    def release(self, task_id: str, user: str):
+        """ Release the slot of a finished task. Releasing a slot twice has no effect. """
+        if not enabled():
+            return
+        pipe = self.redis.pipeline()
+        pipe.zrem(RUNNING_KEY, task_id)
+        pipe.zrem(RUNNING_PREFIX + user, task_id)
+        pipe.execute()
+
+    def admit_next(self) -> Optional[Tuple[str, str]]:
+        """
+        :return: task id and user of the pending task that was admitted, None if no task can start.
+        """
+        if not enabled():
+            return None
+        admitted = self.redis.eval(NEXT_SCRIPT, 2, RUNNING_KEY, USERS_KEY, *next_args())
+        return tuple(admitted) if admitted else None
+
+    def remove(self, task_id: str, user: str) -> bool:
+        """ Remove a pending task, returns if the task was pending. """
+        if not enabled():
+            return False
+        return self.redis.eval(REMOVE_SCRIPT, 2, PENDING_PREFIX + user, USERS_KEY, task_id, user) > 0
+
+    def pending_order(self) -> List[str]:
+        """ :return: ids of the pending tasks, in the order they will be admitted. """
+        users = self.redis.lrange(USERS_KEY, 0, -1)
+        pipe = self.redis.pipeline()
+        for user in users:
+            pipe.lrange(PENDING_PREFIX + user, 0, -1)
+        return round_robin(pipe.execute())
+
+
+class AdmissionControllerAsync:
+
+    def __init__(self, redis_loop):
+        self.redis = redis_loop
+
+    async def admit(self, task_id: str, user: str) -> int:
+        if not enabled():
+            return 0
+        return await self.redis.eval(ADMIT_SCRIPT, keys=admit_keys(user), args=admit_args(task_id, user))
+
+    async def release(self, task_id: str, user: str):
+        if not enabled():
+            return
+        pipe = self.redis.pipeline()
+        pipe.zrem(RUNNING_KEY, task_id)
+        pipe.zrem(RUNNING_PREFIX + user, task_id)
+        await pipe.execute()
+
+    async def admit_next(self) -> Optional[Tuple[str, str]]:
+        if not enabled():
+            return None
+        admitted = await self.redis.eval(NEXT_SCRIPT, keys=[RUNNING_KEY, USERS_KEY], args=next_args())
+        return tuple(admitted) if admitted else None
+
+    async def remove(self, task_id: str, user: str) -> bool:
+        if not enabled():
+            return False
+        removed = await self.redis.eval(REMOVE_SCRIPT, keys=[PENDING_PREFIX + user, USERS_KEY],
+                                        args=[task_id, user])
+        return removed > 0
+
+    async def pending_order(self) -> List[str]:
+        users = await self.redis.lrange(USERS_KEY, 0, -1)
+        pipe = self.redis.pipeline()
+        for user in users:
+            pipe.lrange(PENDING_PREFIX + user, 0, -1)
+        return round_robin(await pipe.execute())
+
+
+def round_robin(queues: List[List[str]]) -> List[str]:
+    """ :return: the task ids of the pending queues of the users, in the order they will be admitted. """
+    order = []
+    for i in range(max((len(queue) for queue in queues), default=0)):
+        order.extend(queue[i] for queue in queues if i < len(queue))
+    return order
+
+
+def queue_message(position: int) -> str:
+    return f'Waiting for other jobs to finish (queue position {position}).'
+
+
+def update_pending_status(task_id: str, message: str, queue_position: Optional[int]) -> dict:
+    task_status = TaskStatus(task_id)
+    status = task_status.update(message=message, queue_position=queue_position)
+    task_status.publish(status['user'], {
+        'task_id': task_id,
+        'status': status['status'],
+        'message': message,
+        'progress': status.get('progress'),
+        'queue_position': queue_position
+    })
+    return status
+
+
+def admit_pending(controller: AdmissionController):
+    """
+    Start the pending jobs for which slots are free, and update the queue positions of the others.
+    """
+    while True:
+        admitted = controller.admit_next()
+        if admitted is None:
+            break
+        task_id, _ = admitted
+        start_job(task_id, update_pending_status(task_id, 'Task admitted.', None))
+    for position, task_id in enumerate(controller.pending_order(), 1):
+        if TaskStatus(task_id).get().get('queue_position') != position:
+            update_pending_status(task_id, queue_message(position), position)
+
+
+async def admit_pending_async(controller: AdmissionControllerAsync):
+    """
+    Start the pending jobs for which slots are free, and update the queue positions of the others,
+    from the API server.
+    """
+    if not enabled():
+        return
+    while True:
+        admitted = await controller.admit_next()
+        if admitted is None:
+            break
+        task_id, _ = admitted
+        task_status = TaskStatusAsync(task_id, controller.redis)
+        start_job(task_id, await task_status.update_and_publish(message='Task admitted.', queue_position=None))
+    order = await controller.pending_order()
+    for position, (task_id, status) in enumerate(zip(order, await get_statuses(controller.redis, order)), 1):
+        if status is not None and status.get('queue_position') != position:
+            await TaskStatusAsync(task_id, controller.redis).update_and_publish(message=queue_message(position),
+                                                                                queue_position=position)
+
+
+def start_job(task_id: str, status: dict):
+    """
+    Send an admitted job to the workers.
+
+    :param task_id: id of the task.
+    :param status: status of the task, with the job type and parameters.
+    """
+    logger.info(f'Starting admitted task: {task_id}')
+    registry[status['job_type']].apply_async(kwargs=status['job_parameters'], task_id=task_id,
+                                             **route_options(status.get('resource_class')))
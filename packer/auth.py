@@ -1,19 +1,140 @@
-import functools
+import hashlib
 import json
 import logging
-from typing import Mapping, Dict
+import threading
+import time
+from collections import OrderedDict
+from typing import Mapping, Dict, Optional, Tuple, Any, Callable
 
 import jwt
-import requests
 from jwt.algorithms import RSAAlgorithm
 from tornado.log import app_log as log
 from tornado.web import HTTPError
 
-from .config import keycloak_config, http_config
+from . import http_client
+from .config import keycloak_config
 
 logger = logging.getLogger(__name__)
 
 
+class VerifiedTokenCache:
+    """
+    Bounded cache of the claims of tokens that have been verified, keyed by token hash.
+    Entries expire with the token (``exp`` claim), and after max_age seconds at the latest.
+    """
+
+    def __init__(self, max_size: int, max_age: float):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _key(token: str) -> str:
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def get(self, token: str) -> Optional[Mapping]:
+        key = self._key(token)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, claims = entry
+            if expires_at <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return claims
+
+    def put(self, token: str, claims: Mapping):
+        if self.max_size <= 0:
+            return
+        expires_at = time.time() + self.max_age
+        if 'exp' in claims:
+            expires_at = min(expires_at, claims['exp'])
+        with self.lock:
+            self.entries[self._key(token)] = (expires_at, claims)
+            self.entries.move_to_end(self._key(token))
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class JwksKeyStore:
+    """
+    Public keys of the Keycloak realm by kid. All keys are loaded together, and refreshed
+    in the background when they are older than ttl seconds. A token with an unknown kid
+    triggers a refetch, at most once per min_refresh_interval seconds. After a failed
+    background refresh, the next one is started min_refresh_interval seconds later at the earliest.
+    """
+
+    def __init__(self, ttl: float, min_refresh_interval: float):
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.keys = None
+        self.loaded_at = 0.0
+        self.fetched_at = 0.0
+        self.failed_at = 0.0
+        self.refreshing = False
+        self.lock = threading.Lock()
+
+    def get(self, token_kid) -> Tuple[str, Any]:
+        """
+        :param token_kid: Token kid
+        :return: Algorithm and public_key pair
+        """
+        if self.keys is None:
+            self.refresh()
+        elif time.time() - self.loaded_at > self.ttl:
+            self.refresh_in_background()
+        key = self.keys.get(token_kid)
+        if key is None and time.time() - self.fetched_at >= self.min_refresh_interval:
+            log.info(f'Unknown kid={token_kid}, refreshing public keys.')
+            self.refresh()
+            key = self.keys.get(token_kid)
+        if key is None:
+            error = "No public key found for kid {}".format(token_kid)
+            logger.error(error)
+            raise ValueError(error)
+        return key
+
+    def refresh(self):
+        self.fetched_at = time.time()
+        try:
+            keys = fetch_keycloak_public_keys()
+        except Exception:
+            self.failed_at = time.time()
+            raise
+        self.keys, self.loaded_at = keys, time.time()
+
+    def refresh_in_background(self):
+        with self.lock:
+            if self.refreshing or time.time() - self.failed_at < self.min_refresh_interval:
+                return
+            self.refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f'Could not refresh public keys: {e}')
+            finally:
+                self.refreshing = False
+
+        threading.Thread(target=run, name='jwks-refresh', daemon=True).start()
+
+    def clear(self):
+        self.keys = None
+        self.loaded_at = self.fetched_at = self.failed_at = 0.0
+
+
+verified_tokens = VerifiedTokenCache(keycloak_config['token_cache_size'], keycloak_config['token_cache_max_age'])
+public_keys = JwksKeyStore(keycloak_config['jwks_ttl'], keycloak_config['jwks_min_refresh_interval'])
+
+
 def authorize(token: str) -> Mapping:
     """
     Validate the token to authorize the access
@@ -24,23 +145,34 @@ def authorize(token: str) -> Mapping:
         error_msg = 'No authorisation token found in the request'
         logger.error(error_msg)
         raise HTTPError(401, 'Unauthorized.')
+    user_token = verified_tokens.get(token)
+    if user_token is not None:
+        return user_token
     decoded_token_header = jwt.get_unverified_header(token)
     token_kid = decoded_token_header.get('kid')
     algorithm, public_key = get_keycloak_public_key_and_algorithm(token_kid)
     user_token = jwt.decode(token, public_key, algorithms=algorithm, audience=keycloak_config.get("client_id"))
+    verified_tokens.put(token, user_token)
     return user_token
 
 
-@functools.lru_cache(maxsize=2)
 def get_keycloak_public_key_and_algorithm(token_kid):
     """
     Get Keycloak public key and token signing algorithm
     :param token_kid: Token kid
     :return: Algorithm and public_key pair
     """
+    return public_keys.get(token_kid)
+
+
+def fetch_keycloak_public_keys() -> Dict[str, Tuple[str, Any]]:
+    """
+    Get all Keycloak public keys and their token signing algorithms
+    :return: Algorithm and public_key pairs by kid
+    """
     handle = f'{keycloak_config.get("oidc_server_url")}/protocol/openid-connect/certs'
-    log.info(f'Getting public key for the kid={token_kid} from the keycloak...')
-    r = requests.get(handle, verify=http_config.get('verify_cert'))
+    log.info('Getting public keys from the keycloak...')
+    r = http_client.get(handle)
     if not r.ok:
         error = "Could not get certificates from Keycloak. " \
                 "Reason: [{}]: {}".format(r.status_code, r.text)
@@ -53,40 +185,118 @@ def get_keycloak_public_key_and_algorithm(token_kid):
                 "Got unexpected response: '{}'".format(r.text)
         logging.error(error)
         raise ValueError(error)
-    try:
-        matching_key = next((item for item in json_response.get('keys') if item['kid'] == token_kid), None)
-        if matching_key is None:
-            error = "No public key found for kid {}".format(token_kid)
+    keys = {}
+    for item in json_response.get('keys') or []:
+        if item.get('use', 'sig') != 'sig':
+            continue
+        try:
+            keys[item['kid']] = item.get('alg'), RSAAlgorithm.from_jwk(json.dumps(item))
+        except Exception as e:
+            error = f'Invalid public key!. Reason: {e}'
             logger.error(error)
-            raise ValueError(error)
-        matching_key_json = json.dumps(matching_key)
-        public_key = RSAAlgorithm.from_jwk(matching_key_json)
-    except Exception as e:
-        error = f'Invalid public key!. Reason: {e}'
-        logger.error(error)
-        raise ValueError(error)
-    logger.info(f'The public key for the kid={token_kid} has been fetched.')
-    return matching_key.get('alg'), public_key
+    logger.info(f'The public keys for the kids {", ".join(keys.keys())} have been fetched.')
+    return keys
+
+
+class AccessTokenCache:
+    """
+    Access tokens obtained from Keycloak, with their expiry time. A cached token is used
+    until refresh_margin seconds before it expires, then a new token is fetched.
+    At most max_size tokens are kept, the least recently used are dropped first.
+    """
+
+    def __init__(self, max_size: int, refresh_margin: float):
+        self.max_size = max_size
+        self.refresh_margin = refresh_margin
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # Held while a token is fetched, so that tokens of other keys can be fetched at the same time.
+        self.key_locks = {}
+
+    def cached(self, key: str) -> Optional[str]:
+        """ :return: the cached token, if it is not about to expire. """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] - self.refresh_margin > time.time():
+                self.entries.move_to_end(key)
+                return entry[0]
+            return None
+
+    def get(self, key: str, fetch: Callable[[], Tuple[str, float]]) -> str:
+        """
+        :param key: cache key of the token.
+        :param fetch: function that fetches a new token, returns the token and its expiry time.
+        :return: access token.
+        """
+        token = self.cached(key)
+        if token is not None:
+            return token
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            # Another thread may have fetched the token in the meantime.
+            token = self.cached(key)
+            if token is not None:
+                return token
+            token, expires_at = fetch()
+            with self.lock:
+                self.entries[key] = (token, expires_at)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_size:
+                    evicted, _ = self.entries.popitem(last=False)
+                    self.key_locks.pop(evicted, None)
+            return token
+
+    def invalidate(self, key: str):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.key_locks.clear()
+
+
+access_tokens = AccessTokenCache(keycloak_config['access_token_cache_size'], keycloak_config['token_refresh_margin'])
 
 
 def get_impersonated_token_for_user(current_user: str) -> str:
     """
-    Exchange offline token for (impersonated) current task user’s token
+    Exchange offline token for (impersonated) current task user’s token.
+    The token is cached until shortly before it expires.
     :param current_user: current task user
     :return: task user's access token
     """
+    return access_tokens.get(f'user:{current_user}', lambda: fetch_impersonated_token_for_user(current_user))
+
+
+def invalidate_impersonated_token_for_user(current_user: str):
+    """
+    Forget the cached token of the user, e.g., when it has been rejected.
+    :param current_user: current task user
+    """
+    access_tokens.invalidate(f'user:{current_user}')
+
+
+def fetch_impersonated_token_for_user(current_user: str) -> Tuple[str, float]:
+    """
+    Exchange offline token for (impersonated) current task user’s token
+    :param current_user: current task user
+    :return: task user's access token and its expiry time
+    """
     offline_user_access_token = get_access_token_by_offline_token()
     handle = f'{keycloak_config.get("oidc_server_url")}/protocol/openid-connect/token'
     params = {'grant_type': 'urn:ietf:params:oauth:grant-type:token-exchange',
               'requested_subject': current_user,
               'client_id': f'{keycloak_config.get("client_id")}',
               'subject_token': offline_user_access_token}
-    return get_access_token(handle, params)
+    return get_access_token_and_expiry(handle, params)
 
 
 def get_access_token_by_offline_token() -> str:
     """
-    Get access token based on offline token
+    Get access token based on offline token.
+    The token is cached until shortly before it expires.
     :return: offline user's access token
     """
     handle = f'{keycloak_config.get("oidc_server_url")}/protocol/openid-connect/token'
@@ -94,7 +304,7 @@ def get_access_token_by_offline_token() -> str:
               'scope': 'offline_access',
               'client_id': f'{keycloak_config.get("client_id")}',
               'refresh_token': f'{keycloak_config.get("offline_token")}'}
-    return get_access_token(handle, params)
+    return access_tokens.get('offline', lambda: get_access_token_and_expiry(handle, params))
 
 
 def get_access_token(url: str, params: Dict) -> str:
@@ -104,7 +314,19 @@ def get_access_token(url: str, params: Dict) -> str:
     :param params: Request body params
     :return: access token
     """
-    response = requests.post(url=url, data=params, verify=http_config.get('verify_cert'))
+    token, _ = get_access_token_and_expiry(url, params)
+    return token
+
+
+def get_access_token_and_expiry(url: str, params: Dict) -> Tuple[str, float]:
+    """
+    Get access token from Keycloak
+    :param url: Keycloak server URL
+    :param params: Request body params
+    :return: access token and the time it expires
+    """
+    requested_at = time.time()
+    response = http_client.post(url=url, data=params)
     if not response.ok:
         error = "Could not get a token from Keycloak. " \
                 "Reason: [{}]: {}".format(response.status_code, response.text)
@@ -112,10 +334,16 @@ def get_access_token(url: str, params: Dict) -> str:
         raise ValueError(error)
     try:
         json_response = response.json()
-        return json_response['access_token']
+        token = json_response['access_token']
     except Exception:
         error = "Could not retrieve the access token. " \
                 "Got unexpected response: '{}'".format(response.text)
         logger.error(error)
         raise ValueError(error)
-
+    if 'expires_in' in json_response:
+        return token, requested_at + float(json_response['expires_in'])
+    try:
+        return token, float(jwt.decode(token, options={'verify_signature': False})['exp'])
+    except Exception:
+        # Unknown expiry, do not reuse the token.
+        return token, requested_at
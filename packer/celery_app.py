@@ -0,0 +1,8 @@
+from celery import Celery
+
+from packer.jobs import task_modules
+from .config import redis_config, celery_config
+
+# The job modules are imported by the workers only, the web server sends jobs by task name.
+app = Celery('tasks', broker=redis_config['url'], include=task_modules())
+app.conf.update(**celery_config)
@@ -0,0 +1,56 @@
+import hashlib
+import json
+
+from packer.config import task_config
+
+# Delete the in-flight key only if it still refers to the task, a newer job may have claimed it.
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# Replace the in-flight key if it still refers to the finished task, or has expired,
+# unless another request has claimed it in the meantime.
+REPLACE_SCRIPT = """
+local current = redis.call('GET', KEYS[1])
+if current == false or current == ARGV[1] then
+    redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+    return 1
+end
+return 0
+"""
+
+
+def fingerprint(job_type: str, job_parameters: dict) -> str:
+    """
+    :return: fingerprint of a job, that is the same for jobs with equal type and parameters,
+    independent of the order of the parameters.
+    """
+    job = json.dumps({'job_type': job_type, 'job_parameters': job_parameters},
+                     sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(job.encode('utf-8')).hexdigest()
+
+
+def inflight_key(user: str, job_fingerprint: str) -> str:
+    """ Id of the running job of a user with the fingerprint. """
+    return f'inflight:{user}:{job_fingerprint}'
+
+
+def inflight_ttl() -> int:
+    return task_config['inflight_ttl']
+
+
+def release(redis, user: str, job_fingerprint: str, task_id: str):
+    """ Remove the in-flight job of a user, if it is the task. """
+    redis.eval(RELEASE_SCRIPT, 1, inflight_key(user, job_fingerprint), task_id)
+
+
+async def replace_async(redis, key: str, finished_task_id: str, task_id: str) -> bool:
+    """ Claim an in-flight key of which the job has finished without releasing it. """
+    return bool(await redis.eval(REPLACE_SCRIPT, keys=[key], args=[finished_task_id or '', task_id, inflight_ttl()]))
+
+
+async def release_async(redis, user: str, job_fingerprint: str, task_id: str):
+    await redis.eval(RELEASE_SCRIPT, keys=[inflight_key(user, job_fingerprint)], args=[task_id])
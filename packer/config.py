@@ -14,10 +14,21 @@ tornado_config = dict(
     port=8999
 )
 
+server_config = dict(
+    processes=int(os.environ.get('TORNADO_PROCESSES', 1)),
+    shutdown_timeout=float(os.environ.get('SHUTDOWN_TIMEOUT', 30))
+)
+
 keycloak_config = dict(
     oidc_server_url='{}/realms/{}'.format(os.environ.get('KEYCLOAK_SERVER_URL'), os.environ.get('KEYCLOAK_REALM')),
     client_id=os.environ.get('KEYCLOAK_CLIENT_ID', 'transmart-client'),
-    offline_token=os.environ.get('KEYCLOAK_OFFLINE_TOKEN')
+    offline_token=os.environ.get('KEYCLOAK_OFFLINE_TOKEN'),
+    token_cache_size=int(os.environ.get('TOKEN_CACHE_SIZE', 10000)),
+    token_cache_max_age=float(os.environ.get('TOKEN_CACHE_MAX_AGE', 300)),
+    jwks_ttl=float(os.environ.get('JWKS_TTL', 3600)),
+    jwks_min_refresh_interval=float(os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30)),
+    access_token_cache_size=int(os.environ.get('ACCESS_TOKEN_CACHE_SIZE', 1000)),
+    token_refresh_margin=float(os.environ.get('TOKEN_REFRESH_MARGIN', 30))
 )
 
 transmart_config = dict(
@@ -25,11 +36,25 @@ transmart_config = dict(
 )
 
 http_config = dict(
-    verify_cert=read_verify_cert(os.environ.get('VERIFY_CERT'))
+    verify_cert=read_verify_cert(os.environ.get('VERIFY_CERT')),
+    connect_timeout=float(os.environ.get('HTTP_CONNECT_TIMEOUT', 10)),
+    read_timeout=float(os.environ.get('HTTP_READ_TIMEOUT', 600)),
+    pool_connections=int(os.environ.get('HTTP_POOL_CONNECTIONS', 4)),
+    pool_maxsize=int(os.environ.get('HTTP_POOL_MAXSIZE', 10))
 )
 
 app_config = dict(
-    host=os.environ.get('CLIENT_ORIGIN_URL', '*')
+    host=os.environ.get('CLIENT_ORIGIN_URL', '*'),
+    status_max_wait=float(os.environ.get('STATUS_MAX_WAIT', 60)),
+    batch_max_jobs=int(os.environ.get('BATCH_MAX_JOBS', 1000))
+)
+
+metrics_config = dict(
+    flush_interval=float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+)
+
+websocket_config = dict(
+    batch_window=float(os.environ.get('WEBSOCKET_BATCH_WINDOW', 0.1))
 )
 
 redis_config = dict(
@@ -37,10 +62,63 @@ redis_config = dict(
 )
 
 task_config = dict(
-    data_dir=os.environ.get('DATA_DIR', '/tmp/packer/')
+    data_dir=os.environ.get('DATA_DIR', '/tmp/packer/'),
+    progress_interval=float(os.environ.get('PROGRESS_INTERVAL', 1.0)),
+    events_max_len=int(os.environ.get('STATUS_EVENTS_MAX_LEN', 1000)),
+    events_ttl=int(os.environ.get('STATUS_EVENTS_TTL', 24 * 60 * 60)),
+    inflight_ttl=int(os.environ.get('INFLIGHT_TTL', 12 * 60 * 60)),
+    result_cache_ttl=int(os.environ.get('RESULT_CACHE_TTL', 0)),
+    work_dir_ttl=int(os.environ.get('WORK_DIR_TTL', 24 * 60 * 60)),
+    memory_check_interval=float(os.environ.get('MEMORY_CHECK_INTERVAL', 1.0)),
+    memory_abort_delay=float(os.environ.get('MEMORY_ABORT_DELAY', 10.0)),
+    worker_warmup=os.environ.get('WORKER_WARMUP', 'true').lower() == 'true'
+)
+
+admission_config = dict(
+    user_limit=int(os.environ.get('MAX_RUNNING_JOBS_PER_USER', 0)),
+    global_limit=int(os.environ.get('MAX_RUNNING_JOBS', 0)),
+    slot_ttl=int(os.environ.get('ADMISSION_SLOT_TTL', 12 * 60 * 60)),
+    sweep_interval=float(os.environ.get('ADMISSION_SWEEP_INTERVAL', 60))
+)
+
+estimate_config = dict(
+    enabled=os.environ.get('ESTIMATE_JOB_SIZE', 'false').lower() == 'true',
+    timeout=float(os.environ.get('ESTIMATE_TIMEOUT', 30)),
+    bytes_per_observation=int(os.environ.get('ESTIMATE_BYTES_PER_OBSERVATION', 2000)),
+    max_observations=int(os.environ.get('MAX_EXPORT_OBSERVATIONS', 0))
+)
+
+fetch_config = dict(
+    partition_size=int(os.environ.get('FETCH_PARTITION_SIZE', 0)),
+    max_concurrency=int(os.environ.get('FETCH_MAX_CONCURRENCY', 4))
+)
+
+resource_class_config = dict(
+    light=dict(
+        queue='light',
+        concurrency=int(os.environ.get('LIGHT_WORKER_CONCURRENCY', 4)),
+        prefetch_multiplier=int(os.environ.get('LIGHT_WORKER_PREFETCH', 4)),
+        acks_late=False,
+        memory_budget=int(os.environ.get('LIGHT_WORKER_MEMORY_MB', 512))
+    ),
+    heavy=dict(
+        queue='heavy',
+        concurrency=int(os.environ.get('HEAVY_WORKER_CONCURRENCY', 2)),
+        prefetch_multiplier=int(os.environ.get('HEAVY_WORKER_PREFETCH', 1)),
+        acks_late=True,
+        memory_budget=int(os.environ.get('HEAVY_WORKER_MEMORY_MB', 4096))
+    )
 )
 
 celery_config = dict(
+    task_routes=('packer.routing.route_task',),
+    task_default_queue='light',
+    # Unacknowledged (acks_late) tasks are redelivered after this many seconds, longer than any job runs.
+    broker_transport_options=dict(visibility_timeout=int(os.environ.get('VISIBILITY_TIMEOUT', 12 * 60 * 60))),
+    # Replace worker processes that have exceeded the largest memory budget (in KiB) after a task,
+    # workers of a single resource class use the budget of their class. A process in which a task
+    # exceeded its own budget is replaced anyway, see packer.tasks.recycle_worker_process.
+    worker_max_memory_per_child=max(c['memory_budget'] for c in resource_class_config.values()) * 1024,
     task_serializer='json',
     accept_content=['json'],  # Ignore other content
     result_serializer='json',
@@ -0,0 +1,89 @@
+import json
+import logging
+from typing import Optional
+
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+
+from packer.config import estimate_config, http_config, resource_class_config, transmart_config
+
+logger = logging.getLogger(__name__)
+
+
+class JobTooLarge(Exception):
+    """ Raised if the estimated size of a job exceeds the configured limits. """
+
+
+def enabled() -> bool:
+    return estimate_config['enabled'] and bool(transmart_config.get('host'))
+
+
+async def transmart_post(path: str, body: dict, token: str) -> dict:
+    verify_cert = http_config['verify_cert']
+    request = HTTPRequest(
+        f'{transmart_config.get("host")}{path}',
+        method='POST',
+        body=json.dumps(body),
+        headers={
+            'Authorization': f'Bearer {token}',
+            'Content-Type': 'application/json',
+            'Accept': 'application/json'
+        },
+        connect_timeout=http_config['connect_timeout'],
+        request_timeout=estimate_config['timeout'],
+        validate_cert=bool(verify_cert),
+        ca_certs=verify_cert if isinstance(verify_cert, str) else None
+    )
+    response = await AsyncHTTPClient().fetch(request)
+    return json.loads(response.body)
+
+
+async def estimate(constraint: dict, token: str) -> dict:
+    """
+    Estimate the size of an export with count queries, that are much cheaper than fetching the observations.
+
+    :param constraint: transmart API constraint of the export.
+    :param token: access token of the user, the counts respect the permissions of the user.
+    :return: estimated number of observations, rows (subjects), columns (concepts) and memory in MiB.
+    """
+    counts = await transmart_post('/v2/observations/counts', {'constraint': constraint}, token)
+    concepts = await transmart_post('/v2/observations/counts_per_concept', {'constraint': constraint}, token)
+    observations = counts.get('observationCount', 0)
+    return {
+        'observations': observations,
+        'rows': counts.get('patientCount', 0),
+        'columns': len(concepts.get('countsPerConcept', {})),
+        'memory_mb': round(observations * estimate_config['bytes_per_observation'] / 2 ** 20, 1)
+    }
+
+
+def select_resource_class(job_estimate: dict) -> str:
+    """
+    :return: the smallest resource class with a memory budget that fits the estimated memory use.
+    :raises JobTooLarge: if the job exceeds the limits or does not fit any resource class.
+    """
+    max_observations = estimate_config['max_observations']
+    if max_observations and job_estimate['observations'] > max_observations:
+        raise JobTooLarge(f'The export has an estimated {job_estimate["observations"]} observations, '
+                          f'the maximum is {max_observations}.')
+    classes = sorted(resource_class_config.items(), key=lambda item: item[1]['memory_budget'])
+    for name, resource_class in classes:
+        if job_estimate['memory_mb'] <= resource_class['memory_budget']:
+            return name
+    raise JobTooLarge(f'The export needs an estimated {job_estimate["memory_mb"]} MiB of memory, '
+                      f'the maximum is {classes[-1][1]["memory_budget"]} MiB.')
+
+
+async def estimate_job(job_parameters: dict, token: str) -> Optional[dict]:
+    """
+    Estimate the size of an export job, if the job has a constraint.
+
+    :return: the estimate, or None if the job cannot be estimated.
+    """
+    constraint = job_parameters.get('constraint')
+    if not enabled() or not isinstance(constraint, dict):
+        return None
+    try:
+        return await estimate(constraint, token)
+    except Exception as e:
+        logger.warning(f'Could not estimate the size of the job: {e}')
+        return None
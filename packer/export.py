@@ -1,26 +1,57 @@
 import csv
+import io
 import pandas as pd
 import logging
+from typing import Callable, Dict, Optional
 
 from packer.file_handling import FSHandler
 from zipfile import ZipFile
 
 logger = logging.getLogger(__name__)
 
+EXPORT_CHUNK_ROWS = 10000  # number of rows written to the export file at once
 
-def save(export_df: pd.DataFrame, task_id: str, file_name: str, sep: str = '\t'):
+
+def save(export_df: pd.DataFrame, task_id: str, file_name: str, sep: str = '\t',
+         on_rows_written: Optional[Callable[[int, int], None]] = None):
     """
     Writes dataframe including it's index columns to a file
     :param task_id: id of the task that indicates name of zip archive to store file to
     :param export_df: dataframe to write to file. Index columns are included.
     :param file_name: name of the file to export data to
     :param sep: separator in CSV file. Tab by default.
+    :param on_rows_written: optional callback, called with the number of rows written so far
+    and the total number of rows after each chunk of rows.
+    """
+    save_all({file_name: export_df}, task_id, sep, on_rows_written)
+
+
+def save_all(exports: Dict[str, pd.DataFrame], task_id: str, sep: str = '\t',
+             on_rows_written: Optional[Callable[[int, int], None]] = None):
+    """
+    Writes dataframes including their index columns to files in one zip archive
+    :param exports: dataframes to write by file name
+    :param task_id: id of the task that indicates name of zip archive to store the files to
+    :param sep: separator in CSV files. Tab by default.
+    :param on_rows_written: optional callback, called with the number of rows written so far
+    and the total number of rows of all dataframes after each chunk of rows.
     """
     fs_handler = FSHandler(task_id)
     logger.info(f'Writing {fs_handler.path} file.')
+    rows_total = sum(len(export_df) for export_df in exports.values())
+    rows_done = 0
     with fs_handler.writer as writer:
         with ZipFile(writer, 'w') as data_zip:
-            data_zip.writestr(f'{file_name}.tsv',
-                              export_df.reset_index().to_csv(encoding='utf-8', sep=sep, index=False,
-                                                             quoting=csv.QUOTE_NONNUMERIC, quotechar='"'))
+            for file_name, export_df in exports.items():
+                export_df = export_df.reset_index()
+                rows = len(export_df)
+                with data_zip.open(f'{file_name}.tsv', 'w') as entry:
+                    with io.TextIOWrapper(entry, encoding='utf-8', newline='') as text_entry:
+                        for start in range(0, max(rows, 1), EXPORT_CHUNK_ROWS):
+                            export_df.iloc[start:start + EXPORT_CHUNK_ROWS].to_csv(
+                                text_entry, sep=sep, index=False, header=start == 0,
+                                quoting=csv.QUOTE_NONNUMERIC, quotechar='"')
+                            if on_rows_written is not None:
+                                on_rows_written(rows_done + min(start + EXPORT_CHUNK_ROWS, rows), rows_total)
+                rows_done += rows
     logger.info(f'{fs_handler.path} file has been saved on disk.')
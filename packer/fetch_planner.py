@@ -0,0 +1,27 @@
+from typing import List, Sequence
+
+
+def patient_set_constraint(patient_ids: Sequence[int]) -> dict:
+    """
+    :param patient_ids: ids of the patients.
+    :return: transmart API constraint that selects the patients.
+    """
+    return {'type': 'patient_set', 'patientIds': list(patient_ids)}
+
+
+def plan_partitions(constraint: dict, patient_ids: Sequence[int], partition_size: int) -> List[dict]:
+    """
+    Split a constraint into disjoint constraints for batches of patients,
+    that together select the same observations.
+
+    :param constraint: transmart API constraint to split.
+    :param patient_ids: ids of the patients that have observations for the constraint.
+    :param partition_size: maximum number of patients per partition.
+    :return: the constraint itself if it does not have to be split, the partition constraints otherwise.
+    """
+    if partition_size <= 0 or len(patient_ids) <= partition_size:
+        return [constraint]
+    return [
+        {'type': 'and', 'args': [constraint, patient_set_constraint(patient_ids[i:i + partition_size])]}
+        for i in range(0, len(patient_ids), partition_size)
+    ]
@@ -0,0 +1,46 @@
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .config import fetch_config, http_config
+
+_lock = threading.Lock()
+_session = None
+_session_pid = None
+
+
+def get_session() -> requests.Session:
+    """
+    HTTP session of the current process, that keeps a pool of keep-alive connections to tranSMART
+    and Keycloak. The session is shared by the threads of the process, e.g., of the partition fetch pool,
+    the pools hold at least one connection per fetch thread. A new session is created in a forked process,
+    connections are never shared between processes.
+    """
+    global _session, _session_pid
+    with _lock:
+        if _session is None or _session_pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=http_config['pool_connections'],
+                                  pool_maxsize=max(http_config['pool_maxsize'], fetch_config['max_concurrency']))
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.verify = http_config.get('verify_cert')
+            session.headers['Accept-Encoding'] = 'gzip, deflate'
+            _session, _session_pid = session, os.getpid()
+        return _session
+
+
+def get_timeout():
+    return http_config['connect_timeout'], http_config['read_timeout']
+
+
+def get(url, **kwargs) -> requests.Response:
+    kwargs.setdefault('timeout', get_timeout())
+    return get_session().get(url, **kwargs)
+
+
+def post(url, **kwargs) -> requests.Response:
+    kwargs.setdefault('timeout', get_timeout())
+    return get_session().post(url, **kwargs)
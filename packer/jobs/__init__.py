@@ -1,9 +1,99 @@
-from .csr_export import csr_export
-from .example import add
-from .basic_export import basic_export
-
-registry = {
-    'add': add,
-    'basic_export': basic_export,
-    'csr_export': csr_export
-}
+"""
+Registry of the available jobs.
+
+The jobs are declared with their parameters and resource class, so that the web server can check
+and dispatch jobs by name, without importing the job modules and their dependencies (pandas, transmart).
+The tasks of the jobs are imported by the workers only.
+"""
+import importlib
+from typing import Callable, Mapping, Sequence
+
+from packer.jobs.checks import check_outputs
+from packer.routing import DEFAULT_RESOURCE_CLASS, route_options
+
+
+class JobSpec:
+    """
+    Declaration of a job, that has to match the Celery task of the job.
+    """
+
+    def __init__(self, name: str, module: str, parameters: Sequence[str] = (),
+                 optional_parameters: Sequence[str] = (), extra_parameters: bool = False,
+                 resource_class: str = DEFAULT_RESOURCE_CLASS, checks: Mapping[str, Callable] = None):
+        """
+        :param name: name of the job and of the task function.
+        :param module: module that defines the task.
+        :param parameters: names of the required job parameters.
+        :param optional_parameters: names of the job parameters that have a default value.
+        :param extra_parameters: whether the task accepts other job parameters (**params).
+        :param resource_class: resource class the task is declared with.
+        :param checks: functions that check the values of job parameters by name,
+        and raise ValueError if a value is not valid.
+        """
+        self.name = name
+        self.module = module
+        self.parameters = tuple(parameters)
+        self.optional_parameters = tuple(optional_parameters)
+        self.extra_parameters = extra_parameters
+        self.resource_class = resource_class
+        self.checks = dict(checks or {})
+
+    @property
+    def task_name(self) -> str:
+        return f'{self.module}.{self.name}'
+
+    def check_parameters(self, job_parameters: dict):
+        """
+        :raises TypeError: if required parameters are missing or unexpected parameters are given,
+        as the task would when it is called.
+        :raises ValueError: if the value of a parameter is not valid.
+        """
+        missing = [parameter for parameter in self.parameters if parameter not in job_parameters]
+        if missing:
+            raise TypeError(f'{self.name}() missing required parameters: {", ".join(missing)}')
+        if not self.extra_parameters:
+            known = self.parameters + self.optional_parameters
+            unexpected = [parameter for parameter in job_parameters if parameter not in known]
+            if unexpected:
+                raise TypeError(f'{self.name}() got unexpected parameters: {", ".join(unexpected)}')
+        for parameter, check in self.checks.items():
+            if parameter in job_parameters:
+                try:
+                    check(job_parameters[parameter])
+                except ValueError as e:
+                    raise ValueError(f'{self.name}() invalid {parameter}: {e}')
+
+    def apply_async(self, kwargs: dict, task_id: str, **options):
+        """
+        Send the job to the workers by task name, to the queue of its resource class unless another
+        queue is given.
+        """
+        from packer.celery_app import app
+        return app.send_task(self.task_name, kwargs=kwargs, task_id=task_id,
+                             **{**route_options(self.resource_class), **options})
+
+    def load(self):
+        """ :return: the Celery task of the job, importing its module. """
+        return getattr(importlib.import_module(self.module), self.name)
+
+
+registry = {spec.name: spec for spec in [
+    JobSpec('add', 'packer.jobs.example', parameters=('x', 'y'), optional_parameters=('sleep',)),
+    JobSpec('basic_export', 'packer.jobs.basic_export', parameters=('constraint',), extra_parameters=True),
+    JobSpec('csr_export', 'packer.jobs.csr_export', parameters=('constraint',), extra_parameters=True,
+            resource_class='heavy'),
+    JobSpec('multi_export', 'packer.jobs.multi_export', parameters=('constraint', 'outputs'),
+            extra_parameters=True, resource_class='heavy', checks={'outputs': check_outputs}),
+]}
+
+
+def task_modules() -> list:
+    """ :return: the modules that define the tasks of the jobs, for the workers to import. """
+    return sorted({spec.module for spec in registry.values()})
+
+
+def __getattr__(name):
+    """ Tasks of the jobs, e.g., ``from packer.jobs import add``, are imported on first use. """
+    if name in registry:
+        return registry[name].load()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
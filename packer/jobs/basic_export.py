@@ -2,11 +2,6 @@ import logging
 
 from packer.export import save
 
-try:
-    from transmart.api.v2.data_structures import ObservationSet
-except ImportError as e:
-    logging.warning(f'Import errors for {__file__!r}: {str(e)}')
-
 from packer.task_status import Status
 from ..tasks import BaseDataTask, app
 
@@ -23,15 +18,12 @@ def basic_export(self: BaseDataTask, constraint, **params):
     :param params: optional job parameters:
         - custom_name: name of the job and export file
     """
-    obs_json = self.observations_json(constraint)
-    self.update_status(Status.RUNNING, 'Observations gotten, transforming.')
-
     if 'custom_name' in params:
         custom_name = params['custom_name']
     else:
         logger.debug(f'No custom name supplied. Use task id as such {self.task_id}.')
         custom_name = self.task_id
 
+    obs_df = self.checkpoint('observations', lambda: self.observations_dataframe(constraint, (0.0, 0.7)))
     self.update_status(Status.RUNNING, 'Writing export to disk.')
-    obs_df = ObservationSet(obs_json).dataframe
-    save(obs_df, self.task_id, custom_name)
+    save(obs_df, self.task_id, custom_name, on_rows_written=self.rows_written_callback((0.7, 1.0)))
@@ -0,0 +1,25 @@
+"""
+Checks of job parameter values, that the web server runs before a job is created.
+Like the registry, this module does not import the dependencies of the jobs.
+"""
+
+MULTI_EXPORT_OUTPUT_TYPES = ('basic', 'csr')
+
+
+def check_outputs(outputs) -> None:
+    """
+    :param outputs: output specifications of a multi export job.
+    :raises ValueError: if the specifications are not valid.
+    """
+    if not isinstance(outputs, list) or not outputs:
+        raise ValueError('Expected a non-empty list of outputs.')
+    names = set()
+    for output in outputs:
+        if not isinstance(output, dict) or output.get('type') not in MULTI_EXPORT_OUTPUT_TYPES:
+            raise ValueError(f'Expected outputs with a type, one of: {", ".join(MULTI_EXPORT_OUTPUT_TYPES)}.')
+        if 'row_filter' in output and output['type'] != 'csr':
+            raise ValueError('A row filter is only supported for csr outputs.')
+        name = output.get('name', output['type'])
+        if name in names:
+            raise ValueError(f'Duplicate output name: {name!r}.')
+        names.add(name)
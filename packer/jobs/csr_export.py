@@ -1,6 +1,6 @@
 import logging
 
-from ..table_transformations.csr_transformations import from_obs_json_to_export_csr_df
+from ..table_transformations.csr_transformations import transform_obs_df
 from ..table_transformations.utils import filter_rows
 
 from packer.task_status import Status
@@ -10,7 +10,7 @@ from ..export import save
 logger = logging.getLogger(__name__)
 
 
-@app.task(bind=True, base=BaseDataTask)
+@app.task(bind=True, base=BaseDataTask, resource_class='heavy')
 def csr_export(self: BaseDataTask, constraint, **params):
     """
     Reformat hypercube data into a specific export file.
@@ -22,16 +22,23 @@ def csr_export(self: BaseDataTask, constraint, **params):
         - row_filter: constraint to filter rows
         - custom_name: name of the job and export file
     """
-    obs_json = self.observations_json(constraint)
-    self.update_status(Status.RUNNING, 'Observations gotten, transforming.')
-    export_df = from_obs_json_to_export_csr_df(obs_json)
+    def get_export_df():
+        obs_df = self.observations_dataframe(constraint, fraction_range=(0.0, 0.45))
+        self.update_status(Status.RUNNING, 'Observations gotten, transforming.')
+        return transform_obs_df(obs_df, on_step=self.check_cancelled)
+
+    export_df = self.checkpoint('csr_export', get_export_df)
+    self.update_progress(fraction=0.6)
     if 'row_filter' in params:
-        self.update_status(Status.RUNNING, 'Observations for the row filter gotten, transforming.')
-        row_filter_constraint = params['row_filter']
-        row_filter_obs_json = self.observations_json(row_filter_constraint)
-        row_export_df = from_obs_json_to_export_csr_df(row_filter_obs_json)
+        def get_row_export_df():
+            row_filter_obs_df = self.observations_dataframe(params['row_filter'], fraction_range=(0.6, 0.75))
+            self.update_status(Status.RUNNING, 'Observations for the row filter gotten, transforming.')
+            return transform_obs_df(row_filter_obs_df, on_step=self.check_cancelled)
+
+        row_export_df = self.checkpoint('csr_row_filter', get_row_export_df)
         self.update_status(Status.RUNNING, 'Removing extra rows based on the row filter.')
         export_df = filter_rows(export_df, row_export_df)
+        self.update_progress(fraction=0.8)
 
     if 'custom_name' in params:
         custom_name = params['custom_name']
@@ -39,5 +46,5 @@ def csr_export(self: BaseDataTask, constraint, **params):
         logger.debug(f'No custom name supplied. Use task id as such {self.task_id}.')
         custom_name = self.task_id
     self.update_status(Status.RUNNING, 'Writing export to disk.')
-    save(export_df, self.task_id, custom_name)
-
+    write_start = 0.8 if 'row_filter' in params else 0.6
+    save(export_df, self.task_id, custom_name, on_rows_written=self.rows_written_callback((write_start, 1.0)))
@@ -29,6 +29,8 @@ def add(self: BaseDataTask, x: int, y: int, sleep: int = 10) -> None:
     if sleep:
         for i in range(sleep, 0, -1):
             msg = f'Task will be ready in {i} seconds'
+            self.check_cancelled(force=True)
+            self.progress.update(fraction=(sleep - i) / sleep)
             self.update_status(Status.RUNNING, msg)
             time.sleep(1)
 
@@ -0,0 +1,61 @@
+import logging
+
+from ..table_transformations.csr_transformations import transform_obs_df
+from ..table_transformations.utils import filter_rows
+
+from packer.task_status import Status
+from ..tasks import BaseDataTask, app
+from ..export import save_all
+from .checks import check_outputs
+
+logger = logging.getLogger(__name__)
+
+
+@app.task(bind=True, base=BaseDataTask, resource_class='heavy')
+def multi_export(self: BaseDataTask, constraint, outputs, **params):
+    """
+    Export the observations of one constraint in several formats. The observations are fetched
+    and decoded once, all outputs are written to the same archive.
+
+    :param self: Required for bind to BaseDataTask
+    :param constraint: mandatory transmart api constraint to get data for.
+    :param outputs: list of outputs, each with:
+        - type: basic or csr
+        - name (optional): name of the export file, the type by default
+        - row_filter (optional, csr only): constraint to filter rows
+    :param params: optional job parameters:
+        - custom_name: name of the job, and prefix of the names of the export files
+    """
+    check_outputs(outputs)
+    obs_df = self.checkpoint('observations', lambda: self.observations_dataframe(constraint, (0.0, 0.4)))
+    self.update_status(Status.RUNNING, 'Observations gotten, transforming.')
+
+    csr_outputs = [output for output in outputs if output['type'] == 'csr']
+    csr_df = None
+    if csr_outputs:
+        # The transformation changes the observations dataframe, the basic outputs need the original.
+        csr_df = self.checkpoint('csr_export', lambda: transform_obs_df(obs_df.copy(), on_step=self.check_cancelled))
+        self.update_progress(fraction=0.5)
+
+    row_filters = [output['row_filter'] for output in csr_outputs if 'row_filter' in output]
+    exports = {}
+    for output in outputs:
+        name = output.get('name', output['type'])
+        file_name = f'{params["custom_name"]}_{name}' if params.get('custom_name') else name
+        if output['type'] == 'basic':
+            exports[file_name] = obs_df
+        elif 'row_filter' in output:
+            index = row_filters.index(output['row_filter'])
+            fraction_range = (0.5 + 0.2 * index / len(row_filters), 0.5 + 0.2 * (index + 1) / len(row_filters))
+
+            def get_row_export_df():
+                row_filter_obs_df = self.observations_dataframe(output['row_filter'], fraction_range)
+                return transform_obs_df(row_filter_obs_df, on_step=self.check_cancelled)
+
+            self.update_status(Status.RUNNING, f'Removing extra rows of {name!r} based on the row filter.')
+            exports[file_name] = filter_rows(csr_df, self.checkpoint(f'csr_row_filter_{index}', get_row_export_df))
+        else:
+            exports[file_name] = csr_df
+
+    self.update_status(Status.RUNNING, 'Writing exports to disk.')
+    save_all(exports, self.task_id, on_rows_written=self.rows_written_callback((0.7, 1.0)))
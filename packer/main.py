@@ -1,26 +1,36 @@
+import asyncio
 import json
 import logging
 import logging.config
 import os
+import signal
+import time
 import uuid
+from collections import OrderedDict
 from datetime import datetime
+from typing import List
 
 import tornado.ioloop
 import tornado.web
 import tornado.websocket
 import yaml
 from tornado import iostream, gen
+from tornado.httpserver import HTTPServer
 from tornado.log import app_log as log
+from tornado.netutil import bind_sockets
 from tornado.options import define
 from tornado.web import HTTPError
 
 import packer.jobs as jobs
-from packer import auth
+from packer import admission, auth, coalescing, cost_estimate, metrics, result_cache, server
 from packer.file_handling import FSHandler
-from packer.task_status import Status, TaskStatusAsync
-from .config import tornado_config, app_config, logging_config
+from packer.task_status import Status, TaskStatusAsync, channel_name, event_id_key, get_statuses
+from .routing import route_options
+from .config import tornado_config, admission_config, app_config, logging_config, metrics_config, server_config, \
+    websocket_config
 from .redis_client import get_async_redis
-from .tasks import app
+from .subscriptions import StatusSubscriptions, events_lost, read_events_after
+from .celery_app import app
 
 
 def get_current_user(self):
@@ -61,8 +71,9 @@ class BaseHandler(tornado.web.RequestHandler):
     def set_default_headers(self):
         self.set_header("Access-Control-Allow-Origin", app_config.get("host"))
         self.set_header("Access-Control-Allow-Credentials", "true")
-        self.set_header("Access-Control-Allow-Headers", "authorization, content-type")
-        self.set_header('Access-Control-Allow-Methods', 'POST, GET, OPTIONS')
+        self.set_header("Access-Control-Allow-Headers", "authorization, content-type, if-none-match")
+        self.set_header("Access-Control-Expose-Headers", "etag")
+        self.set_header('Access-Control-Allow-Methods', 'POST, GET, DELETE, OPTIONS')
 
     @property
     def user_jobs_key(self):
@@ -82,6 +93,38 @@ class BaseHandler(tornado.web.RequestHandler):
         else:
             return TaskStatusAsync(task_id, self.application.redis)
 
+    async def submit(self, task, task_id, job_parameters, task_status, resource_class=None):
+        """
+        Send the task to the workers if the admission limits allow it, otherwise hold it as pending.
+        If the task cannot be sent, its admission slot is released and the error is raised.
+
+        :param resource_class: resource class to run the task with, instead of the one of the task.
+        """
+        position = await self.application.admission.admit(task_id, self.current_user)
+        if position:
+            log.info(f'Task {task_id} is pending at position {position}.')
+            await task_status.update_and_publish(message=admission.queue_message(position), queue_position=position)
+            return
+        try:
+            task.apply_async(
+                kwargs=job_parameters,
+                task_id=task_id,
+                headers=self.request.headers,
+                **route_options(resource_class)
+            )
+        except Exception:
+            await self.application.admission.release(task_id, self.current_user)
+            raise
+
+    def prepare(self):
+        self.application.requests.add(self)
+
+    def on_finish(self):
+        self.application.requests.discard(self)
+
+    def on_connection_close(self):
+        self.application.requests.discard(self)
+
     async def options(self, *args):
         # no body
         self.set_status(200)
@@ -92,6 +135,11 @@ class BaseHandler(tornado.web.RequestHandler):
         self.finish({"error": str(kwargs['exc_info'][1])})
 
 
+async def link_result(source_task_id: str, task_id: str):
+    """ Reuse the result of a task, in a thread, because the result may have to be copied. """
+    await asyncio.get_event_loop().run_in_executor(None, result_cache.link_result, source_task_id, task_id)
+
+
 class JobListHandler(BaseHandler):
     """
     Provides a list of all jobs, current and past for current user.
@@ -100,8 +148,9 @@ class JobListHandler(BaseHandler):
     async def get(self):
         log.info(f'Getting jobs for user: {self.current_user}')
         jobs_ = await self.application.redis.smembers(f'jobs:{self.current_user}')
+        statuses = await get_statuses(self.application.redis, list(jobs_))
         self.write(
-            {'jobs': [await TaskStatusAsync(job, self.application.redis).get() for job in jobs_],
+            {'jobs': [status for status in statuses if status is not None],
              'available_job_types': [job for job in jobs.registry.keys()]}
         )
         self.finish()
@@ -112,10 +161,89 @@ class CreateJobHandler(BaseHandler):
     Start any available job type.
     """
 
-    async def create(self, job_type: str, job_parameters: dict, **kwargs):
+    async def create(self, job_type: str, job_parameters: dict, coalesce: bool = True, cache: bool = True,
+                     **kwargs):
+        """
+        :param coalesce: if an identical job of the user is still running, return that job
+        instead of creating a new one (default: true).
+        :param cache: if the result cache is enabled, reuse the result of an identical job
+        of the user (default: true).
+        """
 
         log.info(f'New job request ({job_type}) for user: {self.current_user}')
+        task = self.check_job(job_type, job_parameters, kwargs)
+        self.check_flags(coalesce=coalesce, cache=cache)
+
+        task_id = str(uuid.uuid4())  # Job id used for tracking.
+        task_status = TaskStatusAsync(task_id, self.application.redis)
+        job_fingerprint = coalescing.fingerprint(job_type, job_parameters)
+        data_version = await result_cache.get_data_version(self.application.redis)
+        await task_status.create(**self.new_status(job_type, job_parameters, job_fingerprint, data_version))
+
+        if cache and result_cache.enabled():
+            cached_task_id = await result_cache.lookup(
+                self.application.redis, self.current_user, job_fingerprint, data_version)
+            if cached_task_id is not None:
+                log.info(f'Using the result of task {cached_task_id} for task {task_id}.')
+                await link_result(cached_task_id, task_id)
+                await task_status.update(status=Status.SUCCESS, message='Result taken from cache.',
+                                         cached_from=cached_task_id)
+                metrics.JOBS_CREATED.inc(job_type=job_type)
+                metrics.JOBS_FINISHED.inc(job_type=job_type, status=Status.SUCCESS)
+                await self.application.redis.sadd(self.user_jobs_key, task_id)
+                self.write(await task_status.get())
+                self.finish()
+                return
+
+        if coalesce:
+            inflight_status = await self.claim_inflight(job_fingerprint, task_id)
+            if inflight_status is not None:
+                await self.application.redis.delete(task_status.key)
+                log.info(f'Identical job {inflight_status["task_id"]} is running, not creating a new one.')
+                self.write(inflight_status)
+                self.finish()
+                return
+
+        resource_class = None
+        job_estimate = await cost_estimate.estimate_job(job_parameters, get_request_token(self))
+        if job_estimate is not None:
+            try:
+                resource_class = cost_estimate.select_resource_class(job_estimate)
+            except cost_estimate.JobTooLarge as e:
+                await self.application.redis.delete(task_status.key)
+                await coalescing.release_async(self.application.redis, self.current_user, job_fingerprint, task_id)
+                raise HTTPError(413, str(e))
+            log.info(f'Estimated size of job {task_id}: {job_estimate}, resource class: {resource_class}.')
+            await task_status.update(estimate=job_estimate, resource_class=resource_class)
 
+        await self.application.redis.sadd(self.user_jobs_key, task_id)
+        metrics.JOBS_CREATED.inc(job_type=job_type)
+
+        try:
+            await self.submit(task, task_id, job_parameters, task_status, resource_class)
+        except Exception as e:
+            log.error(f'Could not submit task {task_id}: {e}')
+            # Identical requests must not get the job that never started.
+            await task_status.update_and_publish(status=Status.FAILED, message=str(e))
+            await coalescing.release_async(self.application.redis, self.current_user, job_fingerprint, task_id)
+            raise tornado.web.HTTPError(400, str(e))
+
+        self.write(await task_status.get())
+        self.finish()
+
+    @staticmethod
+    def check_flags(**flags):
+        for name, value in flags.items():
+            if not isinstance(value, bool):
+                raise HTTPError(400, f'Unexpected argument, "{name}" should be true or false, but got {value!r}.')
+
+    @staticmethod
+    def check_job(job_type: str, job_parameters: dict, kwargs: dict):
+        """
+        Checks the job request before anything is stored.
+
+        :return: the declaration of the job type.
+        """
         if kwargs:
             msg = f'Illegal arguments provided: {", ".join([k for k in kwargs.keys()])}.'
             log.info(msg)
@@ -134,33 +262,54 @@ class CreateJobHandler(BaseHandler):
             raise HTTPError(404, f'Job {job_type!r} not found.')
         log.info(f'Job {job_type!r} found.')
 
-        task_id = str(uuid.uuid4())  # Job id used for tracking.
-        await self.application.redis.sadd(self.user_jobs_key, task_id)
+        try:
+            task.check_parameters(job_parameters)
+        except (TypeError, ValueError) as e:
+            raise HTTPError(400, str(e))
+        return task
 
-        task_status = await self.get_task_status(task_id)
-        await task_status.create(
+    def new_status(self, job_type: str, job_parameters: dict, job_fingerprint: str, data_version) -> dict:
+        return dict(
             job_type=job_type,
             job_parameters=job_parameters,
             status=Status.REGISTERED,
             user=self.current_user,
-            created_at=datetime.utcnow().isoformat(sep='T', timespec='seconds') + 'Z'
+            created_at=datetime.utcnow().isoformat(sep='T', timespec='seconds') + 'Z',
+            fingerprint=job_fingerprint,
+            data_version=data_version
         )
 
-        try:
-            task.apply_async(
-                kwargs=job_parameters,
-                task_id=task_id,
-                headers=self.request.headers
-            )
-        except Exception as e:
-            raise tornado.web.HTTPError(400, str(e))
+    async def claim_inflight(self, job_fingerprint, task_id):
+        """
+        Register the task as the running job with the fingerprint,
+        unless an identical job of the user is still running.
 
-        self.write(await task_status.get())
-        self.finish()
+        :return: status of the identical running job, None if the task is registered.
+        """
+        redis = self.application.redis
+        key = coalescing.inflight_key(self.current_user, job_fingerprint)
+        if await redis.set(key, task_id, expire=coalescing.inflight_ttl(), exist=redis.SET_IF_NOT_EXIST):
+            return None
+        while True:
+            inflight_id = await redis.get(key)
+            inflight_task_status = TaskStatusAsync(inflight_id, redis) if inflight_id else None
+            inflight_status = await redis.get(inflight_task_status.key) if inflight_task_status else None
+            if inflight_status is not None:
+                inflight_status = json.loads(inflight_status)
+                if inflight_status['status'] in (Status.REGISTERED, Status.FETCHING, Status.RUNNING) \
+                        and not await inflight_task_status.is_cancel_requested():
+                    return inflight_status
+            # The job has finished, or is being cancelled, without clearing the key.
+            # If another request replaces it first, the job of that request is checked.
+            if await coalescing.replace_async(redis, key, inflight_id, task_id):
+                return None
 
     async def get(self):
         kwargs = self.request.arguments
         kwargs['job_type'] = self.get_argument('job_type')
+        for flag in ('coalesce', 'cache'):
+            if flag in kwargs:
+                kwargs[flag] = self.get_argument(flag).lower() != 'false'
         try:
             kwargs['job_parameters'] = json.loads(self.get_argument('job_parameters'))
         except json.JSONDecodeError:
@@ -177,30 +326,339 @@ class CreateJobHandler(BaseHandler):
         await self.create(**kwargs)
 
 
+class BatchCreateJobHandler(CreateJobHandler):
+    """
+    Start several jobs at once. All jobs are checked before any of them is created,
+    the jobs are registered with pipelined Redis writes.
+    """
+    SUPPORTED_METHODS = ('POST', 'OPTIONS')
+
+    def check_batch(self, requests) -> List[dict]:
+        if not isinstance(requests, list) or not requests:
+            raise HTTPError(400, 'Expected a non-empty list of jobs.')
+        if len(requests) > app_config['batch_max_jobs']:
+            raise HTTPError(413, f'Too many jobs, at most {app_config["batch_max_jobs"]} jobs can be created at once.')
+        batch = []
+        for index, request in enumerate(requests):
+            if not isinstance(request, dict) or 'job_type' not in request or 'job_parameters' not in request:
+                raise HTTPError(400, f'Job {index}: expected a job_type and job_parameters.')
+            kwargs = dict(request)
+            job_type = kwargs.pop('job_type')
+            job_parameters = kwargs.pop('job_parameters')
+            coalesce = kwargs.pop('coalesce', True)
+            cache = kwargs.pop('cache', True)
+            try:
+                task = self.check_job(job_type, job_parameters, kwargs)
+                self.check_flags(coalesce=coalesce, cache=cache)
+            except HTTPError as e:
+                raise HTTPError(e.status_code, f'Job {index}: {e.log_message}')
+            batch.append(dict(index=index, task=task, job_type=job_type, job_parameters=job_parameters,
+                              coalesce=coalesce, cache=cache,
+                              fingerprint=coalescing.fingerprint(job_type, job_parameters)))
+        return batch
+
+    async def create_batch(self, batch: List[dict]) -> List[str]:
+        """
+        :return: ids of the tasks that handle the jobs, in the order of the jobs.
+        """
+        redis = self.application.redis
+        data_version = await result_cache.get_data_version(redis)
+        for job in batch:
+            job['task_id'] = str(uuid.uuid4())
+            job['status'] = self.new_status(job['job_type'], job['job_parameters'], job['fingerprint'], data_version)
+
+        if result_cache.enabled():
+            cached_ids = await asyncio.gather(*[
+                result_cache.lookup(redis, self.current_user, job['fingerprint'], data_version)
+                for job in batch if job['cache']])
+            for job, cached_task_id in zip([job for job in batch if job['cache']], cached_ids):
+                if cached_task_id is not None:
+                    job['status'].update(status=Status.SUCCESS, message='Result taken from cache.',
+                                         cached_from=cached_task_id)
+        to_run = [job for job in batch if job['status']['status'] == Status.REGISTERED]
+
+        token = get_request_token(self)
+        estimates = await asyncio.gather(*[cost_estimate.estimate_job(job['job_parameters'], token)
+                                           for job in to_run])
+        for job, job_estimate in zip(to_run, estimates):
+            if job_estimate is not None:
+                try:
+                    resource_class = cost_estimate.select_resource_class(job_estimate)
+                except cost_estimate.JobTooLarge as e:
+                    raise HTTPError(413, f'Job {job["index"]}: {e}')
+                job['status'].update(estimate=job_estimate, resource_class=resource_class)
+
+        to_run = await self.coalesce_batch(to_run)
+        coalesced = [job for job in batch if 'inflight_id' in job]
+
+        # The results are linked only when all jobs are accepted, a rejected batch leaves no links behind.
+        for job in batch:
+            if 'cached_from' in job['status']:
+                log.info(f'Using the result of task {job["status"]["cached_from"]} for task {job["task_id"]}.')
+                await link_result(job['status']['cached_from'], job['task_id'])
+
+        task_ids = [job['task_id'] for job in batch if 'inflight_id' not in job]
+        if task_ids:
+            pipe = redis.pipeline()
+            for job in batch:
+                if 'inflight_id' not in job:
+                    pipe.set(TaskStatusAsync(job['task_id'], redis).key, json.dumps(dict(
+                        job['status'], task_id=job['task_id'], version=1)))
+            pipe.sadd(self.user_jobs_key, *task_ids)
+            await pipe.execute()
+        for job in batch:
+            if 'inflight_id' not in job:
+                metrics.JOBS_CREATED.inc(job_type=job['job_type'])
+                if job['status']['status'] == Status.SUCCESS:
+                    metrics.JOBS_FINISHED.inc(job_type=job['job_type'], status=Status.SUCCESS)
+        log.info(f'Registered {len(batch) - len(coalesced)} jobs for user {self.current_user}, '
+                 f'{len(coalesced)} identical to running jobs.')
+
+        for job in to_run:
+            task_status = TaskStatusAsync(job['task_id'], redis)
+            try:
+                await self.submit(job['task'], job['task_id'], job['job_parameters'], task_status,
+                                  job['status'].get('resource_class'))
+            except Exception as e:
+                # submit has released the admission slot of the job.
+                log.error(f'Could not submit task {job["task_id"]}: {e}')
+                await task_status.update_and_publish(status=Status.FAILED, message=str(e))
+                await coalescing.release_async(redis, self.current_user, job['fingerprint'], job['task_id'])
+        return [job.get('inflight_id', job['task_id']) for job in batch]
+
+    async def coalesce_batch(self, batch: List[dict]) -> List[dict]:
+        """
+        Register the jobs as the running jobs with their fingerprints. Jobs that are identical
+        to a running job of the user, or to an earlier job in the batch, get the id of that job as inflight_id.
+
+        :return: the jobs that have to run.
+        """
+        redis = self.application.redis
+        claims = {}
+        for job in batch:
+            if not job['coalesce']:
+                continue
+            if job['fingerprint'] in claims:
+                job['inflight_id'] = claims[job['fingerprint']]['task_id']
+            else:
+                claims[job['fingerprint']] = job
+        pipe = redis.pipeline()
+        for fingerprint, job in claims.items():
+            pipe.set(coalescing.inflight_key(self.current_user, fingerprint), job['task_id'],
+                     expire=coalescing.inflight_ttl(), exist=redis.SET_IF_NOT_EXIST)
+        claimed = await pipe.execute()
+        for (fingerprint, job), is_claimed in zip(claims.items(), claimed):
+            if is_claimed:
+                continue
+            inflight_status = await self.claim_inflight(fingerprint, job['task_id'])
+            if inflight_status is not None:
+                job['inflight_id'] = inflight_status['task_id']
+        for job in batch:
+            inflight_job = claims.get(job['fingerprint'])
+            if inflight_job is not None and inflight_job is not job and 'inflight_id' in inflight_job:
+                job['inflight_id'] = inflight_job['inflight_id']
+        return [job for job in batch if 'inflight_id' not in job]
+
+    async def post(self):
+        try:
+            body = json.loads(self.request.body)
+        except json.JSONDecodeError:
+            raise HTTPError(400, 'Expected are valid JSON parameters.')
+        batch = self.check_batch(body.get('jobs') if isinstance(body, dict) else None)
+        log.info(f'New batch of {len(batch)} jobs for user: {self.current_user}')
+        task_ids = await self.create_batch(batch)
+        statuses = await get_statuses(self.application.redis, task_ids)
+        self.write({'jobs': statuses})
+        self.finish()
+
+
 class JobStatusHandler(BaseHandler):
     """
     Returns status object for single task.
+
+    The version of the status is returned as ETag. A client that passes the ETag it has seen
+    in the If-None-Match header gets 304 Not Modified if the status has not changed.
+    With a ``wait`` argument, the request waits up to that many seconds for a newer status
+    before responding (long-polling).
     """
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.status_version = None
+
+    def compute_etag(self):
+        if self.status_version is None:
+            return None
+        return f'"{self.status_version}"'
+
+    def has_current_version(self, status) -> bool:
+        """ Checks whether the client has seen this version of the status already. """
+        if status.get('version') is None:
+            return False
+        seen = [tag.strip() for tag in self.request.headers.get('If-None-Match', '').split(',')]
+        return f'"{status["version"]}"' in [tag[2:] if tag.startswith('W/') else tag for tag in seen]
+
     async def get(self, task_id):
         task_status = await self.get_task_status(task_id)
-        self.write(await task_status.get())
+        try:
+            wait = min(float(self.get_argument('wait', 0)), app_config['status_max_wait'])
+        except ValueError:
+            raise HTTPError(400, 'Expected a number of seconds to wait.')
+        if wait > 0:
+            status = await self.wait_for_newer_status(task_status, wait)
+        else:
+            status = await task_status.get()
+        self.status_version = status.get('version')
+        self.write(status)
+        self.finish()
+
+    async def wait_for_newer_status(self, task_status, timeout):
+        """
+        :return: the status, as soon as it differs from the version the client has seen, or after timeout.
+        """
+        updated = asyncio.Event()
+
+        def on_status(event):
+            if event.get('task_id') == task_status.task_id:
+                updated.set()
+
+        # Listen before reading the status, to not miss updates in between.
+        self.application.subscriptions.subscribe(self.current_user, on_status)
+        try:
+            status = await task_status.get()
+            if not self.has_current_version(status):
+                return status
+            try:
+                await asyncio.wait_for(updated.wait(), timeout)
+            except asyncio.TimeoutError:
+                return status
+            return await task_status.get()
+        finally:
+            self.application.subscriptions.unsubscribe(self.current_user, on_status)
+
+
+class BatchStatusHandler(BaseHandler):
+    """
+    Returns the status objects of several tasks, given as ``task_id`` arguments
+    or as ``{"task_ids": [...]}`` body of a POST request.
+    """
+
+    async def get(self):
+        await self.write_statuses(self.get_arguments('task_id'))
+
+    async def post(self):
+        try:
+            body = json.loads(self.request.body)
+        except json.JSONDecodeError:
+            raise HTTPError(400, 'Expected are valid JSON parameters.')
+        task_ids = body.get('task_ids') if isinstance(body, dict) else None
+        if not isinstance(task_ids, list) or not all(isinstance(task_id, str) for task_id in task_ids):
+            raise HTTPError(400, 'Expected a list of task ids.')
+        await self.write_statuses(task_ids)
+
+    async def write_statuses(self, task_ids: List[str]):
+        if len(task_ids) > app_config['batch_max_jobs']:
+            raise HTTPError(413, f'Too many tasks, at most {app_config["batch_max_jobs"]} statuses '
+                                 f'can be requested at once.')
+        redis = self.application.redis
+        pipe = redis.pipeline()
+        for task_id in task_ids:
+            pipe.sismember(self.user_jobs_key, task_id)
+        is_jobs = await pipe.execute()
+        user_task_ids = [task_id for task_id, is_job in zip(task_ids, is_jobs) if is_job]
+        statuses = [status for status in await get_statuses(redis, user_task_ids) if status is not None]
+        found = {status['task_id'] for status in statuses}
+        self.write({'jobs': statuses, 'not_found': [task_id for task_id in task_ids if task_id not in found]})
         self.finish()
 
 
 class JobCancelHandler(BaseHandler):
     """
-    Returns status object for single task.
+    Cancel a task. A running task is asked to stop, the worker marks it as cancelled when it has stopped.
     """
 
     async def get(self, task_id):
         task_status = await self.get_task_status(task_id)
-        app.control.revoke(task_id, terminate=True, signal='SIGUSR1')
-        logging.info(f'Cancel signal sent to worker for task: {task_id}')
-        await task_status.update(
+        controller = self.application.admission
+        if (await task_status.get())['status'] in (Status.FETCHING, Status.RUNNING):
+            # The worker releases the admission slot and the in-flight key when the task has stopped.
+            # The message is updated first, the worker may store the cancelled status right after the request.
+            await task_status.update_and_publish(message='Cancelling the task.')
+            await task_status.request_cancel()
+            logging.info(f'Cancel request sent to worker for running task: {task_id}')
+            self.finish()
+            return
+        if await controller.remove(task_id, self.current_user):
+            logging.info(f'Removed pending task: {task_id}')
+            # The workers count the jobs they have received.
+            metrics.JOBS_FINISHED.inc(job_type=(await task_status.get())['job_type'], status=Status.CANCELLED)
+        else:
+            # A task that has not started is skipped, or stops at its first cancellation check.
+            await task_status.request_cancel()
+            app.control.revoke(task_id)
+            logging.info(f'Cancel request sent to worker for task: {task_id}')
+            # The worker does not release the slot of a task that is revoked before it has started.
+            await controller.release(task_id, self.current_user)
+        status = await task_status.update_and_publish(
             status=Status.CANCELLED,
-            message='Cancelled prior to execution.'
+            message='Cancelled prior to execution.',
+            queue_position=None
         )
+        if status.get('fingerprint'):
+            await coalescing.release_async(self.application.redis, self.current_user, status['fingerprint'], task_id)
+        await admission.admit_pending_async(controller)
+        self.finish()
+
+
+class JobResumeHandler(BaseHandler):
+    """
+    Run a failed task again, from the last completed stage.
+    """
+
+    async def get(self, task_id):
+        task_status = await self.get_task_status(task_id)
+        status = await task_status.get()
+
+        if status['user'] != self.current_user:
+            raise HTTPError(401, 'Unauthorized.')
+
+        # Cancelled tasks are in the revoked sets of the workers, they cannot run again.
+        if status['status'] != Status.FAILED:
+            raise HTTPError(403, f'Wrong task status ({status["status"]}), '
+                                 f'has to be {Status.FAILED}.')
+
+        task = jobs.registry.get(status['job_type'])
+        if task is None:
+            raise HTTPError(404, f'Job {status["job_type"]!r} not found.')
+
+        await task_status.update_and_publish(status=Status.REGISTERED, message='Resuming task.')
+        await self.submit(task, task_id, status['job_parameters'], task_status, status.get('resource_class'))
+        log.info(f'Resuming task: {task_id}')
+        self.write(await task_status.get())
+        self.finish()
+
+
+class ResultCacheHandler(BaseHandler):
+    """
+    Remove the cached results of the current user.
+    """
+
+    async def delete(self):
+        await result_cache.invalidate_user(self.application.redis, self.current_user)
+        log.info(f'Result cache cleared for user: {self.current_user}')
+        self.set_status(204)
+        self.finish()
+
+
+class MetricsHandler(BaseHandler):
+    """
+    Returns the metrics of the server and the workers in Prometheus text format.
+    """
+
+    async def get(self):
+        await metrics.flush_async(self.application.redis)
+        self.set_header('Content-Type', metrics.CONTENT_TYPE)
+        self.write(await metrics.render(self.application.redis))
         self.finish()
 
 
@@ -249,11 +707,31 @@ class DataHandler(BaseHandler):
 
 
 class StatusWebSocket(tornado.websocket.WebSocketHandler):
+    """
+    Sends live status updates of the jobs of the current user.
+
+    Arguments:
+        - task_id: only send updates of these tasks (may be repeated), all tasks by default.
+          Clients can change the tasks by sending ``{"subscribe": [<task_id>, ...]}``
+          or ``{"unsubscribe": [<task_id>, ...]}`` messages, invalid messages are answered
+          with ``{"error": <message>}``. A socket opened without task ids keeps sending the updates
+          of all tasks, its subscription messages are answered with an error.
+        - batch: if true, send the updates of a batching window as a list in a single frame.
+        - last_event_id: id of the last event the client has seen, to get the events
+          it has missed before the live ones. If some of them are no longer available,
+          ``{"resync": true}`` is sent first, the client has to get the statuses of its jobs again.
+
+    Updates are collected during a batching window, only the latest update per task is sent.
+    """
     get_current_user = get_current_user
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.sub = None
+        self.replay_buffer = None
+        self.task_ids = None
+        self.batch = False
+        self.pending = OrderedDict()
+        self.send_handle = None
 
     def check_origin(self, origin):
         # FIXME need to limit connections from specific GB
@@ -261,64 +739,278 @@ class StatusWebSocket(tornado.websocket.WebSocketHandler):
 
     async def open(self):
         log.info("WebSocket opened")
-        self.sub, = await self.application.redis.subscribe(f'channel:{self.current_user}')
-
-        open_msg = f'Listening to channel: {self.sub.name.decode()!r}'
+        self.application.websockets.add(self)
+        task_ids = self.get_arguments('task_id')
+        self.task_ids = set(task_ids) if task_ids else None
+        self.batch = self.get_argument('batch', 'false').lower() == 'true'
+        last_event_id = self.get_argument('last_event_id', None)
+        if last_event_id is not None:
+            try:
+                event_id_key(last_event_id)
+            except ValueError:
+                self.close(4000, f'Invalid last_event_id: {last_event_id!r}')
+                return
+            # Hold live messages until the missed ones have been sent.
+            self.replay_buffer = []
+        self.application.subscriptions.subscribe(self.current_user, self.send_status)
+
+        channel = channel_name(self.current_user)
+        open_msg = f'Listening to channel: {channel!r}'
         log.info(open_msg)
         self.write_message(open_msg)
 
-        async def async_reader(channel):
-            while await channel.wait_message():
-                msg = await channel.get()
-                logging.info(msg)
-                self.write_message(msg)
+        if last_event_id is not None:
+            await self.replay(last_event_id)
 
-        await async_reader(self.sub)
+    async def replay(self, last_event_id):
+        try:
+            events = await read_events_after(self.application.redis, self.current_user, last_event_id)
+            if await events_lost(self.application.redis, self.current_user, last_event_id):
+                self.write_resync_message()
+            log.info(f'Replaying {len(events)} status events after {last_event_id!r}.')
+            for event in events:
+                self.queue_status(event)
+                last_event_id = event['event_id']
+        except Exception as e:
+            log.warning(f'Could not replay the status events after {last_event_id!r}: {e}')
+            self.write_resync_message()
+        finally:
+            # Deliver the live messages, also if the missed ones could not be read.
+            buffered, self.replay_buffer = self.replay_buffer, None
+            for event in buffered:
+                event_id = event.get('event_id')
+                if event_id is None or event_id_key(event_id) > event_id_key(last_event_id):
+                    self.queue_status(event)
+
+    def send_status(self, event):
+        if self.replay_buffer is not None:
+            self.replay_buffer.append(event)
+        else:
+            self.queue_status(event)
+
+    def queue_status(self, event):
+        task_id = event.get('task_id')
+        if self.task_ids is not None and task_id not in self.task_ids:
+            return
+        # Keep only the latest update per task, in the order of the latest updates.
+        self.pending.pop(task_id, None)
+        self.pending[task_id] = event
+        batch_window = websocket_config['batch_window']
+        if batch_window <= 0:
+            self.send_pending()
+        elif self.send_handle is None:
+            self.send_handle = tornado.ioloop.IOLoop.current().call_later(batch_window, self.send_pending)
+
+    def send_pending(self):
+        self.send_handle = None
+        events, self.pending = list(self.pending.values()), OrderedDict()
+        if not events:
+            return
+        try:
+            if self.batch:
+                self.write_message(json.dumps(events))
+            else:
+                for event in events:
+                    self.write_message(json.dumps(event))
+        except tornado.websocket.WebSocketClosedError:
+            log.info('Status message not sent, WebSocket closed.')
 
     async def on_message(self, message):
         log.info(f"Message received: {message}")
+        try:
+            request = json.loads(message)
+        except json.JSONDecodeError:
+            request = None
+        if not isinstance(request, dict):
+            self.write_error_message('Expected a JSON object.')
+            return
+        for action in ('subscribe', 'unsubscribe'):
+            task_ids = request.get(action)
+            if task_ids is not None and not (isinstance(task_ids, list)
+                                             and all(isinstance(task_id, str) for task_id in task_ids)):
+                self.write_error_message(f'Expected a list of task ids to {action}.')
+                return
+        if self.task_ids is None and (request.get('subscribe') or request.get('unsubscribe')):
+            self.write_error_message('This websocket sends the updates of all tasks, '
+                                     'open it with task_id arguments to watch specific tasks.')
+            return
+        if request.get('subscribe'):
+            self.task_ids |= set(request['subscribe'])
+        if request.get('unsubscribe'):
+            self.task_ids -= set(request['unsubscribe'])
+
+    def write_error_message(self, message: str):
+        log.info(f'Invalid WebSocket message: {message}')
+        try:
+            self.write_message(json.dumps({'error': message}))
+        except tornado.websocket.WebSocketClosedError:
+            pass
 
-    async def on_close(self):
+    def write_resync_message(self):
+        log.info('Status events have been lost, the client has to get the job statuses again.')
+        try:
+            self.write_message(json.dumps({'resync': True}))
+        except tornado.websocket.WebSocketClosedError:
+            pass
+
+    def on_close(self):
         log.info("WebSocket closed by client.")
-        await self.sub.unsubscribe()
+        self.application.websockets.discard(self)
+        if self.send_handle is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(self.send_handle)
+            self.send_handle = None
+        self.application.subscriptions.unsubscribe(self.current_user, self.send_status)
         log.info("Unsubscribed from channel.")
 
 
+LOOP_LAG_INTERVAL = 0.5  # seconds between IOLoop lag measurements
+
+
 class Application(tornado.web.Application):
 
     def __init__(self, *args, **kwargs):
         self.redis = None
+        self.subscriptions = None
+        self.server = None
+        self.metrics_reporter = None
+        self.admission_sweeper = None
+        self.requests = set()  # handlers of the requests in progress
+        self.websockets = set()
+        self.shutting_down = False
         super().__init__(*args, **kwargs)
 
     def init_with_loop(self, loop):
         self.redis = get_async_redis(loop)
+        self.subscriptions = StatusSubscriptions(self.redis)
+        self.subscriptions.start(loop)
+        self.admission = admission.AdmissionControllerAsync(self.redis)
+        self.metrics_reporter = loop.create_task(self.report_metrics())
+        if admission.enabled():
+            self.admission_sweeper = loop.create_task(self.sweep_admission())
+
+    def log_request(self, handler):
+        super().log_request(handler)
+        if not isinstance(handler, tornado.websocket.WebSocketHandler):
+            metrics.REQUEST_DURATION.observe(handler.request.request_time(), handler=type(handler).__name__,
+                                             method=handler.request.method, code=handler.get_status())
+
+    async def report_metrics(self):
+        """ Measure the IOLoop lag and flush the metrics of the process to Redis regularly. """
+        loop = asyncio.get_event_loop()
+        flushed_at = loop.time()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            metrics.LOOP_LAG.observe(max(loop.time() - start - LOOP_LAG_INTERVAL, 0.0))
+            if loop.time() - flushed_at < metrics_config['flush_interval']:
+                continue
+            metrics.WEBSOCKETS.set(len(self.websockets))
+            try:
+                await metrics.flush_async(self.redis)
+            except Exception as e:
+                log.warning(f'Could not flush metrics: {e}')
+            flushed_at = loop.time()
+
+    async def sweep_admission(self):
+        """ Start waiting jobs regularly, also when slots are freed because they expired. """
+        while True:
+            await asyncio.sleep(admission_config['sweep_interval'])
+            try:
+                await admission.admit_pending_async(self.admission)
+            except Exception as e:
+                log.warning(f'Could not admit pending jobs: {e}')
+
+    def handle_shutdown_signals(self):
+        """ Shut down gracefully on SIGTERM and SIGINT. """
+        loop = asyncio.get_event_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, lambda: asyncio.ensure_future(self.shutdown()))
+
+    async def shutdown(self, timeout: float = None):
+        """
+        Stop accepting connections, wait for the requests in progress to finish, close the websockets
+        and stop the loop. Clients of the websockets reconnect to another server process.
 
-
-def make_web_app(port, tornado_options):
+        :param timeout: maximum number of seconds to wait for requests, the shutdown timeout by default.
+        """
+        if self.shutting_down:
+            return
+        self.shutting_down = True
+        if timeout is None:
+            timeout = server_config['shutdown_timeout']
+        log.info(f'Shutting down, waiting for {len(self.requests)} requests to finish.')
+        self.server.stop()
+        deadline = time.monotonic() + timeout
+        while self.requests and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self.requests:
+            log.warning(f'Closing {len(self.requests)} unfinished requests.')
+        for websocket in list(self.websockets):
+            websocket.close(1001, 'Server restarting.')
+        await self.server.close_all_connections()
+        self.subscriptions.stop()
+        self.metrics_reporter.cancel()
+        if self.admission_sweeper is not None:
+            self.admission_sweeper.cancel()
+        metrics.WEBSOCKETS.set(None)
+        await metrics.flush_async(self.redis)
+        await metrics.remove_process(self.redis)
+        self.redis.close()
+        await self.redis.wait_closed()
+        tornado.ioloop.IOLoop.current().stop()
+        log.info('Server stopped.')
+
+
+def make_web_app(port, tornado_options, sockets=None):
     """
     Create tornado app and loop.
 
+    :param sockets: listening sockets to serve on, shared by the server processes.
+    By default, the app listens on the port.
     :return: (app, loop)
     """
     log.info('Creating web application.')
     web_app = Application([
         (r"/jobs", JobListHandler),
         (r"/jobs/create", CreateJobHandler),
+        (r"/jobs/batch/create", BatchCreateJobHandler),
+        (r"/jobs/batch/status", BatchStatusHandler),
         (r"/jobs/status/(.+)", JobStatusHandler),
         (r"/jobs/data/(.+)", DataHandler),
         (r"/jobs/cancel/(.+)", JobCancelHandler),
-        (r"/jobs/subscribe", StatusWebSocket)
+        (r"/jobs/resume/(.+)", JobResumeHandler),
+        (r"/jobs/cache", ResultCacheHandler),
+        (r"/jobs/subscribe", StatusWebSocket),
+        (r"/metrics", MetricsHandler)
     ], **tornado_options)
-    web_app.listen(port)
+    if sockets is None:
+        web_app.server = web_app.listen(port)
+    else:
+        web_app.server = HTTPServer(web_app)
+        web_app.server.add_sockets(sockets)
     loop = tornado.ioloop.IOLoop.current()
     web_app.init_with_loop(loop.asyncio_loop)
     return web_app, loop
 
 
+def run_server(port, tornado_options, sockets=None):
+    web_app, loop = make_web_app(port, tornado_options, sockets)
+    web_app.handle_shutdown_signals()
+    log.info(f'Starting at http://localhost:{port} (pid {os.getpid()})')
+    loop.start()
+
+
 def main():
     tornado.options.parse_command_line()
     port = tornado_config.get('port', 8888)
     setup_logging()
-    web_app, loop = make_web_app(port, tornado_config)
-    log.info(f'Starting at http://localhost:{web_app.settings.get("port")}')
-    loop.start()
+    processes = server.process_count(server_config['processes'])
+    if processes == 1:
+        run_server(port, tornado_config)
+        return
+    # The sockets are bound before forking, so that all processes accept connections on the port.
+    sockets = bind_sockets(port)
+    # Autoreload does not work with multiple processes.
+    tornado_options = dict(tornado_config, autoreload=False)
+    log.info(f'Starting {processes} server processes.')
+    server.Supervisor(processes, lambda index: run_server(port, tornado_options, sockets)).run()
@@ -0,0 +1,97 @@
+import ctypes
+import logging
+import os
+import threading
+from contextlib import contextmanager
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+class MemoryBudgetExceeded(Exception):
+    """ Raised in a task that uses more memory than its budget. """
+
+
+def rss_mb() -> Optional[float]:
+    """ :return: resident memory of the current process in MiB, None if it cannot be read. """
+    try:
+        with open('/proc/self/statm') as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return resident_pages * PAGE_SIZE / 2 ** 20
+
+
+class MemoryWatchdog(threading.Thread):
+    """
+    Checks the memory use of the process at an interval, and flags when it exceeds the budget.
+    The watched thread raises MemoryBudgetExceeded at its next :meth:`check`, e.g., between the chunks
+    of a transformation. If it does not check within the abort delay, the exception is raised in the
+    thread when it runs Python code again, which may be in the middle of a Redis or HTTP request.
+    """
+
+    def __init__(self, budget_mb: float, interval: float, thread_id: int, abort_delay: float = 0):
+        super().__init__(name='memory-watchdog', daemon=True)
+        self.budget_mb = budget_mb
+        self.interval = interval
+        self.thread_id = thread_id
+        self.abort_delay = abort_delay
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.exceeded = False
+        self.interrupted = False
+
+    def run(self):
+        while not self.exceeded:
+            if self.stopped.wait(self.interval):
+                return
+            rss = rss_mb()
+            if rss is not None and rss > self.budget_mb:
+                logger.warning(f'Memory use of {rss:.0f} MiB exceeds the budget of {self.budget_mb} MiB.')
+                self.exceeded = True
+        if self.stopped.wait(self.abort_delay):
+            return
+        with self.lock:
+            # Do not raise in the watched thread after it has left the watched code.
+            if self.stopped.is_set():
+                return
+            logger.warning(f'Interrupting the thread that did not stop within {self.abort_delay} seconds.')
+            self.interrupted = True
+            ctypes.pythonapi.PyThreadState_SetAsyncExc(
+                ctypes.c_ulong(self.thread_id), ctypes.py_object(MemoryBudgetExceeded))
+
+    def check(self):
+        """
+        :raises MemoryBudgetExceeded: if the memory use has exceeded the budget.
+        """
+        if self.exceeded:
+            raise MemoryBudgetExceeded()
+
+    def stop(self):
+        with self.lock:
+            self.stopped.set()
+        self.join()
+
+
+@contextmanager
+def watch(budget_mb: Optional[float], interval: float, abort_delay: float = 0):
+    """
+    Watch the memory use of the process while the current thread runs the body.
+
+    :param budget_mb: memory budget in MiB, None or 0 to not watch.
+    :param interval: number of seconds between checks.
+    :param abort_delay: number of seconds the thread gets to stop at a check, after the budget
+    has been exceeded, before it is interrupted.
+    :return: the watchdog, None if the memory use is not watched.
+    """
+    if not budget_mb or rss_mb() is None:
+        yield None
+        return
+    watchdog = MemoryWatchdog(budget_mb, interval, threading.get_ident(), abort_delay)
+    watchdog.start()
+    try:
+        yield watchdog
+    finally:
+        watchdog.stop()
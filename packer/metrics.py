@@ -0,0 +1,225 @@
+"""
+Metrics in the Prometheus text format.
+
+Metrics are recorded in memory by the process that observes them and added to totals in Redis
+when the process flushes them, so that the metrics endpoint of any server process reports
+the totals of all server and worker processes.
+"""
+import os
+import socket
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+from packer.config import metrics_config, resource_class_config
+
+KEY_PREFIX = 'metrics:'
+PROCESSES_KEY = 'metrics:processes'  # time of the last flush per process, for the gauges
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STAGE_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)
+
+REGISTRY = []
+
+
+def escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(labels: Dict[str, object]) -> str:
+    return ','.join(f'{name}="{escape(value)}"' for name, value in labels.items())
+
+
+def sample(name: str, labels: str, value) -> str:
+    return f'{name}{{{labels}}} {value}' if labels else f'{name} {value}'
+
+
+def process_id() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name: str, documentation: str, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        # Increments of the fields of the Redis hash of the metric since the last flush.
+        self.pending = defaultdict(float)
+        REGISTRY.append(self)
+
+    @property
+    def key(self) -> str:
+        return KEY_PREFIX + self.name
+
+    def label_string(self, labels: dict) -> str:
+        if set(labels) != set(self.label_names):
+            raise ValueError(f'Expected labels {", ".join(self.label_names)} for {self.name}.')
+        return format_labels({name: labels[name] for name in self.label_names})
+
+    def collect(self) -> Dict[str, float]:
+        pending, self.pending = self.pending, defaultdict(float)
+        return pending
+
+    def header(self) -> List[str]:
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+
+    def render(self, fields: Dict[str, str]) -> List[str]:
+        return self.header() + [sample(self.name, labels, value) for labels, value in sorted(fields.items())]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        self.pending[self.label_string(labels)] += amount
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(str(bucket) for bucket in buckets) + ('+Inf',)
+
+    def observe(self, value: float, **labels):
+        labels = self.label_string(labels)
+        for bucket in self.buckets:
+            if bucket == '+Inf' or value <= float(bucket):
+                self.pending[f'{labels}|{bucket}'] += 1
+        self.pending[f'{labels}|sum'] += value
+
+    def render(self, fields: Dict[str, str]) -> List[str]:
+        series = defaultdict(dict)
+        for field, value in fields.items():
+            labels, _, suffix = field.rpartition('|')
+            series[labels][suffix] = value
+        lines = self.header()
+        for labels, values in sorted(series.items()):
+            for bucket in self.buckets:
+                bucket_labels = ','.join(filter(None, [labels, format_labels({'le': bucket})]))
+                lines.append(sample(f'{self.name}_bucket', bucket_labels, values.get(bucket, 0)))
+            lines.append(sample(f'{self.name}_sum', labels, values.get('sum', 0)))
+            lines.append(sample(f'{self.name}_count', labels, values.get('+Inf', 0)))
+        return lines
+
+
+class Gauge(Metric):
+    """ Value per process, reported as the total of the processes that have flushed recently. """
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str):
+        super().__init__(name, documentation)
+        self.value = None
+
+    def set(self, value: float):
+        self.value = value
+
+    def render(self, fields: Dict[str, str]) -> List[str]:
+        return self.header() + [sample(self.name, '', sum(float(value) for value in fields.values()))]
+
+
+REQUEST_DURATION = Histogram(
+    'packer_http_request_duration_seconds', 'Duration of HTTP requests by handler.',
+    labels=('handler', 'method', 'code'))
+LOOP_LAG = Histogram(
+    'packer_ioloop_lag_seconds', 'Delay of IOLoop callbacks of the server processes.')
+REDIS_DURATION = Histogram(
+    'packer_redis_command_duration_seconds', 'Duration of Redis commands of the server processes.',
+    labels=('command',))
+WEBSOCKETS = Gauge(
+    'packer_websocket_connections', 'Number of open websocket connections.')
+JOBS_CREATED = Counter(
+    'packer_jobs_created_total', 'Number of jobs created by job type.',
+    labels=('job_type',))
+JOBS_FINISHED = Counter(
+    'packer_jobs_finished_total', 'Number of jobs finished by job type and final status.',
+    labels=('job_type', 'status'))
+JOB_DURATION = Histogram(
+    'packer_job_duration_seconds', 'Duration of job runs by job type and final status.',
+    labels=('job_type', 'status'), buckets=STAGE_BUCKETS)
+STAGE_DURATION = Histogram(
+    'packer_job_stage_duration_seconds', 'Duration of the stages of jobs by job type and stage.',
+    labels=('job_type', 'stage'), buckets=STAGE_BUCKETS)
+
+
+def add_updates(pipe):
+    """ Add the commands that add the metrics recorded since the last flush to the totals to a pipeline. """
+    has_gauges = False
+    for metric in REGISTRY:
+        if isinstance(metric, Gauge):
+            if metric.value is not None:
+                pipe.hset(metric.key, process_id(), metric.value)
+                has_gauges = True
+            continue
+        for field, amount in metric.collect().items():
+            pipe.hincrbyfloat(metric.key, field, amount)
+    if has_gauges:
+        pipe.hset(PROCESSES_KEY, process_id(), time.time())
+
+
+def flush(redis):
+    """ Add the metrics recorded since the last flush to the totals in Redis. """
+    pipe = redis.pipeline()
+    add_updates(pipe)
+    pipe.execute()
+
+
+async def flush_async(redis):
+    pipe = redis.pipeline()
+    add_updates(pipe)
+    await pipe.execute()
+
+
+async def remove_process(redis):
+    """ Remove the gauges of the process, when it stops. """
+    pipe = redis.pipeline()
+    for metric in REGISTRY:
+        if isinstance(metric, Gauge):
+            pipe.hdel(metric.key, process_id())
+    pipe.hdel(PROCESSES_KEY, process_id())
+    await pipe.execute()
+
+
+def queue_names() -> List[str]:
+    return sorted({config['queue'] for config in resource_class_config.values()})
+
+
+async def render(redis, now: Optional[float] = None) -> str:
+    """
+    :return: the totals of all metrics and the lengths of the Celery queues, in Prometheus text format.
+    """
+    now = time.time() if now is None else now
+    pipe = redis.pipeline()
+    for metric in REGISTRY:
+        pipe.hgetall(metric.key)
+    pipe.hgetall(PROCESSES_KEY)
+    for queue in queue_names():
+        pipe.llen(queue)
+    results = await pipe.execute()
+    fields = results[:len(REGISTRY)]
+    flushed_at = results[len(REGISTRY)]
+    queue_lengths = results[len(REGISTRY) + 1:]
+
+    # Processes that have not flushed for a while have stopped without removing their gauges.
+    stale = [process for process, timestamp in flushed_at.items()
+             if now - float(timestamp) > 3 * metrics_config['flush_interval']]
+    if stale:
+        pipe = redis.pipeline()
+        for key in [PROCESSES_KEY] + [metric.key for metric in REGISTRY if isinstance(metric, Gauge)]:
+            pipe.hdel(key, *stale)
+        await pipe.execute()
+
+    lines = []
+    for metric, metric_fields in zip(REGISTRY, fields):
+        if isinstance(metric, Gauge):
+            metric_fields = {process: value for process, value in metric_fields.items()
+                             if process in flushed_at and process not in stale}
+        lines.extend(metric.render(metric_fields))
+    lines.append('# HELP packer_queue_length Number of jobs waiting in the Celery queue.')
+    lines.append('# TYPE packer_queue_length gauge')
+    for queue, length in zip(queue_names(), queue_lengths):
+        lines.append(sample('packer_queue_length', format_labels({'queue': queue}), length))
+    return '\n'.join(lines) + '\n'
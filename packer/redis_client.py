@@ -1,16 +1,34 @@
+import asyncio
+import time
+
 import aioredis
 from redis import StrictRedis
 
+from . import metrics
 from .config import redis_config
 
 redis = StrictRedis.from_url(redis_config.get('url'), decode_responses=True)
 
 
+class TimedRedis(aioredis.Redis):
+    """ Async Redis client that records the duration of the commands. """
+
+    def execute(self, command, *args, **kwargs):
+        start = time.perf_counter()
+        # The pool returns a coroutine instead of a future if it has to wait for a connection.
+        future = asyncio.ensure_future(super().execute(command, *args, **kwargs))
+        name = command.decode() if isinstance(command, bytes) else str(command)
+        future.add_done_callback(
+            lambda _: metrics.REDIS_DURATION.observe(time.perf_counter() - start, command=name.upper()))
+        return future
+
+
 def get_async_redis(loop):
     return loop.run_until_complete(
         aioredis.create_redis_pool(
             redis_config.get('url'),
             loop=loop,
-            encoding='utf-8'
+            encoding='utf-8',
+            commands_factory=TimedRedis
         )
     )
@@ -0,0 +1,94 @@
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+from typing import Optional
+
+from packer.config import task_config
+from packer.file_handling import FSHandler
+
+logger = logging.getLogger(__name__)
+
+DATA_VERSION_KEY = 'result_cache:data_version'
+
+
+def enabled() -> bool:
+    """ The result cache is enabled if a ttl is configured. """
+    return task_config['result_cache_ttl'] > 0
+
+
+def cache_key(user: str) -> str:
+    """ Hash with the cached results of a user, by job fingerprint. """
+    return f'result_cache:{user}'
+
+
+def store(redis, status: dict):
+    """
+    Store the result of a finished job in the cache of the user.
+
+    :param redis: Redis client.
+    :param status: status of the job, with the fingerprint and data version it was created with.
+    """
+    if not enabled() or not status.get('fingerprint'):
+        return
+    entry = {'task_id': status['task_id'], 'data_version': status.get('data_version'), 'stored_at': time.time()}
+    key = cache_key(status['user'])
+    pipe = redis.pipeline()
+    pipe.hset(key, status['fingerprint'], json.dumps(entry))
+    pipe.expire(key, task_config['result_cache_ttl'])
+    pipe.execute()
+
+
+async def get_data_version(redis) -> Optional[str]:
+    return await redis.get(DATA_VERSION_KEY)
+
+
+async def lookup(redis, user: str, job_fingerprint: str, data_version: Optional[str]) -> Optional[str]:
+    """
+    :return: id of a task of the user with the fingerprint, of which the result is still valid.
+    """
+    entry = await redis.hget(cache_key(user), job_fingerprint)
+    if entry is None:
+        return None
+    entry = json.loads(entry)
+    if entry['data_version'] != data_version \
+            or time.time() - entry['stored_at'] > task_config['result_cache_ttl'] \
+            or not FSHandler(entry['task_id']).exists():
+        await redis.hdel(cache_key(user), job_fingerprint)
+        return None
+    return entry['task_id']
+
+
+async def invalidate_user(redis, user: str):
+    """ Remove all cached results of a user, e.g., after the permissions of the user have changed. """
+    await redis.delete(cache_key(user))
+
+
+def invalidate_all(redis) -> int:
+    """
+    Invalidate the cached results of all users, to be called after data has been loaded into tranSMART.
+
+    :return: the new data version.
+    """
+    return redis.incr(DATA_VERSION_KEY)
+
+
+def link_result(source_task_id: str, task_id: str):
+    """
+    Make the result file of a task available as the result of another task.
+    The file is copied if it cannot be linked, e.g., to another file system, so this may take a while.
+    """
+    source, target = FSHandler(source_task_id).path, FSHandler(task_id).path
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+if __name__ == '__main__':
+    from packer.redis_client import redis
+    logging.basicConfig(level=logging.INFO)
+    logger.info(f'Result cache invalidated, data version: {invalidate_all(redis)}')
+    sys.exit(0)
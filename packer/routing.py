@@ -0,0 +1,59 @@
+import logging
+from typing import Optional
+
+from packer.config import resource_class_config
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RESOURCE_CLASS = 'light'
+
+
+def get_resource_class(name: str) -> dict:
+    """
+    :param name: name of the resource class, e.g., light or heavy.
+    :return: queue and worker settings of the resource class.
+    """
+    try:
+        return resource_class_config[name]
+    except KeyError:
+        raise ValueError(f'Unknown resource class {name!r}, '
+                         f'expected one of: {", ".join(resource_class_config)}.')
+
+
+def route_task(name, args, kwargs, options, task=None, **kw) -> Optional[dict]:
+    """
+    Celery router that sends a task to the queue of its resource class.
+    Tasks declare their resource class with the `resource_class` task option, e.g.,
+    ``@app.task(bind=True, base=BaseDataTask, resource_class='heavy')``.
+    """
+    resource_class = getattr(task, 'resource_class', None)
+    if resource_class is None:
+        return None
+    return {'queue': get_resource_class(resource_class)['queue']}
+
+
+def route_options(resource_class: Optional[str]) -> dict:
+    """
+    :param resource_class: resource class selected for a job, e.g., based on its estimated size.
+    :return: options for `apply_async` that override the resource class of the task.
+    """
+    if resource_class is None:
+        return {}
+    return {'queue': get_resource_class(resource_class)['queue']}
+
+
+def worker_arguments(name: str) -> list:
+    """
+    :param name: name of the resource class.
+    :return: celery worker command line arguments for a worker of the resource class.
+    """
+    resource_class = get_resource_class(name)
+    return [
+        'worker',
+        '--queues', resource_class['queue'],
+        '--concurrency', str(resource_class['concurrency']),
+        '--prefetch-multiplier', str(resource_class['prefetch_multiplier']),
+        # Worker processes are replaced after a task leaves them above the memory budget.
+        '--max-memory-per-child', str(resource_class['memory_budget'] * 1024),
+        '--hostname', f'{name}@%h',
+    ]
@@ -0,0 +1,109 @@
+import os
+import signal
+import sys
+import time
+from typing import Callable
+
+from tornado.log import app_log as log
+
+RESTART_DELAY = 1  # seconds to wait before replacing a process that stopped unexpectedly
+
+
+def process_count(processes: int) -> int:
+    """ :return: the number of server processes, the number of CPUs if processes is 0 or less. """
+    if processes <= 0:
+        return os.cpu_count() or 1
+    return processes
+
+
+class Supervisor:
+    """
+    Runs the server in a number of forked processes that share the listening sockets
+    bound by the parent process. Every process has its own IOLoop and Redis connections.
+
+    SIGTERM and SIGINT stop the processes gracefully. SIGHUP replaces the processes,
+    the new processes are started before the old ones stop, so that no requests are refused.
+    Processes that stop unexpectedly are replaced.
+    """
+
+    def __init__(self, processes: int, run_process: Callable[[int], None]):
+        """
+        :param processes: number of server processes.
+        :param run_process: runs the server in a forked process, called with the index of the process.
+        """
+        self.processes = processes
+        self.run_process = run_process
+        self.children = {}  # index of the process by pid
+        self.retiring = set()  # pids of processes that are being replaced
+        self.stopping = False
+
+    def spawn(self, index: int) -> int:
+        pid = os.fork()
+        if pid == 0:
+            for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+                signal.signal(signum, signal.SIG_DFL)
+            code = 0
+            try:
+                self.run_process(index)
+            except BaseException as e:
+                log.error(f'Server process {index} failed: {e!r}')
+                code = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+        log.info(f'Started server process {index} (pid {pid}).')
+        self.children[pid] = index
+        return pid
+
+    def run(self):
+        """ Start the processes and wait until all of them have stopped. """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.restart)
+        for index in range(self.processes):
+            self.spawn(index)
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            index = self.children.pop(pid, None)
+            if index is None:
+                continue
+            if pid in self.retiring:
+                self.retiring.discard(pid)
+                log.info(f'Server process {index} (pid {pid}) has been replaced.')
+            elif not self.stopping:
+                log.warning(f'Server process {index} (pid {pid}) stopped unexpectedly '
+                            f'(status {status}), starting a new one.')
+                time.sleep(RESTART_DELAY)
+                self.spawn(index)
+        log.info('All server processes have stopped.')
+
+    def stop(self, signum=None, frame=None):
+        """ Stop all processes gracefully. """
+        if not self.stopping:
+            log.info('Stopping server processes.')
+        self.stopping = True
+        for pid in list(self.children):
+            self.signal(pid, signal.SIGTERM)
+
+    def restart(self, signum=None, frame=None):
+        """ Replace all processes, starting the new ones before stopping the old ones. """
+        if self.stopping:
+            return
+        log.info('Replacing server processes.')
+        for pid, index in list(self.children.items()):
+            if pid in self.retiring:
+                continue
+            self.retiring.add(pid)
+            self.spawn(index)
+            self.signal(pid, signal.SIGTERM)
+
+    @staticmethod
+    def signal(pid: int, signum: int):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
@@ -0,0 +1,132 @@
+import asyncio
+import json
+from collections import defaultdict
+from typing import Callable, List
+
+from tornado.log import app_log as log
+
+from packer.task_status import events_key, event_id_key
+
+CHANNEL_PREFIX = 'channel:'
+CHANNEL_PATTERN = f'{CHANNEL_PREFIX}*'
+RESUBSCRIBE_DELAY = 1  # seconds to wait before subscribing again after losing the connection
+REPLAY_BATCH_SIZE = 100  # number of events read from the event stream at once
+
+
+async def read_events_after(redis, user: str, last_event_id: str) -> List[dict]:
+    """
+    Read the status events of a user that were added to the event stream after the last seen event.
+
+    :param redis: async Redis client.
+    :param user: user id (sub).
+    :param last_event_id: id of the last event the client has seen.
+    :return: list of events, with their event_id, in the order they were published.
+    """
+    events = []
+    last_key = event_id_key(last_event_id)
+    start = last_event_id
+    while True:
+        batch = await redis.xrange(events_key(user), start=start, stop='+', count=REPLAY_BATCH_SIZE)
+        for event_id, fields in batch:
+            if event_id_key(event_id) <= last_key:
+                continue
+            event = json.loads(fields['event'])
+            event['event_id'] = event_id
+            events.append(event)
+            last_key = event_id_key(event_id)
+        if len(batch) < REPLAY_BATCH_SIZE:
+            return events
+        start = batch[-1][0]
+
+
+async def events_lost(redis, user: str, last_event_id: str) -> bool:
+    """
+    Check whether events after the last seen event may have been removed from the event stream,
+    because the stream was trimmed to its maximum length or expired, so that a replay is incomplete.
+
+    :param redis: async Redis client.
+    :param user: user id (sub).
+    :param last_event_id: id of the last event the client has seen.
+    :return: True if the oldest event in the stream is newer than the last seen event, or the stream is empty.
+    """
+    first = await redis.xrange(events_key(user), count=1)
+    return not first or event_id_key(first[0][0]) > event_id_key(last_event_id)
+
+
+class StatusSubscriptions:
+    """
+    Single Redis pattern subscription to the status channels of all users, shared by all
+    websocket connections of the server process. Messages are fanned out in memory
+    to the listeners registered for the user the message is published for.
+    """
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.listeners = defaultdict(set)
+        self.reader = None
+
+    def start(self, loop):
+        """ Start reading status messages on the loop. """
+        self.reader = loop.create_task(self._read())
+
+    def ensure_started(self):
+        """ Start reading again, if the reader was cancelled or stopped. """
+        if self.reader is None or self.reader.done():
+            self.reader = asyncio.ensure_future(self._read())
+
+    def stop(self):
+        if self.reader is not None:
+            self.reader.cancel()
+            self.reader = None
+
+    def subscribe(self, user: str, listener: Callable[[dict], None]):
+        """
+        Register a listener for the status events of a user.
+
+        :param user: user id (sub).
+        :param listener: called with every event published on the channel of the user.
+        """
+        self.ensure_started()
+        self.listeners[user].add(listener)
+
+    def unsubscribe(self, user: str, listener: Callable[[dict], None]):
+        listeners = self.listeners.get(user)
+        if listeners is None:
+            return
+        listeners.discard(listener)
+        if not listeners:
+            del self.listeners[user]
+
+    @property
+    def listener_count(self) -> int:
+        return sum(len(listeners) for listeners in self.listeners.values())
+
+    async def _read(self):
+        while True:
+            try:
+                channel, = await self.redis.psubscribe(CHANNEL_PATTERN)
+                log.info(f'Listening to channels: {CHANNEL_PATTERN!r}')
+                while await channel.wait_message():
+                    channel_name, message = await channel.get(encoding='utf-8')
+                    self._dispatch(channel_name.decode()[len(CHANNEL_PREFIX):], message)
+                log.warning('Status subscription closed.')
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.error(f'Status subscription failed: {e}')
+            await asyncio.sleep(RESUBSCRIBE_DELAY)
+
+    def _dispatch(self, user: str, message: str):
+        listeners = list(self.listeners.get(user, ()))
+        if not listeners:
+            return
+        try:
+            event = json.loads(message)
+        except ValueError:
+            log.error(f'Invalid status message: {message!r}')
+            return
+        for listener in listeners:
+            try:
+                listener(event)
+            except Exception as e:
+                log.error(f'Could not deliver status message to listener: {e}')
@@ -1,5 +1,5 @@
 import re
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Callable
 
 import pandas
 from pandas import DataFrame
@@ -26,6 +26,15 @@ ID_COLUMN_MAPPING = {SUBJECT_ID_FIELD: 'Subject Id',
                      }
 ID_COLUMNS = ID_COLUMN_MAPPING.values()
 COLUMN_ORDER_BY_CONCEPT_CODE_PREFIX = ['Individual'] + list(ID_COLUMN_MAPPING.keys())[1:]
+MERGE_STEP_ROWS = 10000  # number of rows merged between calls of the step callback
+DATE_COLUMN_PATTERN = re.compile(r'.*\bdate\b.*', flags=re.IGNORECASE)
+
+StepCallback = Optional[Callable[[], None]]
+
+
+def _step(on_step: StepCallback):
+    if on_step is not None:
+        on_step()
 
 
 def get_id_columns(df: DataFrame) -> List[str]:
@@ -43,7 +52,13 @@ def from_obs_json_to_export_csr_df(obs_json: Dict) -> DataFrame:
     return df
 
 
-def transform_obs_df(df: DataFrame) -> DataFrame:
+def transform_obs_df(df: DataFrame, on_step: StepCallback = None) -> DataFrame:
+    """
+    :param df: observations dataframe
+    :param on_step: optional callback, called between the steps of the transformation,
+    e.g., to check if the task is cancelled.
+    :return: data frame with the id columns as index, and a column per concept.
+    """
     concept_pat_to_name = _concept_path_to_name(df)
     # Transform sample data and data outside of the sample hierarchy (study, radiology) separately
     sample_df = df
@@ -69,34 +84,37 @@ def transform_obs_df(df: DataFrame) -> DataFrame:
         study_df.drop(columns=non_study_columns, inplace=True)
 
     # Transform sample data
-    df = from_obs_df_to_csr_df(sample_df)
+    df = from_obs_df_to_csr_df(sample_df, on_step)
 
     # Transform Radiology data and merge back with Sample data
     if radiology_df is not None:
         empty_diagnosis_in_sample_df = 'Diagnosis Id' in df.index.names \
                                 and all(x == '' for x in df.copy().reset_index()['Diagnosis Id'].values)
         if 'Diagnosis Id' not in df.index.names or empty_diagnosis_in_sample_df:
-            df = merge_non_hierarchical_entity_df(df, radiology_df, 'Radiology Id', ['Subject Id'])
+            df = merge_non_hierarchical_entity_df(df, radiology_df, 'Radiology Id', ['Subject Id'], on_step)
             # If diagnosis-related concepts are not part of sample data, Diagnosis ID column should not be included in results
             if empty_diagnosis_in_sample_df is True:
                 df.drop(columns=['Diagnosis Id'], inplace=True)
             df.set_index(get_id_columns(df), inplace=True)
         else:
-            df = merge_non_hierarchical_entity_df(df, radiology_df, 'Radiology Id', ['Subject Id', 'Diagnosis Id'])
+            df = merge_non_hierarchical_entity_df(df, radiology_df, 'Radiology Id', ['Subject Id', 'Diagnosis Id'],
+                                                  on_step)
             df.set_index(get_id_columns(df), inplace=True)
 
     # Transform Study data and merge back with Sample data
     if study_df is not None:
-        df = merge_non_hierarchical_entity_df(df, study_df, 'Study Id', ['Subject Id'])
+        df = merge_non_hierarchical_entity_df(df, study_df, 'Study Id', ['Subject Id'], on_step)
         df.set_index(get_id_columns(df), inplace=True)
 
+    _step(on_step)
     df = df.rename(index=str, columns=concept_pat_to_name)
-    df = format_columns(df)
+    df = format_columns(df, on_step)
     return df
 
 
-def merge_non_hierarchical_entity_df(df: DataFrame, entity_df: Optional[DataFrame], id_column: str, merge_columns: List[str]) -> DataFrame:
-    entity_df = from_obs_df_to_csr_df(entity_df)
+def merge_non_hierarchical_entity_df(df: DataFrame, entity_df: Optional[DataFrame], id_column: str, merge_columns: List[str],
+                                     on_step: StepCallback = None) -> DataFrame:
+    entity_df = from_obs_df_to_csr_df(entity_df, on_step)
     if df.empty:
         df = entity_df
         df.reset_index(inplace=True)
@@ -104,10 +122,11 @@ def merge_non_hierarchical_entity_df(df: DataFrame, entity_df: Optional[DataFram
 
     # Merge non-hierarchical entity data into df, creating a cross-product
     entity_df[id_column] = entity_df.index.get_level_values(id_column)
+    _step(on_step)
     return df.reset_index().merge(entity_df, on=merge_columns, how='outer').fillna('')
 
 
-def from_obs_df_to_csr_df(obs: DataFrame) -> DataFrame:
+def from_obs_df_to_csr_df(obs: DataFrame, on_step: StepCallback = None) -> DataFrame:
     if obs.empty:
         logger.warning('Hypercube is empty! Returning empty result.')
         return obs
@@ -126,11 +145,13 @@ def from_obs_df_to_csr_df(obs: DataFrame) -> DataFrame:
     logger.info('Reformatting columns...')
     id_columns = get_id_columns(obs)
     obs = _reformat_columns(obs, id_columns)
+    _step(on_step)
     # Transform concept rows to column headers
     obs_pivot = _concepts_row_to_columns(obs)
+    _step(on_step)
     # Propagate data to lower levels and display only rows that represent the lowest level,
     # e.g., add subject-level data to diagnosis rows and remove the subject-level row
-    obs_pivot = _merge_redundant_rows(obs_pivot, id_columns)
+    obs_pivot = _merge_redundant_rows(obs_pivot, id_columns, on_step)
     # Set columns order to identifiers first and then concepts
     obs_pivot = obs_pivot[id_columns + unq_concept_paths_ord]
     # Replace NAs and NANs in index columns with empty string
@@ -144,15 +165,17 @@ def _concept_path_to_name(df: DataFrame) -> dict:
     return dict(zip(df['concept.conceptPath'], df['concept.name']))
 
 
-def format_columns(df: DataFrame) -> DataFrame:
+def format_columns(df: DataFrame, on_step: StepCallback = None) -> DataFrame:
     """
     :param df: pandas dataframe with various data types of columns
+    :param on_step: optional callback, called after each column
     :return: modified data frame with all columns converted to formatted string
     """
     result_df = DataFrame()
     for col_num, col in enumerate(df.columns):
+        _step(on_step)
         # update datetime fields
-        if re.match(r'.*\bdate\b.*', col, flags=re.IGNORECASE):
+        if DATE_COLUMN_PATTERN.match(col):
             result_df[col_num] = df.iloc[:, col_num].apply(_to_datetime)
         elif numpy.issubdtype(df.iloc[:, col_num].dtype, numpy.number):
             result_df[col_num] = df.iloc[:, col_num].apply(_num_to_str)
@@ -171,13 +194,15 @@ def _num_to_str(x):
     return str(x)
 
 
-def _merge_redundant_rows(data: DataFrame, id_columns: List[str]) -> DataFrame:
+def _merge_redundant_rows(data: DataFrame, id_columns: List[str], on_step: StepCallback = None) -> DataFrame:
     if data.empty:
         return data
     # sort rows by identifying columns, merging of rows strongly depends on sorting
     rows = data.sort_values(id_columns, na_position='last').to_dict('records')
     result_rows = [rows[0]]
-    for row in rows[1:]:
+    for row_num, row in enumerate(rows[1:], 1):
+        if row_num % MERGE_STEP_ROWS == 0:
+            _step(on_step)
         row_copied = False
         for result_row in reversed(result_rows):
             if _is_ancestor_row(row, result_row, id_columns):
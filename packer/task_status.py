@@ -1,6 +1,9 @@
 import json
 import abc
+import time
+from typing import List, Optional
 
+from packer.config import task_config
 from packer.redis_client import redis
 
 
@@ -13,11 +16,88 @@ class Status:
     FAILED = 'FAILED'
 
 
+def channel_name(user: str) -> str:
+    """ Pub/sub channel for live status events of the jobs of a user. """
+    return f'channel:{user}'
+
+
+def events_key(user: str) -> str:
+    """ Capped Redis stream with recent status events of the jobs of a user. """
+    return f'events:{user}'
+
+
+def status_key(task_id: str) -> str:
+    """ Redis key of the status of a task. """
+    return f'job_status:{task_id}'
+
+
+def event_id_key(event_id: str) -> tuple:
+    """ Sort key for Redis stream entry ids, e.g., '1526919030474-55'. """
+    milliseconds, _, sequence = event_id.partition('-')
+    return int(milliseconds), int(sequence or 0)
+
+
+class Progress:
+    """
+    Quantitative progress of a running task: the fraction of the work done and counters
+    for bytes downloaded from tranSMART, observation rows decoded and export rows written.
+    The estimated time remaining is derived from the fraction done and the elapsed time.
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.sent_at = None
+        self.fraction = 0.0
+        self.bytes_downloaded = 0
+        self.bytes_total = None
+        self.rows_decoded = 0
+        self.rows_written = 0
+        self.rows_total = None
+
+    def update(self, fraction: Optional[float] = None, **counters):
+        if fraction is not None:
+            self.fraction = min(max(fraction, 0.0), 1.0)
+        for counter, value in counters.items():
+            if not hasattr(self, counter):
+                raise ValueError(f'Unknown progress counter: {counter!r}')
+            setattr(self, counter, value)
+
+    def eta(self) -> Optional[float]:
+        """ Estimated number of seconds remaining, None if unknown. """
+        if self.fraction >= 1.0:
+            return 0.0
+        if self.fraction <= 0.0:
+            return None
+        elapsed = time.time() - self.started_at
+        return elapsed * (1.0 - self.fraction) / self.fraction
+
+    def is_due(self, interval: float) -> bool:
+        """ True if the last update was sent more than interval seconds ago. """
+        return self.sent_at is None or time.time() - self.sent_at >= interval
+
+    def mark_sent(self):
+        self.sent_at = time.time()
+
+    def as_dict(self) -> dict:
+        eta = self.eta()
+        return {
+            'fraction': round(self.fraction, 4),
+            'bytes_downloaded': self.bytes_downloaded,
+            'bytes_total': self.bytes_total,
+            'rows_decoded': self.rows_decoded,
+            'rows_written': self.rows_written,
+            'rows_total': self.rows_total,
+            'elapsed_seconds': round(time.time() - self.started_at, 1),
+            'eta_seconds': None if eta is None else round(eta, 1),
+        }
+
+
 class TaskStatusABC(metaclass=abc.ABCMeta):
 
     def __init__(self, task_id):
         self.task_id = task_id
-        self.key = f'job_status:{self.task_id}'
+        self.key = status_key(self.task_id)
+        self.cancel_key = f'cancel:{self.task_id}'
 
     @abc.abstractmethod
     def create(self, **kwargs):
@@ -25,7 +105,7 @@ class TaskStatusABC(metaclass=abc.ABCMeta):
 
     @abc.abstractmethod
     def update(self, **kwargs):
-        """ Update key-value pairs in kwargs """
+        """ Update key-value pairs in kwargs and increment the version """
 
     @abc.abstractmethod
     def get(self):
@@ -36,12 +116,15 @@ class TaskStatus(TaskStatusABC):
 
     def create(self, **kwargs):
         kwargs['task_id'] = self.task_id
+        kwargs.setdefault('version', 1)
         redis.set(self.key, json.dumps(kwargs))
 
     def update(self, **kwargs):
         obj = self.get()
         obj.update(**kwargs)
+        obj['version'] = obj.get('version', 0) + 1
         self.create(**obj)
+        return obj
 
     def get(self):
         try:
@@ -49,6 +132,25 @@ class TaskStatus(TaskStatusABC):
         except TypeError:
             return {}
 
+    def is_cancel_requested(self) -> bool:
+        return bool(redis.exists(self.cancel_key))
+
+    def publish(self, user: str, event: dict) -> str:
+        """
+        Append a status event to the event stream of the user, so that clients can replay
+        events they missed, and publish it on the channel of the user.
+
+        :param user: user id (sub) the task belongs to.
+        :param event: status event.
+        :return: id of the event in the event stream.
+        """
+        key = events_key(user)
+        event_id = redis.xadd(key, {'event': json.dumps(event)},
+                              maxlen=task_config['events_max_len'], approximate=True)
+        redis.expire(key, task_config['events_ttl'])
+        redis.publish(channel_name(user), json.dumps(dict(event, event_id=event_id)))
+        return event_id
+
 
 class TaskStatusAsync(TaskStatusABC):
 
@@ -58,14 +160,67 @@ class TaskStatusAsync(TaskStatusABC):
 
     async def create(self, **kwargs):
         kwargs['task_id'] = self.task_id
+        kwargs.setdefault('version', 1)
         await self.redis.set(self.key, json.dumps(kwargs))
 
     async def update(self, **kwargs):
         obj = await self.get()
         obj.update(**kwargs)
+        obj['version'] = obj.get('version', 0) + 1
         await self.create(**obj)
+        return obj
+
+    async def publish(self, user: str, event: dict) -> str:
+        """
+        Append a status event to the event stream of the user and publish it on the channel of the user,
+        see :meth:`TaskStatus.publish`.
+
+        :return: id of the event in the event stream.
+        """
+        key = events_key(user)
+        event_id = await self.redis.xadd(key, {'event': json.dumps(event)}, max_len=task_config['events_max_len'])
+        await self.redis.expire(key, task_config['events_ttl'])
+        await self.redis.publish(channel_name(user), json.dumps(dict(event, event_id=event_id)))
+        return event_id
+
+    async def update_and_publish(self, **kwargs):
+        """
+        Update the status, as :meth:`update`, and publish it, so that websockets and long-polling
+        requests see status changes made by the API server as they see those of the workers.
+        """
+        obj = await self.update(**kwargs)
+        event = {
+            'task_id': self.task_id,
+            'status': obj.get('status'),
+            'message': obj.get('message'),
+            'progress': obj.get('progress')
+        }
+        if 'queue_position' in kwargs:
+            event['queue_position'] = kwargs['queue_position']
+        await self.publish(obj['user'], event)
+        return obj
+
+    async def request_cancel(self):
+        """ Ask the worker that runs the task to stop at the next cancellation check. """
+        await self.redis.set(self.cancel_key, 1, expire=task_config['events_ttl'])
+
+    async def is_cancel_requested(self) -> bool:
+        return bool(await self.redis.exists(self.cancel_key))
 
     async def get(self):
         status = await self.redis.get(self.key)
         return json.loads(status)
 
+
+async def get_statuses(redis_loop, task_ids: List[str]) -> List[Optional[dict]]:
+    """
+    Get the statuses of several tasks with a single MGET.
+
+    :param redis_loop: async Redis client.
+    :param task_ids: ids of the tasks.
+    :return: the statuses in the order of the task ids, None for tasks without status.
+    """
+    if not task_ids:
+        return []
+    statuses = await redis_loop.mget(*[status_key(task_id) for task_id in task_ids])
+    return [None if status is None else json.loads(status) for status in statuses]
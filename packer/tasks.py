@@ -1,30 +1,68 @@
 import abc
+import gzip
+import hashlib
 import logging
 import os
+import pickle
+import shutil
+import sys
+import time
 
 import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from celery import Celery, Task
+import pandas as pd
+from celery import Task, states
+from billiard.exceptions import WorkerLostError
+from billiard.pool import EX_RECYCLE
 from celery.exceptions import SoftTimeLimitExceeded, Ignore
+from celery.signals import task_failure, task_postrun, task_revoked, celeryd_after_setup, worker_process_init
+from requests.exceptions import ConnectionError, Timeout
+
+from packer.file_handling import FSHandler
+from packer.task_status import Status, TaskStatus, Progress, channel_name
+from packer import admission, auth, coalescing, fetch_planner, http_client, metrics, result_cache, warmup
+from packer.redis_client import redis
+from packer.memory_watchdog import MemoryBudgetExceeded, watch
+from packer.routing import DEFAULT_RESOURCE_CLASS, get_resource_class
+# The app is re-exported for the job modules and for `celery -A packer.tasks`.
+from packer.celery_app import app  # noqa: F401
+from .config import task_config, transmart_config, fetch_config
+
+try:
+    from transmart.api.v2.data_structures import ObservationSet
+except ImportError as e:
+    logging.warning(f'Import errors for {__file__!r}: {str(e)}')
 
-from packer.task_status import Status, TaskStatus
-from packer import auth
-from .config import redis_config, task_config, celery_config, transmart_config, http_config
-from .redis_client import redis
+logger = logging.getLogger(__name__)
 
-import requests
+FETCH_CHUNK_SIZE = 1024 * 1024  # 1 MiB chunks of the observations response
+CANCEL_CHECK_INTERVAL = 0.5  # minimum number of seconds between checks for cancellation
 
-logger = logging.getLogger(__name__)
+# Set in the processes of a prefork pool, which are replaced when they exit.
+pool_process = False
 
 
-app = Celery('tasks', broker=redis_config['url'])
-app.conf.update(**celery_config)
-app.autodiscover_tasks(['packer.jobs'], 'jobs')
+class TaskCancelled(Exception):
+    """ Raised in a task at a cancellation check after the task has been cancelled. """
+
 
 os.makedirs(task_config['data_dir'], exist_ok=True)
 
 
 class BaseDataTask(Task, metaclass=abc.ABCMeta):
+    # Retry on connection problems, completed stages are not repeated.
+    autoretry_for = (ConnectionError, Timeout)
+    retry_backoff = True
+    max_retries = 3
+    # Resource class of the job, decides the queue and the workers that run it, see packer.routing.
+    resource_class = DEFAULT_RESOURCE_CLASS
+    # Memory budget in MiB, overrides the budget of the resource class.
+    memory_budget = None
+
+    @property
+    def acks_late(self):
+        return get_resource_class(self.resource_class)['acks_late']
 
     def on_success(self, retval, task_id, args, kwargs):
         """Success handler.
@@ -40,7 +78,10 @@ class BaseDataTask(Task, metaclass=abc.ABCMeta):
         Returns:
             None: The return value of this handler is ignored.
         """
+        self.progress.update(fraction=1.0)
         self.update_status(status=Status.SUCCESS, message='Task finished successfully.')
+        shutil.rmtree(self.get_data_dir(create=False), ignore_errors=True)
+        result_cache.store(redis, self.task_status.get())
 
     def on_retry(self, exc, task_id, args, kwargs, einfo):
         """Retry handler.
@@ -57,6 +98,10 @@ class BaseDataTask(Task, metaclass=abc.ABCMeta):
         Returns:
             None: The return value of this handler is ignored.
         """
+        self.update_status(
+            status=Status.RUNNING,
+            message=f'Retrying task after {exc.__class__.__name__}: {exc}'
+        )
 
     def on_failure(self, exc, task_id, args, kwargs, einfo):
         """Error handler.
@@ -73,11 +118,30 @@ class BaseDataTask(Task, metaclass=abc.ABCMeta):
         Returns:
             None: The return value of this handler is ignored.
         """
-        if type(exc) == SoftTimeLimitExceeded:
+        watchdog = getattr(self.request, 'memory_watchdog', None)
+        if watchdog is not None and watchdog.interrupted:
+            # The task may have been interrupted while it waited for a Redis reply.
+            redis.connection_pool.disconnect()
+        self.remove_result()
+        remove_expired_work_dirs()
+        if type(exc) == TaskCancelled:
+            shutil.rmtree(self.get_data_dir(create=False), ignore_errors=True)
+            self.update_status(
+                status=Status.CANCELLED,
+                message='Task cancelled during execution.'
+            )
+        elif type(exc) == SoftTimeLimitExceeded:
             self.update_status(
                 status=Status.CANCELLED,
                 message='Task cancelled during execution or task passed time limit.'
             )
+        elif type(exc) == MemoryBudgetExceeded:
+            self.request.memory_budget_exceeded = True
+            self.update_status(
+                status=Status.FAILED,
+                message=f'Task used more memory than its budget of {self.get_memory_budget()} MiB. '
+                        f'Try to export less data at once.'
+            )
         else:
             self.update_status(
                 status=Status.FAILED,
@@ -100,11 +164,48 @@ class BaseDataTask(Task, metaclass=abc.ABCMeta):
         """
 
     def __call__(self, *args, **kwargs):
+        self.check_cancelled(force=True)
         self.update_status(status=Status.RUNNING, message=f'Starting task.')
-        super().__call__(*args, **kwargs)
+        with watch(self.get_memory_budget(), task_config['memory_check_interval'],
+                   task_config['memory_abort_delay']) as watchdog:
+            self.request.memory_watchdog = watchdog
+            super().__call__(*args, **kwargs)
+
+    def get_memory_budget(self):
+        """ :return: memory budget of the task in MiB, of the resource class selected for the job. """
+        if self.memory_budget:
+            return self.memory_budget
+        resource_class = self.task_status.get().get('resource_class') or self.resource_class
+        return get_resource_class(resource_class)['memory_budget']
+
+    def check_cancelled(self, force=False):
+        """
+        Cancellation check, to call at chunk boundaries of long running steps.
+        Redis is checked at most once per ``CANCEL_CHECK_INTERVAL`` seconds, unless forced.
+
+        :raises TaskCancelled: if the task has been cancelled.
+        :raises MemoryBudgetExceeded: if the task has used more memory than its budget.
+        """
+        watchdog = getattr(self.request, 'memory_watchdog', None)
+        if watchdog is not None:
+            watchdog.check()
+        now = time.monotonic()
+        if not force and now - getattr(self.request, 'cancel_checked_at', 0) < CANCEL_CHECK_INTERVAL:
+            return
+        self.request.cancel_checked_at = now
+        if self.task_status.is_cancel_requested():
+            logger.info(f'Task {self.task_id} has been cancelled.')
+            raise TaskCancelled()
+
+    def remove_result(self):
+        """ Remove the (partially written) result file of the task. """
+        path = FSHandler(self.task_id).path
+        if os.path.exists(path):
+            os.remove(path)
 
     def get_data_dir(self, create=True):
-        path = os.path.join(task_config['data_dir'], self.task_id)
+        """ Working directory of the task, for intermediate results. """
+        path = os.path.join(task_config['data_dir'], 'work', self.task_id)
         if create:
             os.makedirs(path, exist_ok=True)
         return path
@@ -120,10 +221,23 @@ class BaseDataTask(Task, metaclass=abc.ABCMeta):
     def task_status(self):
         return TaskStatus(self.task_id)
 
+    @property
+    def job_type(self):
+        """ Name of the job in the job registry. """
+        return self.name.rsplit('.', 1)[-1]
+
     @property
     def channel(self):
         obj = self.task_status.get()
-        return f'channel:{obj.get("user")}'
+        return channel_name(obj.get('user'))
+
+    @property
+    def progress(self) -> Progress:
+        """ Progress of the current execution, kept on the request context. """
+        progress = getattr(self.request, 'progress', None)
+        if progress is None:
+            progress = self.request.progress = Progress()
+        return progress
 
     def update_status(self, status, message):
         """
@@ -132,35 +246,186 @@ class BaseDataTask(Task, metaclass=abc.ABCMeta):
         :param status: status code.
         :param message: message for client.
         """
-        self.task_status.update(status=status, message=message)
+        progress = self.progress
+        progress.mark_sent()
+        self.task_status.update(status=status, message=message, progress=progress.as_dict())
         logger.info(f'Status update for {self.task_id}: {message} ({status})')
-        redis.publish(
-            self.channel,
-            json.dumps({
-                'task_id': self.task_id,
-                'status': status,
-                'message': message
-            })
-        )
+        self.publish(status, message, progress.as_dict())
+
+    def update_progress(self, fraction=None, force=False, **counters):
+        """
+        Update the quantitative progress of the task in Redis and send it through websocket.
+        Updates are sent at most once per ``progress_interval`` seconds, unless forced.
 
-    def observations_json(self, constraint):
+        :param fraction: fraction of the task that is done, between 0 and 1.
+        :param force: send the update, even if the previous one was sent recently.
+        :param counters: progress counters to set, e.g., bytes_downloaded, rows_decoded, rows_written.
+        """
+        self.check_cancelled()
+        progress = self.progress
+        progress.update(fraction=fraction, **counters)
+        if not force and not progress.is_due(task_config['progress_interval']):
+            return
+        progress.mark_sent()
+        obj = self.task_status.update(progress=progress.as_dict())
+        self.publish(obj.get('status'), obj.get('message'), obj['progress'])
+
+    def publish(self, status, message, progress=None):
+        user = self.task_status.get().get('user')
+        self.task_status.publish(user, {
+            'task_id': self.task_id,
+            'status': status,
+            'message': message,
+            'progress': progress
+        })
+
+    def decode_observations(self, obs_json, fraction=None):
+        """
+        Decode the observations hypercube to a dataframe with one row per observation.
+
+        :param obs_json: response body (json) of the observation call of transmart API
+        :param fraction: fraction of the task that is done after decoding.
+        :return: observations dataframe
+        """
+        self.check_cancelled()
+        obs_df = ObservationSet(obs_json).dataframe
+        self.update_progress(fraction=fraction, rows_decoded=len(obs_df), force=True)
+        return obs_df
+
+    def rows_written_callback(self, fraction_range=(0.8, 1.0)):
+        """
+        :param fraction_range: fractions of the task that are done before and after writing.
+        :return: callback for :func:`packer.export.save` that reports the rows written.
         """
+        start, end = fraction_range
+
+        def on_rows_written(rows_written, rows_total):
+            fraction = start + (end - start) * rows_written / rows_total if rows_total else end
+            self.update_progress(fraction=fraction, rows_written=rows_written, rows_total=rows_total)
+
+        return on_rows_written
+
+    def observations_json(self, constraint, fraction_range=(0.0, 0.5)):
+        """
+        Observations are spooled to the data directory of the task, a retried or resumed
+        task reads them from there instead of fetching them again.
+
         :param self: Required for bind to BaseDataTask
         :param constraint: transmart API constraint to request
+        :param fraction_range: fractions of the task that are done before and after the fetch,
+        or None to not report progress.
         :return: response body (json) of the observation call of transmart API
         """
+        path = self.spool_path(constraint)
+        if os.path.exists(path):
+            logger.info(f'Reading spooled observations from {path}.')
+            if fraction_range is not None:
+                self.update_progress(fraction=fraction_range[1], force=True)
+        else:
+            self.fetch_observations(constraint, path, fraction_range)
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            return json.load(f)
+
+    def observations_dataframe(self, constraint, fraction_range=(0.0, 0.5)):
+        """
+        Fetch and decode the observations for a constraint. If a partition size is configured,
+        the constraint is split into subject partitions that are fetched concurrently.
+
+        :param constraint: transmart API constraint to request
+        :param fraction_range: fractions of the task that are done before fetching and after decoding.
+        :return: observations dataframe
+        """
+        start, end = fraction_range
+        partitions = [constraint]
+        if fetch_config['partition_size'] > 0:
+            partitions = fetch_planner.plan_partitions(
+                constraint, self.patient_ids(constraint), fetch_config['partition_size'])
+        if len(partitions) == 1:
+            fetched = start + (end - start) * 0.8
+            return self.decode_observations(self.observations_json(constraint, (start, fetched)), fraction=end)
+
+        self.update_status(Status.FETCHING, f'Getting observations in {len(partitions)} partitions.')
+        frames = []
+        with ThreadPoolExecutor(max_workers=fetch_config['max_concurrency']) as executor:
+            futures = [executor.submit(self.partition_dataframe, partition, self.request) for partition in partitions]
+            for future in as_completed(futures):
+                frames.append(future.result())
+                fraction = start + (end - start) * len(frames) / len(partitions)
+                self.update_progress(fraction=fraction, rows_decoded=sum(len(df) for df in frames))
+        obs_df = pd.concat(frames, ignore_index=True, sort=False)
+        self.update_progress(fraction=end, rows_decoded=len(obs_df), force=True)
+        return obs_df
+
+    def partition_dataframe(self, constraint, request):
+        """
+        Fetch and decode the observations of a partition in a thread of the fetch pool,
+        without reporting progress.
+
+        :param constraint: transmart API constraint of the partition.
+        :param request: request context of the task, the request stack is thread local.
+        """
+        self.request_stack.push(request)
+        try:
+            obs_json = self.observations_json(constraint, fraction_range=None)
+            self.check_cancelled()
+            return ObservationSet(obs_json).dataframe
+        finally:
+            self.request_stack.pop()
+
+    def patient_ids(self, constraint):
+        """
+        :param constraint: transmart API constraint.
+        :return: sorted ids of the patients that have observations for the constraint.
+        """
+        r = self.transmart_post('/v2/patients', {'constraint': constraint})
+        return sorted(patient['id'] for patient in r.json()['patients'])
+
+    def spool_path(self, constraint):
+        """ :return: path of the spooled observations for the constraint. """
+        digest = hashlib.sha1(json.dumps(constraint, sort_keys=True).encode('utf-8')).hexdigest()
+        return os.path.join(self.get_data_dir(), f'observations-{digest}.json.gz')
+
+    def fetch_observations(self, constraint, path, fraction_range):
+        """
+        Fetch observations from transmart and write the gzip compressed response body to path.
+        """
+        if fraction_range is not None:
+            self.update_status(Status.FETCHING, f'Getting data from observations from '
+                                                f'{transmart_config.get("host")!r}')
+        r = self.transmart_post('/v2/observations', {'type': 'clinical', 'constraint': constraint},
+                                headers={'Accept-Encoding': 'gzip'}, stream=True)
+        part_path = f'{path}.part'
+        with r:
+            # tranSMART may take long to start the response.
+            self.check_cancelled()
+            with open(part_path, 'wb') as f:
+                self._download(r, f, fraction_range)
+        os.replace(part_path, path)
+
+    def transmart_post(self, path, body, headers=None, **kwargs):
+        """
+        Post a request to transmart on behalf of the user of the task.
+        The task fails if the request is not successful.
+
+        :param path: path of the transmart API call, e.g., /v2/observations
+        :param body: request body (json)
+        :param headers: additional request headers
+        :return: response
+        """
         user = self.task_status.get().get('user')
         token = auth.get_impersonated_token_for_user(user)
-        handle = f'{transmart_config.get("host")}/v2/observations'
-        self.update_status(Status.FETCHING, f'Getting data from observations from {handle!r}')
-        r = requests.post(url=handle,
-                          json={'type': 'clinical', 'constraint': constraint},
-                          headers={
-                              'Authorization': f'Bearer {token}'
-                          },
-                          verify=http_config.get('verify_cert'))
+        handle = f'{transmart_config.get("host")}{path}'
+        r = http_client.post(url=handle,
+                             json=body,
+                             headers={
+                                 'Authorization': f'Bearer {token}',
+                                 'Accept': 'application/json',
+                                 **(headers or {})
+                             },
+                             **kwargs)
         if r.status_code == 401:
             logger.error('Export failed. Unauthorized.')
+            auth.invalidate_impersonated_token_for_user(user)
             self.update_status(Status.FAILED, 'Unauthorized.')
             raise Ignore()
         if not r.ok:
@@ -168,4 +433,184 @@ class BaseDataTask(Task, metaclass=abc.ABCMeta):
             self.update_status(Status.FAILED, f'Connection error occurred when fetching {handle}. '
                                               f'Response status {r.status_code}')
             raise Ignore()
-        return r.json()
+        return r
+
+    def _download(self, response, file, fraction_range=None):
+        total = int(response.headers.get('Content-Length', 0)) or None
+        if response.headers.get('Content-Encoding', '').lower() == 'gzip':
+            # Store the compressed body as is.
+            chunks, writer = response.raw.stream(FETCH_CHUNK_SIZE, decode_content=False), file
+        else:
+            chunks, writer = response.iter_content(chunk_size=FETCH_CHUNK_SIZE), gzip.GzipFile(fileobj=file, mode='wb')
+        with writer:
+            for chunk in chunks:
+                writer.write(chunk)
+                if fraction_range is None:
+                    self.check_cancelled()
+                    continue
+                start, end = fraction_range
+                # Count bytes on the wire, before content decoding, to match Content-Length.
+                downloaded = response.raw.tell()
+                fraction = start + (end - start) * downloaded / total if total else None
+                self.update_progress(fraction=fraction, bytes_downloaded=downloaded, bytes_total=total)
+        if fraction_range is not None:
+            self.update_progress(fraction=fraction_range[1], bytes_downloaded=response.raw.tell(), force=True)
+
+    def checkpoint(self, stage, compute):
+        """
+        Result of a stage of the job, stored in the data directory of the task,
+        so that a retried or resumed task continues after the last completed stage.
+
+        :param stage: name of the stage, unique within the job.
+        :param compute: function that computes the result of the stage.
+        :return: result of the stage.
+        """
+        path = os.path.join(self.get_data_dir(), f'{stage}.pickle')
+        if os.path.exists(path):
+            logger.info(f'Resuming from checkpoint {path}.')
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        start = time.monotonic()
+        result = compute()
+        metrics.STAGE_DURATION.observe(time.monotonic() - start, job_type=self.job_type, stage=stage)
+        part_path = f'{path}.part'
+        with open(part_path, 'wb') as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(part_path, path)
+        return result
+
+
+def remove_expired_work_dirs():
+    """
+    Remove the work directories of the jobs that have not been running for ``work_dir_ttl`` seconds,
+    e.g., of failed jobs that have not been resumed.
+    """
+    work_dir = os.path.join(task_config['data_dir'], 'work')
+    if not os.path.isdir(work_dir):
+        return
+    expired_before = time.time() - task_config['work_dir_ttl']
+    for task_id in os.listdir(work_dir):
+        path = os.path.join(work_dir, task_id)
+        try:
+            modified_at = max([os.path.getmtime(path)] + [entry.stat().st_mtime for entry in os.scandir(path)])
+        except OSError:
+            continue
+        if modified_at > expired_before \
+                or TaskStatus(task_id).get().get('status') in (Status.REGISTERED, Status.FETCHING, Status.RUNNING):
+            continue
+        logger.info(f'Removing the expired work directory of task {task_id}.')
+        shutil.rmtree(path, ignore_errors=True)
+
+
+@task_postrun.connect
+def release_admission_slot(sender=None, task_id=None, state=None, **kwargs):
+    """
+    Release the admission slot of a job when it has finished, also when it failed or was ignored,
+    and start the pending jobs that can be admitted.
+    """
+    if not isinstance(sender, BaseDataTask) or state == states.RETRY or not admission.enabled():
+        return
+    controller = admission.AdmissionController(redis)
+    controller.release(task_id, TaskStatus(task_id).get().get('user'))
+    admission.admit_pending(controller)
+
+
+@task_postrun.connect
+def release_inflight_job(sender=None, task_id=None, state=None, **kwargs):
+    """
+    Remove a finished job from the running jobs, so that an identical request starts a new job.
+    """
+    if not isinstance(sender, BaseDataTask) or state == states.RETRY:
+        return
+    status = TaskStatus(task_id).get()
+    if status.get('fingerprint'):
+        coalescing.release(redis, status['user'], status['fingerprint'], task_id)
+
+
+@task_postrun.connect
+def record_job_metrics(sender=None, task_id=None, state=None, **kwargs):
+    """ Count the finished job and record its duration. """
+    if not isinstance(sender, BaseDataTask) or state == states.RETRY:
+        return
+    status = TaskStatus(task_id).get().get('status')
+    metrics.JOBS_FINISHED.inc(job_type=sender.job_type, status=status)
+    metrics.JOB_DURATION.observe(time.time() - sender.progress.started_at, job_type=sender.job_type, status=status)
+    metrics.flush(redis)
+
+
+@task_revoked.connect
+def record_revoked_job(sender=None, **kwargs):
+    """ Count a job that was cancelled before it started. """
+    if not isinstance(sender, BaseDataTask):
+        return
+    metrics.JOBS_FINISHED.inc(job_type=sender.job_type, status=Status.CANCELLED)
+    metrics.flush(redis)
+
+
+@task_failure.connect
+def fail_lost_task(sender=None, task_id=None, exception=None, **kwargs):
+    """
+    Mark a job as failed if its worker process was lost, e.g., killed because it ran out of memory.
+    The worker process cannot report it, this runs in the main worker process.
+    A job that has finished before its process exited, see recycle_worker_process, keeps its status.
+    """
+    if not isinstance(sender, BaseDataTask) or not isinstance(exception, WorkerLostError):
+        return
+    task_status = TaskStatus(task_id)
+    if task_status.get().get('status') in (Status.SUCCESS, Status.FAILED, Status.CANCELLED):
+        return
+    message = 'The worker process of the task was lost, probably because it ran out of memory.'
+    status = task_status.update(status=Status.FAILED, message=message)
+    task_status.publish(status.get('user'), {
+        'task_id': task_id,
+        'status': Status.FAILED,
+        'message': message,
+        'progress': status.get('progress')
+    })
+    release_admission_slot(sender, task_id, Status.FAILED)
+    release_inflight_job(sender, task_id, Status.FAILED)
+    metrics.JOBS_FINISHED.inc(job_type=sender.job_type, status=Status.FAILED)
+    metrics.flush(redis)
+
+
+@celeryd_after_setup.connect
+def warm_up_worker(**kwargs):
+    """
+    Load the modules of the jobs in the main worker process, after logging is configured
+    and before the worker processes are forked.
+    """
+    if task_config['worker_warmup']:
+        warmup.warm_up_worker()
+
+
+@task_postrun.connect
+def recycle_worker_process(sender=None, task_id=None, **kwargs):
+    """
+    Replace a worker process after a task has exceeded its memory budget, because the memory it
+    has allocated may not be returned to the operating system. Connected after the other handlers.
+    The main worker process reports the task as lost, its status has been stored already.
+    """
+    if not pool_process or not isinstance(sender, BaseDataTask) \
+            or not getattr(sender.request, 'memory_budget_exceeded', False):
+        return
+    logger.warning(f'Replacing the worker process after task {task_id} exceeded its memory budget.')
+    sys.exit(EX_RECYCLE)
+
+
+@celeryd_after_setup.connect
+def clean_up_work_dirs(**kwargs):
+    """ Remove the expired work directories when a worker starts. """
+    remove_expired_work_dirs()
+
+
+@worker_process_init.connect
+def mark_pool_process(**kwargs):
+    global pool_process
+    pool_process = True
+
+
+@worker_process_init.connect
+def prime_worker_process(**kwargs):
+    """ Open the HTTP session and fetch the service token of a new worker process. """
+    if task_config['worker_warmup']:
+        warmup.prime_worker_process()
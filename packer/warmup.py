@@ -0,0 +1,88 @@
+"""
+Warm-up of the workers, so that the first jobs of a worker process run as fast as later ones.
+
+The main worker process imports the modules of the jobs and runs a small transformation before it
+forks the worker processes, so that these start with everything loaded. The loaded objects are
+excluded from garbage collection afterwards, which keeps their memory pages shared with the worker
+processes (copy-on-write). Every worker process then opens its HTTP session and fetches the Keycloak
+service token.
+"""
+import csv
+import gc
+import importlib
+import io
+import logging
+import pickle
+import threading
+import time
+
+from packer import auth, http_client
+from packer.config import keycloak_config
+
+logger = logging.getLogger(__name__)
+
+PRELOAD_MODULES = (
+    'numpy',
+    'pandas',
+    'transmart.api.v2.data_structures',
+    'packer.export',
+    'packer.table_transformations.csr_transformations',
+)
+
+
+def preload_modules():
+    for module in PRELOAD_MODULES:
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            logger.warning(f'Could not preload module {module}: {e}')
+
+
+def run_sample_transformation():
+    """
+    Transform and write a few observations, to load the parts of pandas that are imported
+    and initialised on first use.
+    """
+    import pandas as pd
+    from packer.table_transformations.csr_transformations import from_obs_df_to_csr_df
+
+    obs_df = pd.DataFrame([
+        [None, 'Individual.age', '\\01.Patient\\Age\\', 'Age', 42.0, 1, 'P1', None, 'WARMUP'],
+        ['D1', 'Diagnosis.name', '\\02.Diagnosis\\Diagnosis Name\\', 'Diagnosis Name',
+         None, 1, 'P1', 'Diagnosis 1 Name', 'WARMUP'],
+    ], columns=['Diagnosis', 'concept.conceptCode', 'concept.conceptPath', 'concept.name', 'numericValue',
+                'patient.id', 'patient.subjectIds.SUBJ_ID', 'stringValue', 'study.name'])
+    csr_df = pickle.loads(pickle.dumps(from_obs_df_to_csr_df(obs_df), protocol=pickle.HIGHEST_PROTOCOL))
+    csr_df.to_csv(io.StringIO(), sep='\t', index=False, quoting=csv.QUOTE_NONNUMERIC)
+
+
+def warm_up_worker():
+    """ Prepare the main worker process, before the worker processes are forked. """
+    started_at = time.monotonic()
+    preload_modules()
+    try:
+        run_sample_transformation()
+    except Exception as e:
+        logger.warning(f'Could not run the warm-up transformation: {e}')
+    gc.collect()
+    gc.freeze()
+    logger.info(f'Worker warmed up in {time.monotonic() - started_at:.2f} seconds, '
+                f'{gc.get_freeze_count()} objects frozen.')
+
+
+def fetch_service_token():
+    try:
+        auth.get_access_token_by_offline_token()
+    except Exception as e:
+        logger.warning(f'Could not fetch the Keycloak service token: {e}')
+
+
+def prime_worker_process():
+    """
+    Prepare a forked worker process. The session is created in the thread that runs the jobs.
+    The service token is fetched in the background, because the worker process has to report
+    that it started within a few seconds; a job that needs the token meanwhile waits for it.
+    """
+    http_client.get_session()
+    if keycloak_config.get('offline_token'):
+        threading.Thread(target=fetch_service_token, name='fetch-service-token', daemon=True).start()
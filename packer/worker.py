@@ -0,0 +1,23 @@
+import argparse
+import sys
+
+from packer.config import resource_class_config
+from packer.routing import worker_arguments
+
+
+def main(argv=None):
+    """
+    Start a Celery worker for the jobs of a resource class.
+    Additional arguments are passed to the celery worker, e.g., ``--loglevel info``.
+    """
+    parser = argparse.ArgumentParser(description='Start a transmart-packer worker.')
+    parser.add_argument('--resource-class', choices=sorted(resource_class_config), default='light',
+                        help='resource class of the jobs the worker runs (default: light)')
+    args, celery_args = parser.parse_known_args(argv)
+
+    from packer.celery_app import app
+    app.worker_main(worker_arguments(args.resource_class) + celery_args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
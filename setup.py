@@ -37,7 +37,10 @@ setup(
         'packer.table_transformations'
     ],
     entry_points={
-        'console_scripts': ['transmart-packer=packer.main:main'],
+        'console_scripts': [
+            'transmart-packer=packer.main:main',
+            'transmart-packer-worker=packer.worker:main'
+        ],
     },
     include_package_data=True,
     license="GNU General Public License v3 or later",
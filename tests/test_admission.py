@@ -0,0 +1,121 @@
+import asyncio
+import json
+import unittest
+from unittest import mock
+from uuid import uuid4
+
+from packer import admission
+from packer.redis_client import get_async_redis, redis
+from packer.task_status import TaskStatus
+
+
+class AdmissionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.controller = admission.AdmissionController(redis)
+        redis.delete(admission.RUNNING_KEY, admission.USERS_KEY)
+
+    def user(self):
+        return f'user-{uuid4()}'
+
+    def test_disabled_by_default(self):
+        self.assertFalse(admission.enabled())
+        self.assertEqual(0, self.controller.admit('task', 'user'))
+        self.assertFalse(redis.exists(admission.RUNNING_KEY))
+
+    @mock.patch.dict('packer.admission.admission_config', user_limit=2)
+    def test_user_limit(self):
+        user = self.user()
+        self.assertEqual(0, self.controller.admit('t1', user))
+        self.assertEqual(0, self.controller.admit('t2', user))
+        self.assertEqual(1, self.controller.admit('t3', user))
+        self.assertEqual(2, self.controller.admit('t4', user))
+        self.assertIsNone(self.controller.admit_next())
+        self.controller.release('t1', user)
+        self.controller.release('t1', user)
+        self.assertEqual(('t3', user), self.controller.admit_next())
+        self.assertIsNone(self.controller.admit_next())
+        self.assertTrue(self.controller.remove('t4', user))
+        self.controller.release('t2', user)
+        self.assertIsNone(self.controller.admit_next())
+
+    @mock.patch.dict('packer.admission.admission_config', global_limit=1)
+    def test_round_robin(self):
+        alice, bob = self.user(), self.user()
+        self.assertEqual(0, self.controller.admit('a1', alice))
+        self.assertEqual(1, self.controller.admit('a2', alice))
+        self.assertEqual(2, self.controller.admit('a3', alice))
+        self.assertEqual(2, self.controller.admit('b1', bob))
+        self.assertEqual(['a2', 'b1', 'a3'], self.controller.pending_order())
+        admitted = []
+        for task_id, user in [('a1', alice), ('a2', alice), ('b1', bob)]:
+            self.controller.release(task_id, user)
+            admitted.append(self.controller.admit_next()[0])
+        self.assertEqual(['a2', 'b1', 'a3'], admitted)
+        self.assertEqual([], self.controller.pending_order())
+
+    @mock.patch.dict('packer.admission.admission_config', global_limit=1, slot_ttl=0)
+    def test_slots_expire(self):
+        user = self.user()
+        self.assertEqual(0, self.controller.admit('t1', user))
+        self.assertEqual(0, self.controller.admit('t2', user))
+
+
+class AdmitPendingAsyncTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # The client schedules its commands on the current event loop.
+        previous_loop = asyncio.get_event_loop()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(asyncio.set_event_loop, previous_loop)
+        self.redis_loop = get_async_redis(self.loop)
+        self.addCleanup(self.loop.close)
+        self.addCleanup(lambda: self.loop.run_until_complete(self.redis_loop.wait_closed()))
+        self.addCleanup(self.redis_loop.close)
+        self.controller = admission.AdmissionController(redis)
+        redis.delete(admission.RUNNING_KEY, admission.USERS_KEY)
+        self.user = f'user-{uuid4()}'
+        self.task_ids = [str(uuid4()) for _ in range(5)]
+        for task_id in self.task_ids:
+            TaskStatus(task_id).create(user=self.user, job_type='add', job_parameters={})
+            self.addCleanup(redis.delete, TaskStatus(task_id).key)
+        patcher = mock.patch.object(admission, 'start_job')
+        self.start_job = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def admit_pending(self):
+        self.loop.run_until_complete(admission.admit_pending_async(admission.AdmissionControllerAsync(self.redis_loop)))
+
+    def started(self):
+        return [call[0][0] for call in self.start_job.call_args_list]
+
+    @mock.patch.dict('packer.admission.admission_config', global_limit=2)
+    def test_all_free_slots_are_filled(self):
+        for task_id in self.task_ids:
+            self.controller.admit(task_id, self.user)
+        for task_id in self.task_ids[:2]:
+            self.controller.release(task_id, self.user)
+        self.admit_pending()
+        self.assertEqual(self.task_ids[2:4], self.started())
+        self.assertIsNone(TaskStatus(self.task_ids[2]).get()['queue_position'])
+        self.assertEqual(1, TaskStatus(self.task_ids[4]).get()['queue_position'])
+        # The clients of the user are told about the admitted jobs and the new queue positions.
+        events = [json.loads(fields['event']) for _, fields in redis.xrange(f'events:{self.user}')]
+        self.addCleanup(redis.delete, f'events:{self.user}')
+        self.assertEqual(self.task_ids[2:], [event['task_id'] for event in events])
+        self.assertEqual([None, None, 1], [event['queue_position'] for event in events])
+
+    @mock.patch.dict('packer.admission.admission_config', global_limit=2)
+    def test_expired_slots_are_filled(self):
+        for task_id in self.task_ids[:3]:
+            self.controller.admit(task_id, self.user)
+        self.admit_pending()
+        self.assertEqual([], self.started())
+        with mock.patch.dict('packer.admission.admission_config', slot_ttl=0):
+            self.admit_pending()
+        self.assertEqual([self.task_ids[2]], self.started())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+import json
+import threading
+import time
+import unittest
+from unittest import mock
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jwt.algorithms import RSAAlgorithm
+
+from packer import auth
+from packer.config import keycloak_config
+
+
+def generate_key(kid):
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    jwk = json.loads(RSAAlgorithm.to_jwk(private_key.public_key()))
+    jwk.update(kid=kid, alg='RS256', use='sig')
+    return private_key, jwk
+
+
+def certs_response(*jwks):
+    response = mock.Mock(ok=True)
+    response.json.return_value = {'keys': list(jwks)}
+    return response
+
+
+class AuthTestCase(unittest.TestCase):
+
+    def setUp(self):
+        auth.verified_tokens.clear()
+        auth.public_keys.clear()
+        self.private_key, self.jwk = generate_key('key1')
+
+    def token(self, private_key=None, kid='key1', **claims):
+        claims = dict({'sub': 'user1', 'aud': keycloak_config['client_id'], 'exp': int(time.time()) + 60}, **claims)
+        return jwt.encode(claims, private_key or self.private_key, algorithm='RS256', headers={'kid': kid})
+
+    def test_authorize_caches_verified_token(self):
+        token = self.token()
+        with mock.patch.object(auth.http_client, 'get', return_value=certs_response(self.jwk)) as get, \
+                mock.patch.object(auth.jwt, 'decode', wraps=jwt.decode) as decode:
+            self.assertEqual('user1', auth.authorize(token)['sub'])
+            self.assertEqual('user1', auth.authorize(token)['sub'])
+        self.assertEqual(1, get.call_count)
+        self.assertEqual(1, decode.call_count)
+
+    def test_cached_token_expires(self):
+        token = self.token()
+        auth.verified_tokens.put(token, {'sub': 'user1', 'exp': time.time() - 1})
+        self.assertIsNone(auth.verified_tokens.get(token))
+
+    def test_cache_is_bounded(self):
+        cache = auth.VerifiedTokenCache(max_size=2, max_age=60)
+        for token in ['a', 'b', 'c']:
+            cache.put(token, {'sub': token})
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual({'sub': 'c'}, cache.get('c'))
+
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        other_key, other_jwk = generate_key('key2')
+        with mock.patch.object(auth.http_client, 'get', return_value=certs_response(self.jwk)) as get:
+            auth.authorize(self.token())
+            auth.public_keys.fetched_at -= auth.public_keys.min_refresh_interval
+            with self.assertRaises(ValueError):
+                auth.authorize(self.token(private_key=other_key, kid='key2'))
+            with self.assertRaises(ValueError):
+                auth.authorize(self.token(private_key=other_key, kid='key2', sub='user2'))
+        # One initial load, one refetch for the unknown kid.
+        self.assertEqual(2, get.call_count)
+
+    def test_failed_background_refresh_is_rate_limited(self):
+        with mock.patch.object(auth.http_client, 'get', return_value=certs_response(self.jwk)):
+            auth.authorize(self.token())
+        auth.public_keys.loaded_at -= auth.public_keys.ttl + 1
+        with mock.patch.object(auth.http_client, 'get', side_effect=ConnectionError) as get:
+            for sub in ('user2', 'user3', 'user4'):
+                self.assertEqual(sub, auth.authorize(self.token(sub=sub))['sub'])
+                while auth.public_keys.refreshing:
+                    time.sleep(0.01)
+        self.assertEqual(1, get.call_count)
+
+    def test_rotated_key_is_fetched(self):
+        other_key, other_jwk = generate_key('key2')
+        auth.public_keys.min_refresh_interval = 0
+        try:
+            with mock.patch.object(auth.http_client, 'get', side_effect=[certs_response(self.jwk),
+                                                                      certs_response(self.jwk, other_jwk)]):
+                auth.authorize(self.token())
+                self.assertEqual('user1', auth.authorize(self.token(private_key=other_key, kid='key2'))['sub'])
+        finally:
+            auth.public_keys.min_refresh_interval = keycloak_config['jwks_min_refresh_interval']
+
+
+def token_response(access_token, expires_in=300):
+    response = mock.Mock(ok=True)
+    response.json.return_value = {'access_token': access_token, 'expires_in': expires_in}
+    return response
+
+
+class AccessTokenCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        auth.access_tokens.clear()
+
+    def test_impersonated_token_is_cached(self):
+        with mock.patch.object(auth.http_client, 'post', side_effect=[token_response('offline'),
+                                                                   token_response('user1')]) as post:
+            self.assertEqual('user1', auth.get_impersonated_token_for_user('user1'))
+            self.assertEqual('user1', auth.get_impersonated_token_for_user('user1'))
+        self.assertEqual(2, post.call_count)
+
+    def test_offline_token_is_shared_between_users(self):
+        with mock.patch.object(auth.http_client, 'post', side_effect=[token_response('offline'),
+                                                                   token_response('user1'),
+                                                                   token_response('user2')]) as post:
+            self.assertEqual('user1', auth.get_impersonated_token_for_user('user1'))
+            self.assertEqual('user2', auth.get_impersonated_token_for_user('user2'))
+        self.assertEqual(3, post.call_count)
+
+    def test_token_is_refreshed_before_expiry(self):
+        margin = keycloak_config['token_refresh_margin']
+        with mock.patch.object(auth.http_client, 'post', side_effect=[token_response('offline'),
+                                                                   token_response('user1', margin / 2),
+                                                                   token_response('user1-new')]):
+            self.assertEqual('user1', auth.get_impersonated_token_for_user('user1'))
+            self.assertEqual('user1-new', auth.get_impersonated_token_for_user('user1'))
+
+    def test_invalidated_token_is_fetched_again(self):
+        with mock.patch.object(auth.http_client, 'post', side_effect=[token_response('offline'),
+                                                                   token_response('user1'),
+                                                                   token_response('user1-new')]):
+            self.assertEqual('user1', auth.get_impersonated_token_for_user('user1'))
+            auth.invalidate_impersonated_token_for_user('user1')
+            self.assertEqual('user1-new', auth.get_impersonated_token_for_user('user1'))
+
+    def test_tokens_of_other_users_are_fetched_concurrently(self):
+        cache = auth.AccessTokenCache(max_size=10, refresh_margin=0)
+        fetching, release = threading.Event(), threading.Event()
+        fetches = []
+
+        def slow_fetch():
+            fetches.append('user1')
+            fetching.set()
+            release.wait(5)
+            return 'user1', time.time() + 60
+
+        threads = [threading.Thread(target=cache.get, args=('user1', slow_fetch)) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        self.assertTrue(fetching.wait(5))
+        # Not blocked by the fetch of the token of the other user.
+        self.assertEqual('user2', cache.get('user2', lambda: ('user2', time.time() + 60)))
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(['user1'], fetches)
+        self.assertEqual('user1', cache.cached('user1'))
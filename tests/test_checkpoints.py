@@ -0,0 +1,86 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+from uuid import uuid4
+
+from packer.jobs.example import add
+from packer.redis_client import redis
+from packer.task_status import Status, TaskStatus
+from packer.tasks import TaskCancelled, remove_expired_work_dirs
+
+
+class CheckpointTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.TemporaryDirectory()
+        patcher = mock.patch.dict('packer.tasks.task_config', data_dir=self.data_dir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.data_dir.cleanup)
+        add.push_request(id=str(uuid4()))
+        self.addCleanup(add.pop_request)
+
+    def test_stage_computed_once(self):
+        compute = mock.Mock(return_value={'rows': [1, 2, 3]})
+        self.assertEqual({'rows': [1, 2, 3]}, add.checkpoint('stage', compute))
+        self.assertEqual({'rows': [1, 2, 3]}, add.checkpoint('stage', compute))
+        compute.assert_called_once()
+
+    def test_failed_stage_not_stored(self):
+        with self.assertRaises(ValueError):
+            add.checkpoint('stage', mock.Mock(side_effect=ValueError))
+        self.assertEqual([], os.listdir(add.get_data_dir()))
+        self.assertEqual(42, add.checkpoint('stage', lambda: 42))
+
+    def test_work_dir_separate_from_result_file(self):
+        self.assertEqual(os.path.join(self.data_dir.name, 'work', add.request.id), add.get_data_dir())
+
+    @mock.patch.dict('packer.tasks.task_config', work_dir_ttl=60)
+    def test_expired_work_dirs_removed(self):
+        task_ids = {status: str(uuid4()) for status in (Status.FAILED, Status.RUNNING)}
+        for status, task_id in task_ids.items():
+            TaskStatus(task_id).create(status=status)
+            self.addCleanup(redis.delete, TaskStatus(task_id).key)
+        expired = time.time() - 120
+        for task_id in list(task_ids.values()) + ['unknown-task']:
+            path = os.path.join(self.data_dir.name, 'work', task_id)
+            os.makedirs(path)
+            open(os.path.join(path, 'stage.pickle'), 'wb').close()
+            for entry in (os.path.join(path, 'stage.pickle'), path):
+                os.utime(entry, (expired, expired))
+        add.checkpoint('stage', lambda: 42)
+
+        remove_expired_work_dirs()
+        self.assertEqual(sorted([add.request.id, task_ids[Status.RUNNING]]),
+                         sorted(os.listdir(os.path.join(self.data_dir.name, 'work'))))
+
+    def test_check_cancelled(self):
+        add.check_cancelled(force=True)
+        redis.set(add.task_status.cancel_key, 1, ex=10)
+        self.addCleanup(redis.delete, add.task_status.cancel_key)
+        with self.assertRaises(TaskCancelled):
+            add.check_cancelled(force=True)
+
+    def test_cancelled_when_observations_response_starts(self):
+        add.check_cancelled(force=True)
+        response = mock.MagicMock()
+
+        def transmart_post(*args, **kwargs):
+            # Cancelled while waiting for the response, which took longer than the check interval.
+            redis.set(add.task_status.cancel_key, 1, ex=10)
+            add.request.cancel_checked_at = 0
+            return response
+
+        self.addCleanup(redis.delete, add.task_status.cancel_key)
+        path = os.path.join(add.get_data_dir(), 'observations.json.gz')
+        with mock.patch.object(add, 'transmart_post', transmart_post), \
+                mock.patch.object(add, '_download') as download, self.assertRaises(TaskCancelled):
+            add.fetch_observations({'type': 'true'}, path, None)
+        download.assert_not_called()
+        response.__exit__.assert_called_once()
+
+
+if __name__ == '__main__':
+    unittest.main()
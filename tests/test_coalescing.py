@@ -0,0 +1,38 @@
+import unittest
+from uuid import uuid4
+
+from packer import coalescing
+from packer.redis_client import redis
+
+
+class CoalescingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.key = coalescing.inflight_key(f'user-{uuid4()}', 'fingerprint')
+        self.addCleanup(redis.delete, self.key)
+
+    def test_fingerprint_ignores_parameter_order(self):
+        self.assertEqual(coalescing.fingerprint('add', {'x': 1, 'y': 2}),
+                         coalescing.fingerprint('add', {'y': 2, 'x': 1}))
+        self.assertNotEqual(coalescing.fingerprint('add', {'x': 1, 'y': 2}),
+                            coalescing.fingerprint('add', {'x': 2, 'y': 1}))
+
+    def test_finished_job_replaced_once(self):
+        redis.set(self.key, 'finished')
+        self.assertEqual(1, redis.eval(coalescing.REPLACE_SCRIPT, 1, self.key, 'finished', 'first', 60))
+        self.assertEqual(0, redis.eval(coalescing.REPLACE_SCRIPT, 1, self.key, 'finished', 'second', 60))
+        self.assertEqual('first', redis.get(self.key))
+        self.assertGreater(redis.ttl(self.key), 0)
+
+    def test_expired_key_replaced(self):
+        self.assertEqual(1, redis.eval(coalescing.REPLACE_SCRIPT, 1, self.key, '', 'first', 60))
+        self.assertEqual('first', redis.get(self.key))
+
+    def test_release_only_own_task(self):
+        redis.set(self.key, 'newer')
+        redis.eval(coalescing.RELEASE_SCRIPT, 1, self.key, 'older')
+        self.assertEqual('newer', redis.get(self.key))
+
+
+if __name__ == '__main__':
+    unittest.main()
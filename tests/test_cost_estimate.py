@@ -0,0 +1,48 @@
+import unittest
+from unittest import mock
+
+from tornado.testing import AsyncTestCase, gen_test
+
+from packer import cost_estimate
+
+counts = {
+    '/v2/observations/counts': {'observationCount': 1000000, 'patientCount': 5000},
+    '/v2/observations/counts_per_concept': {'countsPerConcept': {'age': {}, 'gender': {}, 'diagnosis': {}}}
+}
+
+
+async def transmart_post(path, body, token):
+    return counts[path]
+
+
+class CostEstimateTestCase(AsyncTestCase):
+
+    @gen_test
+    async def test_estimate(self):
+        with mock.patch.object(cost_estimate, 'transmart_post', transmart_post):
+            job_estimate = await cost_estimate.estimate({'type': 'true'}, 'token')
+        self.assertEqual(1000000, job_estimate['observations'])
+        self.assertEqual(5000, job_estimate['rows'])
+        self.assertEqual(3, job_estimate['columns'])
+        self.assertAlmostEqual(1907.3, job_estimate['memory_mb'], places=1)
+
+    @gen_test
+    async def test_no_estimate_without_constraint(self):
+        with mock.patch.dict('packer.cost_estimate.estimate_config', enabled=True), \
+                mock.patch.dict('packer.cost_estimate.transmart_config', host='http://transmart'):
+            self.assertIsNone(await cost_estimate.estimate_job({'x': 1, 'y': 2}, 'token'))
+
+    def test_select_resource_class(self):
+        self.assertEqual('light', cost_estimate.select_resource_class({'observations': 1000, 'memory_mb': 10}))
+        self.assertEqual('heavy', cost_estimate.select_resource_class({'observations': 10 ** 6, 'memory_mb': 2000}))
+        with self.assertRaises(cost_estimate.JobTooLarge):
+            cost_estimate.select_resource_class({'observations': 10 ** 8, 'memory_mb': 200000})
+
+    @mock.patch.dict('packer.cost_estimate.estimate_config', max_observations=1000)
+    def test_max_observations(self):
+        with self.assertRaises(cost_estimate.JobTooLarge):
+            cost_estimate.select_resource_class({'observations': 1001, 'memory_mb': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import time
+import unittest
+
+from redis import StrictRedis
+from redis.exceptions import ResponseError
+
+from benchmarks import fake_redis
+
+
+class FakeRedisTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.process, url = fake_redis.start_in_process()
+        cls.redis = StrictRedis.from_url(url, decode_responses=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.redis.close()
+        cls.process.terminate()
+        cls.process.join()
+
+    def setUp(self):
+        self.redis.flushall()
+
+    def test_strings(self):
+        self.assertTrue(self.redis.set('a', 1))
+        self.assertIsNone(self.redis.set('a', 2, nx=True))
+        self.assertEqual(['1', None], self.redis.mget('a', 'b'))
+        self.assertTrue(self.redis.set('b', 'x', px=50))
+        time.sleep(0.1)
+        self.assertIsNone(self.redis.get('b'))
+        self.assertEqual(1, self.redis.delete('a', 'b'))
+
+    def test_collections(self):
+        self.assertEqual(2, self.redis.sadd('s', 'x', 'y'))
+        self.assertTrue(self.redis.sismember('s', 'x'))
+        self.assertEqual(0.5, self.redis.hincrbyfloat('h', 'f', 0.5))
+        self.assertEqual(3, self.redis.hincrbyfloat('h', 'f', 2.5))
+        self.assertEqual({'f': '3'}, self.redis.hgetall('h'))
+        self.redis.lpush('q', 'a', 'b')
+        self.assertEqual(('q', 'a'), self.redis.brpop('q', 1))
+        self.assertEqual(1, self.redis.llen('q'))
+        with self.assertRaises(ResponseError):
+            self.redis.get('s')
+
+    def test_stream(self):
+        first = self.redis.xadd('events', {'event': '1'})
+        self.redis.xadd('events', {'event': '2'})
+        self.redis.xadd('events', {'event': '3'}, maxlen=2, approximate=True)
+        self.assertEqual(2, self.redis.xlen('events'))
+        self.assertEqual(['2', '3'], [fields['event'] for _, fields in self.redis.xrange('events', min=first)])
+
+    def test_publish_subscribe(self):
+        pubsub = self.redis.pubsub()
+        pubsub.psubscribe('channel:*')
+        self.assertEqual('psubscribe', pubsub.get_message(timeout=1)['type'])
+        self.assertEqual(1, self.redis.publish('channel:user', 'hello'))
+        message = pubsub.get_message(timeout=1)
+        self.assertEqual(('channel:user', 'hello'), (message['channel'], message['data']))
+        pubsub.close()
+
+    def test_transaction(self):
+        pipe = self.redis.pipeline()
+        pipe.set('k', 'v').get('k').incr('n')
+        self.assertEqual([True, 'v', 1], pipe.execute())
+
+    def test_scripts_not_supported(self):
+        with self.assertRaises(ResponseError):
+            self.redis.eval('return 1', 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
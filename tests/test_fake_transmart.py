@@ -0,0 +1,104 @@
+import unittest
+from unittest import mock
+
+import jwt
+import requests
+
+from benchmarks.fake_keycloak import FakeKeycloak
+from benchmarks.fake_transmart import FakeTransmart, load_template, patient_set_ids, scaled_hypercube
+from packer import auth
+from packer.config import keycloak_config
+
+
+class ScaledHypercubeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.template = load_template()
+
+    def test_scaled_hypercube_copies_subjects(self):
+        hypercube = scaled_hypercube(3, self.template)
+        self.assertEqual(3 * len(self.template['cells']), len(hypercube['cells']))
+        patients = hypercube['dimensionElements']['patient']
+        self.assertEqual(3 * len(self.template['dimensionElements']['patient']), len(patients))
+        self.assertEqual(len(patients), len({patient['id'] for patient in patients}))
+        self.assertEqual(len(patients), len({patient['subjectIds']['SUBJ_ID'] for patient in patients}))
+        # Elements of other dimensions are shared by the copies.
+        self.assertEqual(self.template['dimensionElements']['concept'], hypercube['dimensionElements']['concept'])
+
+    def test_scaled_hypercube_indexes_are_in_range(self):
+        hypercube = scaled_hypercube(2, self.template)
+        indexed = [declaration['name'] for declaration in hypercube['dimensionDeclarations']
+                   if not declaration.get('inline')]
+        for cell in hypercube['cells']:
+            for name, position in zip(indexed, cell['dimensionIndexes']):
+                if position is not None:
+                    self.assertLess(position, len(hypercube['dimensionElements'][name]))
+
+    def test_patient_set_ids(self):
+        constraint = {'type': 'and', 'args': [{'type': 'study_name', 'studyId': 'S'},
+                                              {'type': 'patient_set', 'patientIds': [1, 2]}]}
+        self.assertEqual({1, 2}, patient_set_ids(constraint))
+        self.assertIsNone(patient_set_ids({'type': 'study_name', 'studyId': 'S'}))
+
+
+class FakeServicesTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.transmart = FakeTransmart(scale=2).start()
+        cls.keycloak = FakeKeycloak(client_id=keycloak_config['client_id']).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.transmart.stop()
+        cls.keycloak.stop()
+
+    def setUp(self):
+        auth.access_tokens.clear()
+        auth.verified_tokens.clear()
+        auth.public_keys.clear()
+
+    def post_observations(self, constraint, **headers):
+        return requests.post(f'{self.transmart.url}/v2/observations',
+                             json={'type': 'clinical', 'constraint': constraint},
+                             headers=dict({'Authorization': 'Bearer token'}, **headers))
+
+    def test_observations_require_token(self):
+        response = requests.post(f'{self.transmart.url}/v2/observations', json={})
+        self.assertEqual(401, response.status_code)
+
+    def test_observations_are_compressed(self):
+        response = self.post_observations({'type': 'true'}, **{'Accept-Encoding': 'gzip'})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('gzip', response.headers['Content-Encoding'])
+        self.assertEqual(len(self.transmart.hypercube['cells']), len(response.json()['cells']))
+
+    def test_patient_set_selects_observations(self):
+        first_copy = self.transmart.patients[:len(self.transmart.patients) // 2]
+        response = self.post_observations({'type': 'patient_set', 'patientIds': [p['id'] for p in first_copy]},
+                                          **{'Accept-Encoding': 'identity'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(len(self.transmart.hypercube['cells']) // 2, len(response.json()['cells']))
+
+    def test_counts(self):
+        response = requests.post(f'{self.transmart.url}/v2/observations/counts', json={'constraint': {}},
+                                 headers={'Authorization': 'Bearer token'})
+        self.assertEqual(len(self.transmart.hypercube['cells']), response.json()['observationCount'])
+        self.assertEqual(len(self.transmart.patients), response.json()['patientCount'])
+
+    def test_impersonated_token(self):
+        issued = self.keycloak.tokens_issued
+        with mock.patch.dict(keycloak_config, oidc_server_url=self.keycloak.realm_url, offline_token='offline'):
+            token = auth.get_impersonated_token_for_user('user1')
+        claims = jwt.decode(token, options={'verify_signature': False})
+        self.assertEqual('user1', claims['sub'])
+        self.assertEqual(issued + 2, self.keycloak.tokens_issued)
+
+    def test_token_is_verified_with_realm_keys(self):
+        with mock.patch.dict(keycloak_config, oidc_server_url=self.keycloak.realm_url):
+            user = auth.authorize(self.keycloak.token('user1'))
+        self.assertEqual('user1', user['sub'])
+
+
+if __name__ == '__main__':
+    unittest.main()
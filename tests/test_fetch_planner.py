@@ -0,0 +1,47 @@
+import unittest
+from unittest import mock
+from uuid import uuid4
+
+import pandas as pd
+
+from packer import fetch_planner
+from packer.jobs.example import add
+
+constraint = {'type': 'study_name', 'studyId': 'CSR'}
+
+
+class FetchPlannerTestCase(unittest.TestCase):
+
+    def test_small_constraint_not_split(self):
+        self.assertEqual([constraint], fetch_planner.plan_partitions(constraint, [1, 2, 3], 3))
+        self.assertEqual([constraint], fetch_planner.plan_partitions(constraint, [1, 2, 3], 0))
+
+    def test_split_by_patients(self):
+        partitions = fetch_planner.plan_partitions(constraint, [1, 2, 3, 4, 5], 2)
+        self.assertEqual(3, len(partitions))
+        self.assertEqual({'type': 'and', 'args': [constraint, {'type': 'patient_set', 'patientIds': [5]}]},
+                         partitions[-1])
+        patient_ids = [patient_id for p in partitions for patient_id in p['args'][1]['patientIds']]
+        self.assertEqual([1, 2, 3, 4, 5], patient_ids)
+
+    @mock.patch.dict('packer.tasks.fetch_config', partition_size=2, max_concurrency=2)
+    def test_partitions_fetched_and_merged(self):
+        def observations(partition_constraint, fraction_range):
+            self.assertEqual(task_id, add.task_id)  # request context is available in the fetch threads
+            return partition_constraint['args'][1]['patientIds']
+
+        task_id = str(uuid4())
+        add.push_request(id=task_id)
+        self.addCleanup(add.pop_request)
+        with mock.patch.object(add, 'patient_ids', return_value=[1, 2, 3]), \
+                mock.patch.object(add, 'observations_json', side_effect=observations), \
+                mock.patch.object(add, 'update_status'), \
+                mock.patch.object(add, 'update_progress'), \
+                mock.patch('packer.tasks.ObservationSet') as observation_set:
+            observation_set.side_effect = lambda ids: mock.Mock(dataframe=pd.DataFrame({'patient': ids}))
+            obs_df = add.observations_dataframe(constraint)
+        self.assertEqual([1, 2, 3], sorted(obs_df['patient']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,28 @@
+import threading
+import unittest
+from unittest import mock
+
+from packer import http_client
+
+
+class HttpClientTestCase(unittest.TestCase):
+
+    def test_session_shared_by_threads(self):
+        sessions = []
+        threads = [threading.Thread(target=lambda: sessions.append(http_client.get_session())) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(4, len(sessions))
+        self.assertTrue(all(session is http_client.get_session() for session in sessions))
+
+    @mock.patch.object(http_client, '_session', None)
+    @mock.patch.dict('packer.http_client.fetch_config', max_concurrency=32)
+    def test_pool_holds_a_connection_per_fetch_thread(self):
+        adapter = http_client.get_session().get_adapter('https://transmart')
+        self.assertEqual(32, adapter._pool_maxsize)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import inspect
+import unittest
+from unittest import mock
+
+from packer.jobs import registry, task_modules
+from packer.tasks import app
+
+
+class JobRegistryTestCase(unittest.TestCase):
+
+    def test_specs_match_tasks(self):
+        for name, spec in registry.items():
+            with self.subTest(job=name):
+                task = spec.load()
+                self.assertEqual(spec.task_name, task.name)
+                self.assertEqual(spec.resource_class, task.resource_class)
+                parameters = inspect.signature(task.run).parameters.values()
+                self.assertEqual(spec.parameters, tuple(
+                    p.name for p in parameters if p.default is p.empty and p.kind != p.VAR_KEYWORD))
+                self.assertEqual(spec.optional_parameters, tuple(
+                    p.name for p in parameters if p.default is not p.empty))
+                self.assertEqual(spec.extra_parameters, any(p.kind == p.VAR_KEYWORD for p in parameters))
+
+    def test_workers_import_job_modules(self):
+        self.assertEqual(task_modules(), sorted(app.conf.include))
+
+    def test_check_parameters(self):
+        spec = registry['add']
+        spec.check_parameters({'x': 1, 'y': 2, 'sleep': 0})
+        with self.assertRaises(TypeError):
+            spec.check_parameters({'y': 2})
+        with self.assertRaises(TypeError):
+            spec.check_parameters({'x': 1, 'y': 2, 'z': 3})
+        registry['basic_export'].check_parameters({'constraint': {}, 'custom_name': 'export'})
+
+    def test_check_parameter_values(self):
+        spec = registry['multi_export']
+        spec.check_parameters({'constraint': {}, 'outputs': [{'type': 'csr'}]})
+        with self.assertRaises(ValueError):
+            spec.check_parameters({'constraint': {}, 'outputs': [{'type': 'xlsx'}]})
+
+    def test_sent_to_queue_of_resource_class(self):
+        with mock.patch('packer.celery_app.app.send_task') as send_task:
+            registry['csr_export'].apply_async(kwargs={'constraint': {}}, task_id='1')
+            self.assertEqual('heavy', send_task.call_args[1]['queue'])
+            self.assertEqual('packer.jobs.csr_export.csr_export', send_task.call_args[0][0])
+            registry['csr_export'].apply_async(kwargs={'constraint': {}}, task_id='2', queue='light')
+            self.assertEqual('light', send_task.call_args[1]['queue'])
+
+
+if __name__ == '__main__':
+    unittest.main()
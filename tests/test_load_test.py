@@ -0,0 +1,40 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from benchmarks.load_test import SCENARIOS, percentile
+
+APP_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+class LoadTestTestCase(unittest.TestCase):
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(50, percentile(values, 0.5))
+        self.assertEqual(99, percentile(values, 0.99))
+        self.assertIsNone(percentile([], 0.5))
+
+    def test_short_run(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'result.json')
+            process = subprocess.run(
+                [sys.executable, '-m', 'benchmarks.load_test', '--duration', '1', '--warmup', '0.5',
+                 '--clients', '2', '--websockets', '2', '--users', '2', '--job-seconds', '0.1',
+                 '--data-size', '1024', '--json', output],
+                cwd=APP_ROOT, capture_output=True, text=True, timeout=120)
+            self.assertEqual(0, process.returncode, process.stderr)
+            with open(output) as f:
+                result = json.load(f)
+        for scenario in SCENARIOS:
+            self.assertGreater(result['http'][scenario]['requests'], 0)
+            self.assertEqual(0, result['http'][scenario]['errors'])
+        self.assertGreater(result['websocket']['messages'], 0)
+        self.assertIsNotNone(result['loop_lag']['p99_ms'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import time
+import unittest
+from unittest import mock
+from uuid import uuid4
+
+from billiard.exceptions import WorkerLostError
+from billiard.pool import EX_RECYCLE
+
+from packer import memory_watchdog, tasks
+from packer.jobs.example import add
+from packer.memory_watchdog import MemoryBudgetExceeded, MemoryWatchdog, watch
+from packer.redis_client import redis
+from packer.task_status import Status, TaskStatus
+
+
+def busy(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+
+@unittest.skipIf(memory_watchdog.rss_mb() is None, 'Memory use of the process cannot be read.')
+class MemoryWatchdogTestCase(unittest.TestCase):
+
+    def test_budget_exceeded(self):
+        with self.assertRaises(MemoryBudgetExceeded):
+            with watch(budget_mb=1, interval=0.01):
+                busy(5)
+
+    def test_within_budget(self):
+        with watch(budget_mb=10 ** 6, interval=0.01):
+            busy(0.1)
+
+    def test_not_raised_after_watched_code(self):
+        with watch(budget_mb=1, interval=10):
+            pass
+        busy(0.1)
+
+    def test_raised_at_check(self):
+        with self.assertRaises(MemoryBudgetExceeded):
+            with watch(budget_mb=1, interval=0.01, abort_delay=10) as watchdog:
+                for _ in range(500):
+                    if watchdog.exceeded:
+                        break
+                    time.sleep(0.01)
+                watchdog.check()
+        self.assertFalse(watchdog.interrupted)
+
+    def test_interrupted_without_check(self):
+        with self.assertRaises(MemoryBudgetExceeded):
+            with watch(budget_mb=1, interval=0.01, abort_delay=0.1) as watchdog:
+                busy(5)
+        self.assertTrue(watchdog.interrupted)
+
+
+class RecycleWorkerProcessTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.task_id = str(uuid4())
+        add.push_request(id=self.task_id)
+        self.addCleanup(add.pop_request)
+        TaskStatus(self.task_id).create(user='user', job_type='add', status=Status.RUNNING)
+        self.addCleanup(redis.delete, TaskStatus(self.task_id).key)
+
+    @mock.patch.object(tasks, 'pool_process', True)
+    def test_process_replaced_after_budget_exceeded(self):
+        tasks.recycle_worker_process(sender=add, task_id=self.task_id)
+        add.on_failure(MemoryBudgetExceeded(), self.task_id, (), {}, None)
+        with self.assertRaises(SystemExit) as context:
+            tasks.recycle_worker_process(sender=add, task_id=self.task_id)
+        self.assertEqual(EX_RECYCLE, context.exception.code)
+
+        # The main worker process reports the task as lost, which keeps the status of the task.
+        tasks.fail_lost_task(sender=add, task_id=self.task_id, exception=WorkerLostError())
+        self.assertIn('memory than its budget', TaskStatus(self.task_id).get()['message'])
+
+    def test_raised_at_cancellation_check(self):
+        watchdog = MemoryWatchdog(budget_mb=1, interval=1, thread_id=0)
+        add.request.memory_watchdog = watchdog
+        add.check_cancelled(force=True)
+        watchdog.exceeded = True
+        with self.assertRaises(MemoryBudgetExceeded):
+            add.check_cancelled()
+
+    def test_redis_connections_closed_after_interrupt(self):
+        watchdog = MemoryWatchdog(budget_mb=1, interval=1, thread_id=0)
+        watchdog.exceeded = watchdog.interrupted = True
+        add.request.memory_watchdog = watchdog
+        with mock.patch.object(redis.connection_pool, 'disconnect') as disconnect:
+            add.on_failure(MemoryBudgetExceeded(), self.task_id, (), {}, None)
+        disconnect.assert_called_once()
+        self.assertEqual(Status.FAILED, TaskStatus(self.task_id).get()['status'])
+
+    def test_process_not_replaced_outside_pool(self):
+        add.on_failure(MemoryBudgetExceeded(), self.task_id, (), {}, None)
+        tasks.recycle_worker_process(sender=add, task_id=self.task_id)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import unittest
+
+from packer import metrics
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        registry = list(metrics.REGISTRY)
+        self.addCleanup(lambda: metrics.REGISTRY.__setitem__(slice(None), registry))
+
+    def test_histogram(self):
+        histogram = metrics.Histogram('test_duration_seconds', 'Test durations.', labels=('stage',), buckets=(1, 5))
+        histogram.observe(0.5, stage='fetch')
+        histogram.observe(3, stage='fetch')
+        pending = histogram.collect()
+        self.assertEqual({'stage="fetch"|1': 1, 'stage="fetch"|5': 2, 'stage="fetch"|+Inf': 2,
+                          'stage="fetch"|sum': 3.5}, pending)
+        self.assertEqual({}, histogram.collect())
+
+        lines = histogram.render({field: f'{value:g}' for field, value in pending.items()})
+        self.assertEqual([
+            '# HELP test_duration_seconds Test durations.',
+            '# TYPE test_duration_seconds histogram',
+            'test_duration_seconds_bucket{stage="fetch",le="1"} 1',
+            'test_duration_seconds_bucket{stage="fetch",le="5"} 2',
+            'test_duration_seconds_bucket{stage="fetch",le="+Inf"} 2',
+            'test_duration_seconds_sum{stage="fetch"} 3.5',
+            'test_duration_seconds_count{stage="fetch"} 2',
+        ], lines)
+
+    def test_counter(self):
+        counter = metrics.Counter('test_total', 'Test count.', labels=('job_type', 'status'))
+        counter.inc(job_type='add', status='SUCCESS')
+        counter.inc(2, status='SUCCESS', job_type='add')
+        self.assertEqual({'job_type="add",status="SUCCESS"': 3}, counter.collect())
+        with self.assertRaises(ValueError):
+            counter.inc(job_type='add')
+
+    def test_label_values_escaped(self):
+        self.assertEqual('name="a \\"b\\"\\\\n"', metrics.format_labels({'name': 'a "b"\\n'}))
+
+    def test_gauge_total(self):
+        gauge = metrics.Gauge('test_connections', 'Test connections.')
+        self.assertEqual('test_connections 5.0', gauge.render({'host:1': '2', 'host:2': '3'})[-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
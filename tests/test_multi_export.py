@@ -0,0 +1,76 @@
+import tempfile
+import unittest
+from unittest import mock
+from uuid import uuid4
+from zipfile import ZipFile
+
+import pandas as pd
+
+from packer.file_handling import FSHandler
+from packer.jobs.checks import check_outputs
+from packer.jobs.multi_export import multi_export
+
+OBSERVATION_COLUMNS = ['Diagnosis', 'concept.conceptCode', 'concept.conceptPath', 'concept.name',
+                       'numericValue', 'patient.id', 'patient.subjectIds.SUBJ_ID', 'stringValue', 'study.name']
+
+
+def observations():
+    return pd.DataFrame([
+        [None, 'Individual.age', '\\01.Patient\\Age\\', 'Age', 42.0, 1, 'P1', None, 'TEST'],
+        ['D1', 'Diagnosis.name', '\\02.Diagnosis\\Diagnosis Name\\', 'Diagnosis Name',
+         None, 1, 'P1', 'Diagnosis 1 Name', 'TEST'],
+        [None, 'Individual.age', '\\01.Patient\\Age\\', 'Age', 39.0, 2, 'P2', None, 'TEST'],
+    ], columns=OBSERVATION_COLUMNS)
+
+
+class CheckOutputsTestCase(unittest.TestCase):
+
+    def test_valid_outputs(self):
+        check_outputs([{'type': 'basic'}, {'type': 'csr'}, {'type': 'csr', 'name': 'filtered', 'row_filter': {}}])
+
+    def test_invalid_outputs(self):
+        for outputs in [None, [], [{'name': 'export'}], [{'type': 'xlsx'}],
+                        [{'type': 'basic', 'row_filter': {}}], [{'type': 'csr'}, {'type': 'csr'}]]:
+            with self.subTest(outputs=outputs), self.assertRaises(ValueError):
+                check_outputs(outputs)
+
+
+class MultiExportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.data_dir.cleanup)
+        for patcher in [mock.patch.dict('packer.tasks.task_config', data_dir=self.data_dir.name),
+                        mock.patch.object(multi_export, 'update_status'),
+                        mock.patch.object(multi_export, 'update_progress')]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.task_id = str(uuid4())
+        multi_export.push_request(id=self.task_id)
+        self.addCleanup(multi_export.pop_request)
+
+    def test_outputs_from_one_fetch(self):
+        with mock.patch.object(multi_export, 'observations_dataframe',
+                               side_effect=lambda *args: observations()) as fetch:
+            multi_export.run({'type': 'true'}, [{'type': 'basic', 'name': 'observations'}, {'type': 'csr'}])
+
+        fetch.assert_called_once()
+        with ZipFile(FSHandler(self.task_id).path) as data_zip:
+            self.assertEqual(['observations.tsv', 'csr.tsv'], data_zip.namelist())
+            basic = data_zip.read('observations.tsv').decode('utf-8').splitlines()
+            csr = data_zip.read('csr.tsv').decode('utf-8').splitlines()
+        self.assertEqual(4, len(basic))
+        self.assertIn('"concept.conceptCode"', basic[0])
+        self.assertEqual(3, len(csr))
+        self.assertTrue(csr[0].startswith('"Subject Id"'))
+
+    def test_custom_name_prefixes_file_names(self):
+        with mock.patch.object(multi_export, 'observations_dataframe', side_effect=lambda *args: observations()):
+            multi_export.run({'type': 'true'}, [{'type': 'basic'}, {'type': 'csr'}], custom_name='study')
+
+        with ZipFile(FSHandler(self.task_id).path) as data_zip:
+            self.assertEqual(['study_basic.tsv', 'study_csr.tsv'], data_zip.namelist())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import csv
+import io
+import time
+import unittest
+from uuid import uuid4
+from zipfile import ZipFile
+
+import pandas as pd
+
+from packer import export
+from packer.file_handling import FSHandler
+from packer.task_status import Progress
+
+
+class ProgressTestCase(unittest.TestCase):
+
+    def test_eta_unknown_before_start(self):
+        progress = Progress()
+        self.assertIsNone(progress.eta())
+        self.assertIsNone(progress.as_dict()['eta_seconds'])
+
+    def test_eta_derived_from_fraction(self):
+        progress = Progress()
+        progress.started_at = time.time() - 10
+        progress.update(fraction=0.25)
+        self.assertAlmostEqual(30, progress.eta(), delta=1)
+
+    def test_eta_zero_when_done(self):
+        progress = Progress()
+        progress.update(fraction=1.0)
+        self.assertEqual(0.0, progress.eta())
+
+    def test_fraction_is_bounded(self):
+        progress = Progress()
+        progress.update(fraction=1.5)
+        self.assertEqual(1.0, progress.fraction)
+
+    def test_counters(self):
+        progress = Progress()
+        progress.update(bytes_downloaded=100, bytes_total=200, rows_decoded=10)
+        as_dict = progress.as_dict()
+        self.assertEqual(100, as_dict['bytes_downloaded'])
+        self.assertEqual(200, as_dict['bytes_total'])
+        self.assertEqual(10, as_dict['rows_decoded'])
+
+    def test_unknown_counter(self):
+        with self.assertRaises(ValueError):
+            Progress().update(rows_read=1)
+
+    def test_is_due(self):
+        progress = Progress()
+        self.assertTrue(progress.is_due(1.0))
+        progress.mark_sent()
+        self.assertFalse(progress.is_due(1.0))
+        self.assertTrue(progress.is_due(0.0))
+
+
+class SaveTestCase(unittest.TestCase):
+
+    def test_save_in_chunks(self):
+        task_id = str(uuid4())
+        df = pd.DataFrame({'id': [f'P{i}' for i in range(25)], 'value': range(25)}).set_index('id')
+        reported = []
+        chunk_rows = export.EXPORT_CHUNK_ROWS
+        export.EXPORT_CHUNK_ROWS = 10
+        try:
+            export.save(df, task_id, 'export', on_rows_written=lambda n, total: reported.append((n, total)))
+        finally:
+            export.EXPORT_CHUNK_ROWS = chunk_rows
+
+        self.assertEqual([(10, 25), (20, 25), (25, 25)], reported)
+        with ZipFile(FSHandler(task_id).path) as data_zip:
+            content = data_zip.read('export.tsv').decode('utf-8')
+        expected = io.StringIO()
+        df.reset_index().to_csv(expected, sep='\t', index=False, quoting=csv.QUOTE_NONNUMERIC, quotechar='"')
+        self.assertEqual(expected.getvalue(), content)
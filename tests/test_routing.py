@@ -0,0 +1,33 @@
+import unittest
+
+from packer import routing
+from packer.jobs import registry
+from packer.tasks import app
+
+
+class RoutingTestCase(unittest.TestCase):
+
+    def route(self, task):
+        return app.amqp.router.route({}, task.name, (), {}, task_type=task)['queue'].name
+
+    def test_jobs_routed_to_resource_class_queue(self):
+        self.assertEqual('light', self.route(registry['add'].load()))
+        self.assertEqual('heavy', self.route(registry['csr_export'].load()))
+
+    def test_acks_late_by_resource_class(self):
+        self.assertFalse(registry['add'].load().acks_late)
+        self.assertTrue(registry['csr_export'].load().acks_late)
+
+    def test_unknown_resource_class(self):
+        with self.assertRaises(ValueError):
+            routing.get_resource_class('huge')
+
+    def test_worker_arguments(self):
+        args = routing.worker_arguments('heavy')
+        self.assertEqual('worker', args[0])
+        self.assertEqual('heavy', args[args.index('--queues') + 1])
+        self.assertEqual('1', args[args.index('--prefetch-multiplier') + 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import os
+import signal
+import tempfile
+import time
+import unittest
+
+from packer.server import Supervisor, process_count
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError('Timed out.')
+        time.sleep(0.05)
+
+
+def is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+class SupervisorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.pid_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.pid_dir.cleanup)
+
+    def run_process(self, index):
+        """ Records its pid and waits for SIGTERM. """
+        stopped = []
+        signal.signal(signal.SIGTERM, lambda *args: stopped.append(True))
+        with open(os.path.join(self.pid_dir.name, str(os.getpid())), 'w') as f:
+            f.write(str(index))
+        while not stopped:
+            time.sleep(0.05)
+
+    def pids(self):
+        return {int(pid) for pid in os.listdir(self.pid_dir.name)}
+
+    def test_process_count(self):
+        self.assertEqual(3, process_count(3))
+        self.assertEqual(os.cpu_count(), process_count(0))
+
+    def test_restart_and_stop(self):
+        supervisor_pid = os.fork()
+        if supervisor_pid == 0:
+            try:
+                Supervisor(2, self.run_process).run()
+            finally:
+                os._exit(0)
+        wait_for(lambda: len(self.pids()) == 2)
+        first = self.pids()
+
+        os.kill(supervisor_pid, signal.SIGHUP)
+        wait_for(lambda: len(self.pids()) == 4 and not any(is_running(pid) for pid in first))
+        second = self.pids() - first
+        self.assertTrue(all(is_running(pid) for pid in second))
+
+        os.kill(supervisor_pid, signal.SIGTERM)
+        _, status = os.waitpid(supervisor_pid, 0)
+        self.assertTrue(os.WIFEXITED(status))
+        self.assertEqual(0, os.WEXITSTATUS(status))
+        self.assertFalse(any(is_running(pid) for pid in second))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,9 @@
 import json
 import os.path
 import sys
+import threading
 import time
+from unittest import mock
 
 import jwt
 import packer
@@ -11,8 +13,10 @@ import tornado.websocket
 from tornado import httpclient
 from tornado.testing import AsyncHTTPTestCase
 
+from packer import result_cache
 from packer.main import make_web_app
-from packer.task_status import Status
+from packer.redis_client import redis
+from packer.task_status import Status, TaskStatus
 from tests.testing_config import tornado_config
 
 # add application root to sys.path
@@ -33,7 +37,7 @@ def get_mock_auth(user_id=None):
         'aud': 'transmart'
     }
     token = jwt.encode(claims, key='secret?')
-    return {'Authorization': f'Bearer {token.decode()}'}
+    return {'Authorization': f'Bearer {token}'}
 
 
 mock_user = '1234567890'
@@ -150,6 +154,25 @@ class TestWebAppHandlers(TestHandlerBase):
         response = self.post('/jobs/create', args)
         self.assertEqual(400, response.code)
 
+    def test_create_job_post_invalid_flag(self):
+        response = self.mocked_post('/jobs/create', dict(self.post_args, coalesce="false"))
+        self.assertEqual(400, response.code)
+        self.assertIn('"coalesce"', json.loads(response.body)['error'])
+        response = self.mocked_post('/jobs/batch/create', {"jobs": [dict(self.post_args, cache=0)]})
+        self.assertEqual(400, response.code)
+        self.assertIn('Job 0:', json.loads(response.body)['error'])
+
+    def test_create_job_post_invalid_parameter_value(self):
+        args = {
+            "job_type": "multi_export",
+            "job_parameters": {"constraint": {"type": "true"}, "outputs": [{"type": "basic"}, {"type": "basic"}]}
+        }
+        with mock.patch('packer.jobs.JobSpec.apply_async') as apply_async:
+            response = self.mocked_post('/jobs/create', args)
+        self.assertEqual(400, response.code)
+        self.assertIn('invalid outputs', json.loads(response.body)['error'])
+        apply_async.assert_not_called()
+
     def test_create_job_post_invalid_json(self):
         args = """
         {
@@ -206,19 +229,279 @@ class TestWebAppHandlers(TestHandlerBase):
             time.sleep(0.3)
         self.assertEqual(Status.SUCCESS, body.get('status'))
 
+    def test_status_not_modified(self):
+        args = {"job_type": "add", "job_parameters": {"x": 4, "y": 6, "sleep": 0}}
+        response = self.mocked_post('/jobs/create', args)
+        task_id = json.loads(response.body).get("task_id")
+        for _ in range(10):
+            response = self.mocked_get(f'/jobs/status/{task_id}')
+            if Status.SUCCESS == json.loads(response.body).get('status'):
+                break
+            time.sleep(0.3)
+        etag = response.headers.get('Etag')
+        self.assertIsNotNone(etag)
+        response = self.fetch(f'/jobs/status/{task_id}', headers={'If-None-Match': etag, **get_mock_auth()})
+        self.assertEqual(304, response.code)
+
+    def test_status_long_poll(self):
+        response = self.mocked_post('/jobs/create', self.post_args)
+        task_id = json.loads(response.body).get("task_id")
+        response = self.mocked_get(f'/jobs/status/{task_id}')
+        version = json.loads(response.body).get('version')
+        body = {}
+        while body.get('status') != Status.SUCCESS:
+            response = self.fetch(f'/jobs/status/{task_id}?wait=5',
+                                  headers={'If-None-Match': response.headers.get('Etag'), **get_mock_auth()})
+            self.assertEqual(200, response.code)
+            body = json.loads(response.body)
+            self.assertGreater(body.get('version'), version)
+            version = body.get('version')
+
+    def test_create_job_coalesced(self):
+        args = {"job_type": "add", "job_parameters": {"sleep": 1, "y": 2, "x": 7}}
+        first = json.loads(self.mocked_post('/jobs/create', args).body)
+        args['job_parameters'] = {"x": 7, "y": 2, "sleep": 1}
+        second = json.loads(self.mocked_post('/jobs/create', args).body)
+        self.assertEqual(first['task_id'], second['task_id'])
+        third = json.loads(self.mocked_post('/jobs/create', dict(args, coalesce=False)).body)
+        self.assertNotEqual(first['task_id'], third['task_id'])
+        for task_id in (first['task_id'], third['task_id']):
+            for _ in range(20):
+                if json.loads(self.mocked_get(f'/jobs/status/{task_id}').body)['status'] == Status.SUCCESS:
+                    break
+                time.sleep(0.3)
+        fourth = json.loads(self.mocked_post('/jobs/create', args).body)
+        self.assertNotEqual(first['task_id'], fourth['task_id'])
+        self.mocked_get(f'/jobs/cancel/{fourth["task_id"]}')
+
+    @mock.patch.dict('packer.result_cache.task_config', result_cache_ttl=60)
+    def test_create_job_cached(self):
+        args = {"job_type": "add", "job_parameters": {"x": 3, "y": 5, "sleep": 0}}
+        task_id = json.loads(self.mocked_post('/jobs/create', args).body)['task_id']
+        for _ in range(20):
+            if json.loads(self.mocked_get(f'/jobs/status/{task_id}').body)['status'] == Status.SUCCESS:
+                break
+            time.sleep(0.3)
+        # The worker stores results only if its own result cache is enabled.
+        result_cache.store(redis, TaskStatus(task_id).get())
+
+        link_threads = []
+        link_result = result_cache.link_result
+
+        def record_link_thread(*link_args):
+            link_threads.append(threading.current_thread())
+            link_result(*link_args)
+
+        with mock.patch.object(result_cache, 'link_result', record_link_thread):
+            cached = json.loads(self.mocked_post('/jobs/create', args).body)
+        # The result may be copied, which must not block the IOLoop.
+        self.assertEqual(1, len(link_threads))
+        self.assertIsNot(threading.main_thread(), link_threads[0])
+        self.assertNotEqual(task_id, cached['task_id'])
+        self.assertEqual(Status.SUCCESS, cached['status'])
+        self.assertEqual(task_id, cached['cached_from'])
+        response = self.mocked_get(f'/jobs/data/{cached["task_id"]}')
+        self.assertEqual(8, int.from_bytes(response.body, byteorder='big'))
+
+        not_cached = json.loads(self.mocked_post('/jobs/create', dict(args, cache=False)).body)
+        self.assertNotEqual(Status.SUCCESS, not_cached['status'])
+        self.mocked_get(f'/jobs/cancel/{not_cached["task_id"]}')
+
+        result_cache.invalidate_all(redis)
+        not_cached = json.loads(self.mocked_post('/jobs/create', args).body)
+        self.assertNotIn('cached_from', not_cached)
+        self.mocked_get(f'/jobs/cancel/{not_cached["task_id"]}')
+
+    @mock.patch.dict('packer.result_cache.task_config', result_cache_ttl=60)
+    def test_result_cache_invalidated_by_user(self):
+        task_id = json.loads(self.mocked_post('/jobs/create', self.post_args).body)['task_id']
+        result_cache.store(redis, dict(TaskStatus(task_id).get(), status=Status.SUCCESS))
+        self.assertTrue(redis.exists(result_cache.cache_key(mock_user)))
+        response = self.fetch('/jobs/cache', method='DELETE', headers=get_mock_auth())
+        self.assertEqual(204, response.code)
+        self.assertFalse(redis.exists(result_cache.cache_key(mock_user)))
+        self.mocked_get(f'/jobs/cancel/{task_id}')
+
+    def test_batch_create_and_status(self):
+        jobs = [{"job_type": "add", "job_parameters": {"x": 2, "y": 9, "sleep": 1}},
+                {"job_type": "add", "job_parameters": {"x": 3, "y": 9, "sleep": 0}, "coalesce": False},
+                {"job_type": "add", "job_parameters": {"sleep": 1, "y": 9, "x": 2}}]
+        response = self.mocked_post('/jobs/batch/create', {"jobs": jobs})
+        self.assertEqual(200, response.code)
+        created = json.loads(response.body)['jobs']
+        self.assertEqual(3, len(created))
+        for body in created:
+            self.check_create_response(body)
+        self.assertNotEqual(created[0]['task_id'], created[1]['task_id'])
+        self.assertEqual(created[0]['task_id'], created[2]['task_id'])
+
+        task_ids = [created[0]['task_id'], created[1]['task_id'], 'some-non-existent-uuid']
+        response = self.mocked_get('/jobs/batch/status?' + '&'.join(f'task_id={task_id}' for task_id in task_ids))
+        self.assertEqual(200, response.code)
+        body = json.loads(response.body)
+        self.assertEqual(task_ids[:2], [status['task_id'] for status in body['jobs']])
+        self.assertEqual(['some-non-existent-uuid'], body['not_found'])
+        for _ in range(20):
+            body = json.loads(self.mocked_post('/jobs/batch/status', {"task_ids": task_ids[:2]}).body)
+            if all(status['status'] == Status.SUCCESS for status in body['jobs']):
+                break
+            time.sleep(0.3)
+        self.assertEqual([Status.SUCCESS, Status.SUCCESS], [status['status'] for status in body['jobs']])
+
+    def test_batch_create_all_coalesced(self):
+        jobs = [{"job_type": "add", "job_parameters": {"x": 4, "y": 9, "sleep": 1}},
+                {"job_type": "add", "job_parameters": {"x": 5, "y": 9, "sleep": 1}}]
+        created = json.loads(self.mocked_post('/jobs/batch/create', {"jobs": jobs}).body)['jobs']
+        response = self.mocked_post('/jobs/batch/create', {"jobs": jobs})
+        self.assertEqual(200, response.code)
+        self.assertEqual([body['task_id'] for body in created],
+                         [body['task_id'] for body in json.loads(response.body)['jobs']])
+
+    def test_batch_create_too_large_job_not_linked(self):
+        jobs = [{"job_type": "add", "job_parameters": {"x": 1, "y": 2, "sleep": 0}},
+                {"job_type": "basic_export", "job_parameters": {"constraint": {"type": "true"}}, "cache": False}]
+
+        async def lookup(*args):
+            return 'cached-task-id'
+
+        async def estimate_job(job_parameters, token):
+            if 'constraint' in job_parameters:
+                return {'observations': 10 ** 8, 'memory_mb': 200000}
+            return None
+
+        jobs_before = redis.scard(f'jobs:{mock_user}')
+        with mock.patch.dict('packer.result_cache.task_config', result_cache_ttl=60), \
+                mock.patch.object(result_cache, 'lookup', lookup), \
+                mock.patch.object(packer.main.cost_estimate, 'estimate_job', estimate_job), \
+                mock.patch.object(result_cache, 'link_result') as link_result:
+            response = self.mocked_post('/jobs/batch/create', {"jobs": jobs})
+        self.assertEqual(413, response.code)
+        self.assertIn('Job 1:', json.loads(response.body)['error'])
+        link_result.assert_not_called()
+        self.assertEqual(jobs_before, redis.scard(f'jobs:{mock_user}'))
+
+    @mock.patch.dict('packer.admission.admission_config', user_limit=1)
+    def test_batch_create_dispatch_fails(self):
+        self.addCleanup(redis.delete, 'admission:running', f'admission:running:{mock_user}')
+        jobs = [{"job_type": "add", "job_parameters": {"x": 6, "y": 9, "sleep": 0}}]
+        with mock.patch('packer.jobs.JobSpec.apply_async', side_effect=ConnectionError('Broker is unavailable.')):
+            response = self.mocked_post('/jobs/batch/create', {"jobs": jobs})
+        self.assertEqual(200, response.code)
+        task_id = json.loads(response.body)['jobs'][0]['task_id']
+        self.assertEqual(Status.FAILED, json.loads(self.mocked_get(f'/jobs/status/{task_id}').body)['status'])
+        self.assertEqual(0, redis.zcard(f'admission:running:{mock_user}'))
+        # Identical jobs are not coalesced with the failed job.
+        response = self.mocked_post('/jobs/batch/create', {"jobs": jobs})
+        self.assertNotEqual(task_id, json.loads(response.body)['jobs'][0]['task_id'])
+
+    def test_batch_create_invalid_job(self):
+        jobs = [{"job_type": "add", "job_parameters": {"x": 1, "y": 1}},
+                {"job_type": "add", "job_parameters": {"y": 1}}]
+        jobs_before = redis.scard(f'jobs:{mock_user}')
+        response = self.mocked_post('/jobs/batch/create', {"jobs": jobs})
+        self.assertEqual(400, response.code)
+        self.assertIn('Job 1:', json.loads(response.body)['error'])
+        self.assertEqual(jobs_before, redis.scard(f'jobs:{mock_user}'))
+        response = self.mocked_post('/jobs/batch/create', {"jobs": []})
+        self.assertEqual(400, response.code)
+        response = self.mocked_get('/jobs/batch/create')
+        self.assertEqual(405, response.code)
+
+    def test_metrics(self):
+        self.get('/jobs')
+        response = self.get('/metrics')
+        self.assertEqual(200, response.code)
+        self.assertTrue(response.headers['Content-Type'].startswith('text/plain; version=0.0.4'))
+        body = response.body.decode('utf-8')
+        self.assertIn('packer_http_request_duration_seconds_count{handler="JobListHandler",method="GET",code="200"}',
+                      body)
+        self.assertIn('packer_redis_command_duration_seconds_count{command="SMEMBERS"}', body)
+        self.assertIn('packer_queue_length{queue="light"}', body)
+        self.assertIn('# TYPE packer_job_stage_duration_seconds histogram', body)
+
     def test_status_wrong_task(self):
         response = self.get('/jobs/status/some-non-existent-uuid')
         self.assertEqual(404, response.code)
 
     def test_job_cancelling(self):
         response = self.mocked_post('/jobs/create', self.post_args)
-        body = json.loads(response.body)
-        response = self.mocked_get(f'/jobs/cancel/{body.get("task_id")}')
+        task_id = json.loads(response.body).get('task_id')
+        response = self.mocked_get(f'/jobs/cancel/{task_id}')
         self.assertEqual(200, response.code)
-        response = self.mocked_get(f'/jobs/status/{body.get("task_id")}')
-        body = json.loads(response.body)
+        # An identical job is not the one that is being cancelled.
+        response = self.mocked_post('/jobs/create', self.post_args)
+        self.assertNotEqual(task_id, json.loads(response.body).get('task_id'))
+        # A job that has started already is cancelled by its worker.
+        for _ in range(20):
+            body = json.loads(self.mocked_get(f'/jobs/status/{task_id}').body)
+            if body['status'] == Status.CANCELLED:
+                break
+            time.sleep(0.1)
         self.assertEqual(Status.CANCELLED, body.get('status'))
 
+    @mock.patch.dict('packer.admission.admission_config', user_limit=1)
+    @tornado.testing.gen_test
+    async def test_status_long_poll_wakes_on_cancel(self):
+        self.addCleanup(redis.delete, 'admission:running', f'admission:running:{mock_user}',
+                        f'admission:pending:{mock_user}', 'admission:users')
+        port = tornado_config.get("port")
+        client = httpclient.AsyncHTTPClient()
+        args = dict(self.post_args, coalesce=False)
+        tasks = []
+        for _ in range(2):
+            r = await client.fetch(f"http://localhost:{port}/jobs/create", method='POST', body=json.dumps(args),
+                                   headers=get_mock_auth())
+            tasks.append(json.loads(r.body))
+        pending = tasks[1]
+        self.assertEqual(1, pending['queue_position'])
+
+        long_poll = client.fetch(f"http://localhost:{port}/jobs/status/{pending['task_id']}?wait=10",
+                                 headers={'If-None-Match': f'"{pending["version"]}"', **get_mock_auth()})
+        started_at = time.monotonic()
+        await client.fetch(f"http://localhost:{port}/jobs/cancel/{pending['task_id']}", headers=get_mock_auth())
+        body = json.loads((await long_poll).body)
+        self.assertLess(time.monotonic() - started_at, 5)
+        self.assertEqual(Status.CANCELLED, body['status'])
+        await client.fetch(f"http://localhost:{port}/jobs/cancel/{tasks[0]['task_id']}", headers=get_mock_auth())
+
+    @mock.patch.dict('packer.admission.admission_config', user_limit=1)
+    def test_slot_released_when_dispatch_fails(self):
+        self.addCleanup(redis.delete, 'admission:running', f'admission:running:{mock_user}')
+        with mock.patch('packer.jobs.JobSpec.apply_async', side_effect=ConnectionError('Broker is unavailable.')):
+            response = self.mocked_post('/jobs/create', dict(self.post_args, coalesce=False))
+        self.assertEqual(400, response.code)
+        self.assertEqual(0, redis.zcard(f'admission:running:{mock_user}'))
+
+    def test_failed_dispatch_not_coalesced(self):
+        args = {"job_type": "add", "job_parameters": {"x": 5, "y": 8, "sleep": 0}}
+        with mock.patch('packer.jobs.JobSpec.apply_async', side_effect=ConnectionError('Broker is unavailable.')):
+            response = self.mocked_post('/jobs/create', args)
+        self.assertEqual(400, response.code)
+        created = json.loads(self.mocked_post('/jobs/create', args).body)
+        self.assertIn(created['status'], (Status.REGISTERED, Status.RUNNING))
+        failed = [status for status in json.loads(self.mocked_get('/jobs').body)['jobs']
+                  if status['job_parameters'] == args['job_parameters'] and status['task_id'] != created['task_id']]
+        self.assertEqual([Status.FAILED], [status['status'] for status in failed])
+
+    def test_running_job_cancelling(self):
+        args = {"job_type": "add", "job_parameters": {"x": 1, "y": 2, "sleep": 5}, "coalesce": False}
+        task_id = json.loads(self.mocked_post('/jobs/create', args).body).get('task_id')
+        for _ in range(20):
+            if json.loads(self.mocked_get(f'/jobs/status/{task_id}').body)['status'] == Status.RUNNING:
+                break
+            time.sleep(0.1)
+        self.mocked_get(f'/jobs/cancel/{task_id}')
+        # The worker sets the status when the task has stopped.
+        body = json.loads(self.mocked_get(f'/jobs/status/{task_id}').body)
+        self.assertIn(body['message'], ('Cancelling the task.', 'Task cancelled during execution.'))
+        for _ in range(20):
+            body = json.loads(self.mocked_get(f'/jobs/status/{task_id}').body)
+            if body['message'] == 'Task cancelled during execution.':
+                break
+            time.sleep(0.1)
+        self.assertEqual(Status.CANCELLED, body['status'])
+        self.assertEqual('Task cancelled during execution.', body['message'])
+
     def test_get_job_list(self):
         response = self.get('/jobs')
         self.assertEqual(200, response.code)
@@ -231,7 +514,10 @@ class TestWebAppHandlers(TestHandlerBase):
 
         response = self.mocked_get(f'/jobs/data/{task_id}')
         self.assertEqual(403, response.code)
-        time.sleep(2)
+        for _ in range(50):
+            if json.loads(self.mocked_get(f'/jobs/status/{task_id}').body)['status'] == Status.SUCCESS:
+                break
+            time.sleep(0.1)
 
         response = self.mocked_get(f'/jobs/data/{task_id}')
         self.assertEqual(200, response.code)
@@ -271,3 +557,172 @@ class TestWebAppHandlers(TestHandlerBase):
             if message.get('status') == Status.SUCCESS:
                 break
 
+    @tornado.testing.gen_test
+    async def test_ws_listen_multiple_connections(self):
+        auth_header = get_mock_auth()
+        port = tornado_config.get("port")
+        ws_url = f"ws://localhost:{port}/jobs/subscribe"
+        ws_clients = []
+        for _ in range(2):
+            request = httpclient.HTTPRequest(ws_url, headers=auth_header)
+            ws_client = await tornado.websocket.websocket_connect(request)
+            await ws_client.read_message()
+            ws_clients.append(ws_client)
+
+        client = httpclient.AsyncHTTPClient()
+        r = await client.fetch(
+            f"http://localhost:{port}/jobs/create",
+            body=json.dumps(self.post_args),
+            method='POST',
+            headers=auth_header
+        )
+        task_id = json.loads(r.body).get('task_id')
+
+        for ws_client in ws_clients:
+            while True:
+                message = json.loads(await ws_client.read_message())
+                if message.get('task_id') == task_id and message.get('status') == Status.SUCCESS:
+                    break
+
+    @tornado.testing.gen_test
+    async def test_ws_replay_missed_events(self):
+        auth_header = get_mock_auth()
+        port = tornado_config.get("port")
+        ws_url = f"ws://localhost:{port}/jobs/subscribe"
+        ws_client = await tornado.websocket.websocket_connect(httpclient.HTTPRequest(ws_url, headers=auth_header))
+        await ws_client.read_message()
+
+        client = httpclient.AsyncHTTPClient()
+        r = await client.fetch(
+            f"http://localhost:{port}/jobs/create",
+            body=json.dumps(self.post_args),
+            method='POST',
+            headers=auth_header
+        )
+        task_id = json.loads(r.body).get('task_id')
+
+        event_ids = []
+        while True:
+            message = json.loads(await ws_client.read_message())
+            if message.get('task_id') != task_id:
+                continue
+            event_ids.append(message.get('event_id'))
+            if message.get('status') == Status.SUCCESS:
+                break
+        ws_client.close()
+
+        request = httpclient.HTTPRequest(f"{ws_url}?last_event_id={event_ids[0]}", headers=auth_header)
+        ws_client = await tornado.websocket.websocket_connect(request)
+        await ws_client.read_message()
+        while True:
+            message = json.loads(await ws_client.read_message())
+            if message.get('task_id') != task_id:
+                continue
+            # Replayed updates of the same task may be coalesced to the latest one.
+            self.assertIn(message.get('event_id'), event_ids[1:])
+            if message.get('event_id') == event_ids[-1]:
+                break
+
+    @tornado.testing.gen_test
+    async def test_ws_live_events_after_failed_replay(self):
+        async def read_events_after(*args):
+            raise ConnectionError('Redis is unavailable.')
+
+        auth_header = get_mock_auth()
+        port = tornado_config.get("port")
+        request = httpclient.HTTPRequest(f"ws://localhost:{port}/jobs/subscribe?last_event_id=1-0",
+                                         headers=auth_header)
+        with mock.patch('packer.main.read_events_after', read_events_after):
+            ws_client = await tornado.websocket.websocket_connect(request)
+            await ws_client.read_message()
+            self.assertEqual({'resync': True}, json.loads(await ws_client.read_message()))
+
+        client = httpclient.AsyncHTTPClient()
+        r = await client.fetch(
+            f"http://localhost:{port}/jobs/create",
+            body=json.dumps(self.post_args),
+            method='POST',
+            headers=auth_header
+        )
+        task_id = json.loads(r.body).get('task_id')
+        while True:
+            message = json.loads(await ws_client.read_message())
+            if message.get('task_id') == task_id and message.get('status') == Status.SUCCESS:
+                break
+
+    @tornado.testing.gen_test
+    async def test_ws_resync_after_trimmed_events(self):
+        key = f'events:{mock_user}'
+        event_ids = [redis.xadd(key, {'event': json.dumps({'task_id': 'some-task-id', 'status': Status.RUNNING})})
+                     for _ in range(3)]
+        redis.xtrim(key, 1, approximate=False)
+
+        auth_header = get_mock_auth()
+        port = tornado_config.get("port")
+        request = httpclient.HTTPRequest(f"ws://localhost:{port}/jobs/subscribe?last_event_id={event_ids[0]}",
+                                         headers=auth_header)
+        ws_client = await tornado.websocket.websocket_connect(request)
+        await ws_client.read_message()
+        self.assertEqual({'resync': True}, json.loads(await ws_client.read_message()))
+        self.assertEqual(event_ids[2], json.loads(await ws_client.read_message())['event_id'])
+
+        request = httpclient.HTTPRequest(f"ws://localhost:{port}/jobs/subscribe?last_event_id={event_ids[2]}",
+                                         headers=auth_header)
+        ws_client = await tornado.websocket.websocket_connect(request)
+        await ws_client.read_message()
+        # Nothing was lost, the next message is a live one.
+        redis.publish(f'channel:{mock_user}', json.dumps({'task_id': 'some-task-id', 'status': Status.SUCCESS}))
+        self.assertEqual(Status.SUCCESS, json.loads(await ws_client.read_message())['status'])
+
+    @tornado.testing.gen_test
+    async def test_ws_invalid_subscription(self):
+        auth_header = get_mock_auth()
+        port = tornado_config.get("port")
+        request = httpclient.HTTPRequest(f"ws://localhost:{port}/jobs/subscribe", headers=auth_header)
+        ws_client = await tornado.websocket.websocket_connect(request)
+        await ws_client.read_message()
+        for message in ('"task"', '{"subscribe": "some-task-id"}', '{"unsubscribe": [1]}'):
+            ws_client.write_message(message)
+            self.assertIn('error', json.loads(await ws_client.read_message()))
+
+        # A socket that watches all tasks cannot be narrowed, it keeps watching all tasks.
+        ws_client.write_message(json.dumps({'subscribe': ['some-other-task-id']}))
+        self.assertIn('error', json.loads(await ws_client.read_message()))
+        client = httpclient.AsyncHTTPClient()
+        r = await client.fetch(
+            f"http://localhost:{port}/jobs/create",
+            body=json.dumps(self.post_args),
+            method='POST',
+            headers=auth_header
+        )
+        task_id = json.loads(r.body).get('task_id')
+        while True:
+            message = json.loads(await ws_client.read_message())
+            if message.get('task_id') == task_id and message.get('status') == Status.SUCCESS:
+                break
+
+    @tornado.testing.gen_test
+    async def test_ws_task_subscription_batched(self):
+        auth_header = get_mock_auth()
+        port = tornado_config.get("port")
+        client = httpclient.AsyncHTTPClient()
+        task_ids = []
+        for _ in range(2):
+            r = await client.fetch(
+                f"http://localhost:{port}/jobs/create",
+                body=json.dumps(self.post_args),
+                method='POST',
+                headers=auth_header
+            )
+            task_ids.append(json.loads(r.body).get('task_id'))
+
+        ws_url = f"ws://localhost:{port}/jobs/subscribe?task_id={task_ids[0]}&batch=true"
+        ws_client = await tornado.websocket.websocket_connect(httpclient.HTTPRequest(ws_url, headers=auth_header))
+        await ws_client.read_message()
+        done = False
+        while not done:
+            events = json.loads(await ws_client.read_message())
+            self.assertIsInstance(events, list)
+            for event in events:
+                self.assertEqual(task_ids[0], event.get('task_id'))
+                done = done or event.get('status') == Status.SUCCESS
@@ -0,0 +1,34 @@
+import gc
+import unittest
+from unittest import mock
+
+from packer import warmup
+
+
+class WarmupTestCase(unittest.TestCase):
+
+    def test_warm_up_worker(self):
+        self.addCleanup(gc.unfreeze)
+        with mock.patch.object(warmup.logger, 'warning') as warning:
+            warmup.warm_up_worker()
+        warning.assert_not_called()
+        self.assertGreater(gc.get_freeze_count(), 0)
+
+    def test_prime_worker_process(self):
+        with mock.patch.dict('packer.warmup.keycloak_config', offline_token='offline'), \
+                mock.patch('packer.auth.get_access_token_by_offline_token') as get_token, \
+                mock.patch('packer.http_client.get_session') as get_session, \
+                mock.patch('threading.Thread.start', lambda thread: thread.run()):
+            warmup.prime_worker_process()
+        get_session.assert_called_once()
+        get_token.assert_called_once()
+
+    def test_token_failure_logged(self):
+        with mock.patch('packer.auth.get_access_token_by_offline_token', side_effect=ConnectionError('down')), \
+                mock.patch.object(warmup.logger, 'warning') as warning:
+            warmup.fetch_service_token()
+        warning.assert_called_once()
+
+
+if __name__ == '__main__':
+    unittest.main()